@@ -173,6 +173,7 @@ The "supervisor" command accepts the following options:
   --include=program       include program in the supervisord config
   --autoreload=program    restart program when code files change
   --noreload              don't restart programs when code files change
+  --refresh-config        ignore any cached copy of the merged config
 
 
 Extra Goodies
@@ -204,6 +205,12 @@ configuration file contains the following variables::
 
     environ              the os.environ dict, as seen by your code.
 
+    HOST                 facts about the CPUs and memory of the machine, as
+                         described below.
+
+    SOCKET_FD            the file descriptor of the shared listening socket,
+                         for programs with a "listen" option.
+
 If your project has other configuration files that need to interpolate these
 values, you can refer to them via the "templated" filter, like this::
 
@@ -213,7 +220,419 @@ values, you can refer to them via the "templated" filter, like this::
 The file path is relative to your project directory.  Django-supervisor will
 read the specified file, pass it through its templating logic, write out a
 matching "nginx.conf.templated" file, and insert the path to this file as the
-result of the filter.
+result of the filter.  The templated file is replaced atomically, and is only
+written when its contents have actually changed.
+
+
+Sizing Processes for the Host
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Rather than hard-coding how many worker processes to run, you can size them
+to fit whatever machine the config is rendered on.  The HOST template
+variable has the following attributes, each of which is only worked out if
+you use it::
+
+    HOST.cpu_count           number of CPUs in the machine.
+
+    HOST.usable_cpus         number of CPUs we can actually use, taking into
+                             account the CPU affinity mask and any cgroup
+                             CPU quota, e.g. when running in a container.
+
+    HOST.memory_total        total memory in bytes, limited by any cgroup
+                             memory limit.
+
+    HOST.memory_available    memory currently available in bytes, limited
+                             by any cgroup memory limit.
+
+The "workers" tag turns these into a number of processes.  It gives per_cpu
+workers for each usable CPU plus a constant, capped so that they all fit in
+memory at memory_per_worker each, and kept between at_least and at_most::
+
+    [program:celeryd]
+    command={{ PYTHON }} {{ PROJECT_DIR }}/manage.py celery worker -l info
+    process_name=%(program_name)s_%(process_num)s
+    numprocs={% workers per_cpu=2 plus=1 memory_per_worker="256M" at_most=32 %}
+
+The same config then runs three workers on a single-core laptop and
+thirty-two on a big server.  The config cache is refreshed whenever the
+number of CPUs or total memory changes, but not for changes in available
+memory, so use --refresh-config if you depend on that.
+
+
+Shared Listening Sockets
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+Rather than giving each process of a web server its own port, you can have
+all of them accept connections on a single socket by giving the program a
+"listen" option.  This is either "[<host>:]<port>" for a TCP socket, with the
+host defaulting to 127.0.0.1, or a path for a unix socket::
+
+    [program:webserver]
+    command={{ PYTHON }} -m gunicorn --bind fd://{{ SOCKET_FD }} myproject.wsgi
+    numprocs={% workers per_cpu=2 %}
+    process_name=%(program_name)s_%(process_num)s
+    listen=*:8000
+
+Such programs are turned into supervisord [fcgi-program:x] sections, so the
+socket is bound once by supervisord before any of the processes start, and
+is passed to each of them as the file descriptor given by the SOCKET_FD
+template variable (i.e. as stdin).  The kernel shares incoming connections
+among all the processes accepting on it, and restarting any one process
+doesn't drop connections.  Options such as socket_owner, socket_mode and
+socket_backlog are passed through to supervisord.
+
+
+Preloaded Workers
+~~~~~~~~~~~~~~~~~
+
+Every program that runs manage.py normally pays for importing Django and
+your apps itself, and keeps its own private copy of everything it imported.
+To avoid this, give such programs the "zygote" option::
+
+    [program:celeryd]
+    command={{ PYTHON }} {{ PROJECT_DIR }}/manage.py celeryd -n w%(process_num)s
+    numprocs=8
+    process_name=%(program_name)s_%(process_num)s
+    zygote=true
+
+This adds a "djsupervisor_zygote" program to the config, which sets up Django
+and imports the management commands of all such programs once.  Each process
+is then forked from the zygote when it starts, so it starts almost instantly
+and shares most of its memory with the others copy-on-write.  You can have the
+zygote import other modules up front by listing them in the setting
+SUPERVISOR_ZYGOTE_PRELOAD.
+
+supervisord actually runs a tiny script in place of each process, which
+doesn't import Django.  It passes the worker its stdin, stdout, stderr and
+environment, forwards any signals to it, and exits with the same status, so
+the worker behaves like a normal supervised process.  If the zygote isn't
+running, the script just runs the command itself after a short wait.
+Restarting the zygote, e.g. for autoreload, doesn't affect running workers.
+
+Because workers are forked from the zygote, they run as the same user and
+with the same Django settings as the zygote, whatever their environment
+says.  Their resource usage is counted under the zygote by the "stats"
+command rather than under their own programs, so max_rss limits don't apply
+to them.
+
+
+App-Provided and Included Config Files
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Any installed app can provide its own process definitions by shipping a
+"management/supervisord.conf" file.  These are merged in the order the apps
+appear in INSTALLED_APPS, and then your project's supervisord.conf is merged
+over the top of them so you can tweak or exclude whatever they define.  The
+APP_DIR template variable points to the app's directory while rendering such
+files.  If you set SUPERVISOR_CONFIG_FILE, apps are expected to use that name
+for their file too.
+
+Your project can also split its config into several files by dropping them
+in a "conf.d" directory next to manage.py.  All files matching "conf.d/*.conf"
+are merged, in sorted order, after the main project config file.  You can
+use a different pattern by setting SUPERVISOR_CONFIG_INCLUDE, or set it to
+None to disable this.
+
+All of these files are rendered concurrently, using a pool of
+SUPERVISOR_RENDER_THREADS threads.  Each file is also cached separately, so
+that only the files that have changed need to be rendered again.
+
+
+Config Caching
+~~~~~~~~~~~~~~
+
+Rendering and merging all the config files takes a little while, and it
+happens every time you run the "supervisor" command.  To avoid repeating
+this work, django-supervisor caches the final merged config on disk and
+re-uses it until something changes.  The cache is keyed on the config files
+and any files used with the "templated" filter, the settings module, the
+command-line options, the environment and the python interpreter.
+
+The cache is stored in a ".supervisor-cache" directory next to your
+supervisord.conf file, which you may want to add to your .gitignore.  You
+can store it elsewhere by setting SUPERVISOR_CONFIG_CACHE_DIR, or disable
+it entirely by setting SUPERVISOR_CONFIG_CACHE to False.  If you need to
+force the config to be rebuilt, pass the --refresh-config option.
+
+
+Fast Control Commands
+~~~~~~~~~~~~~~~~~~~~~
+
+Every run of "manage.py supervisor" has to set up Django before it can do
+anything, which adds up if you're calling e.g. "supervisor status" from a
+health-check script.  For such control commands you can instead use the
+lightweight djsupervisor.ctl module, which re-uses the connection details
+from the config cache and doesn't need to import Django at all::
+
+    $ python -m djsupervisor.ctl status
+    celeryd                          RUNNING    pid 4937, uptime 0:00:55
+    webserver                        RUNNING    pid 4801, uptime 0:09:05
+
+It finds your project by looking for manage.py in the current directory and
+its parents, or you can pass the --project-dir option.  If the cached config
+is missing or out of date, or your environment has changed since it was
+written, it simply runs "manage.py supervisor" for you.
+
+
+Following Logs
+~~~~~~~~~~~~~~
+
+The "logs" command follows the output of any number of processes at once,
+prefixing each line with the time and the name of the process it came from::
+
+    $ python myproject/manage.py supervisor logs 'celeryd_*' webserver
+    14:02:11 celeryd_1:celeryd_1 | Task tasks.send_mail succeeded in 0.12s
+    14:02:12 webserver:webserver | "GET / HTTP/1.1" 200 5120
+
+Process names can include shell-style wildcards, and new processes matching
+them are picked up as they appear.  With no names it follows every process.
+All the logs are read over a single connection to supervisord, and quiet
+processes are checked less and less often, so following lots of them is
+cheap.  Use --stderr to follow the stderr logs instead, --bytes to change
+how much existing output is shown, and --no-follow to just show the existing
+output and exit.
+
+
+Resource Usage
+~~~~~~~~~~~~~~
+
+The "stats" command shows the CPU, memory, thread, file descriptor and
+context switch usage of each supervised process, totalled over any child
+processes it has started::
+
+    $ python myproject/manage.py supervisor stats
+    NAME                                 PID PROCS   CPU%   CPU TIME       RSS THREADS    FDS  CTX SWTCH
+    celeryd:celeryd                     4937     5    2.0      31.27    212.4M      15     61      84221
+    webserver:webserver                 4801     1    0.0       3.82     48.1M       1     12       6310
+
+By default it takes two samples a second apart, to work out the CPU usage.
+Use --interval and --count to change how often and how many times it prints
+the usage (--count=0 keeps going until interrupted), and --json to print a
+line of JSON for each process instead of a table.  This reads directly from
+/proc, so it is only available on Linux and similar systems.
+
+
+Metrics
+~~~~~~~
+
+If you set SUPERVISOR_METRICS_PORT, an extra "metrics" eventlistener is added
+to the config.  It serves metrics for every supervised process over HTTP in
+the Prometheus text format, e.g. at http://127.0.0.1:9001/metrics for a port
+of 9001.  You can change the interface it listens on with the setting
+SUPERVISOR_METRICS_HOST, which defaults to "127.0.0.1".
+
+The exported metrics include the current state of each process, its uptime,
+the total time it has spent in each state, how many times it has been started
+and restarted after exiting, and its last exit status.  These are all kept
+up to date from events sent by supervisord, so scraping them doesn't put any
+load on supervisord itself.  Like any other section, you can disable the
+listener with "exclude=true" in an [eventlistener:metrics] section.
+
+
+Memory Limits
+~~~~~~~~~~~~~
+
+Long-running workers often grow slowly over time.  To have them restarted
+when they get too big, give their program a "max_rss" option::
+
+    [program:celeryd]
+    command={{ PYTHON }} {{ PROJECT_DIR }}/manage.py celery worker -l info
+    max_rss=512MB
+    max_rss_window=60
+
+If any program has a max_rss, a "djsupervisor_memwatch" eventlistener is added
+to the config.  Every five seconds it checks the resident memory of each
+process, totalled over all of its child processes, and gracefully restarts any
+that have been over their limit for at least max_rss_window seconds (by
+default, straight away).  At most one process is restarted at a time, and each
+restart is logged to the listener's stderr log along with the memory usage
+that triggered it.  Like "stats", this reads directly from /proc, so it is
+only available on Linux and similar systems.
+
+
+Health Checks
+~~~~~~~~~~~~~
+
+supervisord only knows whether a process is running, not whether it's
+actually working.  To have a process restarted when it stops responding,
+give its program one of the options "healthcheck_http" (a URL that must
+respond without an error status), "healthcheck_tcp" (a host:port that must
+accept connections) or "healthcheck_cmd" (a command that must exit with
+status zero)::
+
+    [program:webserver]
+    command={{ PYTHON }} {{ PROJECT_DIR }}/manage.py runserver 80%(process_num)02d
+    numprocs=4
+    process_name=%(program_name)s_%(process_num)s
+    healthcheck_http=http://127.0.0.1:80%(process_num)02d/health/
+    healthcheck_interval=10
+    healthcheck_timeout=5
+    healthcheck_max_latency=2
+    healthcheck_failures=3
+
+The options can use the same %(process_num)s style expansions as the command.
+Each process is probed every healthcheck_interval seconds (default 10), once
+it has been running for healthcheck_grace seconds (default 10).  A probe
+fails if it takes longer than healthcheck_timeout (default 5), or longer than
+healthcheck_max_latency if given, and a process is restarted after
+healthcheck_failures failures in a row (default 3).  Only one process in each
+group is restarted at a time.
+
+All probes are run by a single "djsupervisor_healthcheck" program that is
+added to the config, using a pool of SUPERVISOR_HEALTHCHECK_THREADS threads
+(default 32) so that slow probes don't hold up the others.  Restarts run on
+their own threads, so they don't hold up the probes either.  Failures and
+restarts go to its log, and the "health" command shows the latest status and
+probe latency of each process::
+
+    $ python myproject/manage.py supervisor health
+    NAME                             STATUS         LATENCY FAILURES  CHECK
+    webserver:webserver_0            healthy          1.9ms        0  http http://127.0.0.1:8000/health/
+    webserver:webserver_1            failing        5001.2ms       1  http http://127.0.0.1:8001/health/ (timed out)
+
+
+Startup Dependencies
+~~~~~~~~~~~~~~~~~~~~
+
+supervisord starts all its programs at once, in order of priority, without
+waiting for any of them to be ready.  To start a program only once the
+programs it needs are ready, give it a "depends_on" option listing them::
+
+    [program:postgres]
+    command=/usr/lib/postgresql/bin/postgres -D {{ PROJECT_DIR }}/db
+    ready_when=log:ready to accept connections
+
+    [program:webserver]
+    command={{ PYTHON }} {{ PROJECT_DIR }}/manage.py runserver 8000
+    depends_on=postgres
+    ready_when=port:8000
+
+    [program:celeryd]
+    command={{ PYTHON }} {{ PROJECT_DIR }}/manage.py celeryd
+    depends_on=postgres webserver
+
+Programs with dependencies are started by a "djsupervisor_startup" program
+that is added to the config.  It starts each of them as soon as everything it
+depends on is ready, so independent programs still start in parallel, and it
+logs how long each step took before exiting.  A program is ready once all its
+processes are RUNNING, or when the condition given by its "ready_when" option
+holds: either "port:[<host>:]<port>" accepting connections, "file:<path>"
+existing, or "log:<text>" having been written to the stdout log of every
+process.  Only output written during this run counts, so programs that others
+depend on with a "log:" condition are also started by the startup program,
+once it has noted where their logs end.  If a program fails to start, or stays
+stopped because nothing is going to start it (e.g. it has autostart=false),
+or has no processes in the running supervisord, the programs depending on it
+are never started.
+
+Depending on an unknown program, or on a cycle of programs, is an error.
+Dependencies on programs excluded with exclude=true are ignored.
+
+
+Event Listeners
+~~~~~~~~~~~~~~~
+
+supervisord can send events to "eventlistener" processes whenever something
+happens, such as a process changing state.  djsupervisor lets you handle
+these events in your Django code: any [eventlistener:<name>] section that
+doesn't give a command of its own is run by the "listen" command, which sets
+up Django just once and sends the events to the receivers of the signal
+djsupervisor.signals.supervisor_events::
+
+    [eventlistener:alerts]
+    events=PROCESS_STATE_EXITED,PROCESS_STATE_FATAL
+    handlers=myapp.listeners.send_alert
+
+Receivers are called with the name of the listener and a list of events,
+each of which has attributes "name", "serial", "headers", "data" and "body".
+The optional "handlers" option gives the dotted paths of extra receivers to
+connect in that particular listener process::
+
+    def send_alert(sender, listener, events, **kwargs):
+        for event in events:
+            notify("%s: %s" % (event.data["processname"], event.name))
+
+Events are read from supervisord in a background thread and handed over in
+batches of up to SUPERVISOR_LISTEN_BATCH_SIZE, which defaults to 100, so a
+slow receiver doesn't hold up supervisord.  If more than
+SUPERVISOR_LISTEN_MAX_PENDING events are waiting then the listener stops
+accepting new ones until it catches up, and supervisord buffers them instead.
+Since events are acknowledged when they are queued, an exception raised by a
+receiver won't cause supervisord to send the events again.  The time spent
+in each receiver is written to the listener's stderr log every
+SUPERVISOR_LISTEN_STATS_INTERVAL seconds.  Timing receivers separately relies
+on a Django internal that is available from Django 1.7 up to 4.2; with other
+versions, the total time spent in all of them is written instead.
+
+Listeners run by the "listen" command are auto-reloaded when your code changes,
+and get a buffer_size of 1024 so that supervisord can queue plenty of events
+for them; other listeners are left as they are.  The defaults for all event
+listeners can be set in an [eventlistener:__defaults__] section, just like for
+programs.
+
+
+Applying Config Changes
+~~~~~~~~~~~~~~~~~~~~~~~
+
+After changing your config, the "diffconfig" command will show you which
+process groups have been added, removed or changed, and for changed groups
+exactly which options differ::
+
+    $ python myproject/manage.py supervisor diffconfig
+    celerybeat: added
+    webserver: changed, needs restart (command, environment)
+    celeryd: changed, applied once stopped or with --force (stopwaitsecs)
+
+The "applyconfig" command then applies just those changes.  Unlike
+"supervisorctl update", it doesn't restart groups in which only options
+such as autostart, priority or stopwaitsecs have changed, since these don't
+affect the running processes.  Such changes are applied the next time you
+run "applyconfig" while the group is stopped, or straight away if you pass
+the --force argument.
+
+To tell which options have changed, django-supervisor keeps a snapshot of
+the running config in the config cache directory.  It is updated whenever
+changes are applied, whether by "applyconfig" or by passing "update", "add",
+"remove" or "reload" through to supervisorctl.  If that snapshot is missing,
+changed groups are always restarted.
+
+
+Rolling Restarts
+~~~~~~~~~~~~~~~~
+
+Restarting a group of processes with "supervisor restart" stops them all at
+once.  To keep things running during a deploy, you can instead restart them
+a few at a time with the "rolling-restart" command::
+
+    $ python myproject/manage.py supervisor rolling-restart --batch-size=25% web
+
+Each batch must reach the RUNNING state, and then stay up for the number of
+seconds given by --settle (default SUPERVISOR_ROLLING_RESTART_SETTLE, or 0)
+before the next batch is restarted.  If any process fails to come back up,
+the rolling restart stops with an error and the remaining processes are
+left untouched.
+
+
+Python Client API
+~~~~~~~~~~~~~~~~~
+
+If you want to control your processes from python code, such as a deploy
+script, you can use the djsupervisor.client module rather than shelling out
+to supervisorctl.  It connects using the same details as the "supervisor"
+command, keeps a small pool of persistent connections, and sends operations
+on many processes to supervisord as a single batch::
+
+    from djsupervisor.client import get_client
+
+    client = get_client()
+    failures = client.restart(["webserver","celeryd"])
+    for (name,error) in failures:
+        print "%s failed to restart: %s" % (name,error)
+
+The start(), stop() and restart() methods accept program names, full
+"group:name" process names and shell-style wildcards.  By default they wait
+until the processes have actually started or stopped.  Processes running
+under supervisord can get a client with SupervisorClient.from_environ().
 
 
 Defaults, Overrides and Excludes
@@ -250,6 +669,16 @@ Here's an example config file that shows them all in action::
     [program:autoreload]
     exclude=true
 
+You can also scope defaults and overrides to just those programs whose names
+match a shell-style pattern, by putting the pattern in the section name.  These
+take precedence over the global [program:__defaults__] and
+[program:__overrides__] sections, and if several patterns match the same
+program then the later sections win::
+
+    ; Give celery workers plenty of time to finish their tasks.
+    [program:celery_*:__defaults__]
+    stopwaitsecs=600
+
 
 
 Automatic Control Socket Config
@@ -291,6 +720,47 @@ option to supervisor or just exclude it in your project config file like so::
     [program:autoreload]
     exclude=true
 
+The autoreload process watches the directories containing your project's
+python modules, but not the python installation itself or any third-party
+packages installed into it.  You can add other directories to watch with
+SUPERVISOR_AUTORELOAD_INCLUDE_DIRS, and leave out directories matching the
+shell-style patterns in SUPERVISOR_AUTORELOAD_EXCLUDE_DIRS, which by default
+skips version-control metadata and node_modules.  To avoid running out of
+native filesystem watches it will watch at most
+SUPERVISOR_AUTORELOAD_MAX_WATCHES directories (default 4096), and reports
+how many it is using when it starts.
+
+If the native filesystem observer can't be used, the autoreload process falls
+back to polling.  It only looks at files matching the autoreload patterns,
+only re-lists directories that have changed, and polls less often while
+nothing is changing.  Its index of files is saved in the config cache
+directory so that it doesn't have to start from scratch after a restart.
+
+Changes are batched up so that a burst of activity, such as switching git
+branches, causes only a single restart.  The restart happens once no files
+have changed for SUPERVISOR_AUTORELOAD_QUIET_PERIOD seconds (default 0.5), or
+at most SUPERVISOR_AUTORELOAD_MAX_WAIT seconds (default 5) after the first
+change.
+
+If you set SUPERVISOR_AUTORELOAD_SELECTIVE to True, then each Django process
+running under supervisord will keep a record of the source files it has
+imported, and only those processes that imported a changed file will be
+restarted.  Other python programs can do the same by calling the function
+djsupervisor.imports.start_reporting().  Programs that don't keep such a
+record are always restarted.
+
+The autoreload process can also restart processes a few at a time; set
+SUPERVISOR_AUTORELOAD_BATCH_SIZE to a number or percentage to enable this.
+
+Saving a file without changing its contents, e.g. by running "touch" on it,
+doesn't cause a restart.  The autoreload process hashes the watched files in
+the background when it starts, keeps track of their contents as they change,
+and ignores changes that leave them the same; set SUPERVISOR_AUTORELOAD_CHECK_CONTENTS to False to disable this.
+
+The autoreload process keeps a connection open to supervisord, and restarts
+all the affected processes in a single batch.  It logs how long each restart
+took, and how long after the triggering change it finished, to its output.
+
 """
 
 __ver_major__ = 0
@@ -300,3 +770,4 @@ __ver_sub__ = ""
 __version__ = "%d.%d.%d%s" % (__ver_major__,__ver_minor__,__ver_patch__,__ver_sub__)
 
 
+default_app_config = "djsupervisor.apps.DjSupervisorConfig"
@@ -0,0 +1,23 @@
+"""
+
+djsupervisor.apps:  django application config for djsupervisor
+---------------------------------------------------------------
+
+When SUPERVISOR_AUTORELOAD_SELECTIVE is enabled, every Django process running
+under supervisord records the source files it has imported, so that the
+autoreloader can restart only the processes affected by a change.
+
+"""
+
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class DjSupervisorConfig(AppConfig):
+
+    name = "djsupervisor"
+
+    def ready(self):
+        if getattr(settings,"SUPERVISOR_AUTORELOAD_SELECTIVE",False):
+            from djsupervisor.imports import start_reporting
+            start_reporting()
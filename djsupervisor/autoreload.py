@@ -0,0 +1,441 @@
+"""
+
+djsupervisor.autoreload:  restart supervised processes when code changes
+------------------------------------------------------------------------
+
+This module provides the machinery behind the "supervisor autoreload"
+command.  The plan_watches() function decides which directories to watch
+for changes, and the AutoReloader class receives notifications of changed
+files from the filesystem observer and restarts the appropriate processes
+from a background thread using a single long-lived connection to supervisord.
+
+"""
+
+import os
+import sys
+import json
+import site
+import time
+import fnmatch
+import threading
+import traceback
+from distutils import sysconfig
+
+from djsupervisor import cache
+from djsupervisor import imports
+from djsupervisor.client import SupervisorClient
+
+
+class AutoReloader(object):
+    """Restart a set of supervised processes in response to code changes.
+
+    Call the trigger() method to request a restart.  It returns immediately,
+    and the restart is done in a background thread.  Any triggers that arrive
+    while a restart is in progress are coalesced into a single follow-up
+    restart, so we never queue up a backlog of redundant restarts.
+
+    If the autoreload process itself is among those to be restarted then it
+    is restarted last, from a forked child process.  Otherwise supervisord
+    would kill us while we were still restarting everything else.
+
+    If selective is true, only the processes that have imported one of the
+    changed files are restarted; see djsupervisor.imports for details.
+    If a ContentIndex is given, changes that leave the contents of all the
+    files unchanged are ignored.  If batch_size is given, processes are
+    restarted a few at a time as by SupervisorClient.rolling_restart().
+    """
+
+    def __init__(self,client,programs,own_name=None,selective=False,
+                      content_index=None,batch_size=None):
+        self.client = client
+        self.programs = list(programs)
+        if own_name is None:
+            own_name = get_own_process_name()
+        self.own_name = own_name
+        self.content_index = content_index
+        self.batch_size = batch_size
+        self.records_dir = None
+        if selective:
+            self.records_dir = imports.get_records_dir()
+        self._lock = threading.Lock()
+        self._pending = threading.Event()
+        self._triggered_at = None
+        self._changed_paths = set()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def trigger(self,changed_paths=()):
+        """Request that the processes be restarted as soon as possible."""
+        if changed_paths and self.content_index is not None:
+            num_changed = len(changed_paths)
+            changed_paths = self.content_index.filter_changed(changed_paths)
+            if not changed_paths:
+                print>>sys.stderr, "autoreload: ignoring %d files with"\
+                                   " unchanged contents" % (num_changed,)
+                return
+        for path in sorted(changed_paths)[:5]:
+            print>>sys.stderr, "autoreload: %s changed" % (path,)
+        if len(changed_paths) > 5:
+            print>>sys.stderr, "autoreload: ...and %d more files changed" \
+                               % (len(changed_paths) - 5,)
+        with self._lock:
+            if self._triggered_at is None:
+                self._triggered_at = time.time()
+            if changed_paths and self._changed_paths is not None:
+                self._changed_paths.update(changed_paths)
+            else:
+                self._changed_paths = None
+        self._pending.set()
+
+    def _run(self):
+        while True:
+            self._pending.wait()
+            with self._lock:
+                self._pending.clear()
+                triggered_at = self._triggered_at
+                changed_paths = self._changed_paths
+                self._triggered_at = None
+                self._changed_paths = set()
+            try:
+                self.restart(triggered_at,changed_paths)
+            except Exception:
+                print>>sys.stderr, "AUTORELOAD FAILED TO RESTART PROCESSES"
+                traceback.print_exc()
+
+    def restart(self,triggered_at=None,changed_paths=None):
+        """Restart the processes, logging how long it took.
+
+        If changed_paths is given and we're in selective mode, only those
+        processes affected by the changes are restarted.
+        """
+        start_time = time.time()
+        if triggered_at is None:
+            triggered_at = start_time
+        infos = self.client.get_all_process_info()
+        names = self.client.get_process_names(self.programs,infos)
+        if changed_paths and self.records_dir is not None:
+            records = imports.read_records(self.records_dir)
+            names = imports.select_processes(names,changed_paths,
+                                             infos,records)
+        restart_self = self.own_name in names
+        if restart_self:
+            names.remove(self.own_name)
+        failures = []
+        if names and self.batch_size:
+            failures = self.client.rolling_restart(names,self.batch_size)
+        elif names:
+            failures = self.client.restart(names)
+        for (name,error) in failures:
+            print>>sys.stderr, "autoreload: %s failed to restart: %s" \
+                               % (name,error)
+        end_time = time.time()
+        print>>sys.stderr, "autoreload: restarted %d processes in %.3fs"\
+                           " (%.3fs after change)" \
+                           % (len(names),end_time - start_time,
+                              end_time - triggered_at)
+        if restart_self:
+            self.restart_self()
+
+    def restart_self(self):
+        """Restart this autoreload process, from a forked child.
+
+        The child uses a fresh connection to supervisord, since the pooled
+        ones are shared with the parent.
+        """
+        if os.fork() == 0:
+            try:
+                client = SupervisorClient(self.client.serverurl,
+                                          self.client.username,
+                                          self.client.password)
+                client.restart([self.own_name])
+            finally:
+                os._exit(0)
+
+
+def get_own_process_name():
+    """Get the "group:name" of the current process, if it's supervised."""
+    name = os.environ.get("SUPERVISOR_PROCESS_NAME")
+    if name is None:
+        return None
+    group = os.environ.get("SUPERVISOR_GROUP_NAME",name)
+    return "%s:%s" % (group,name)
+
+
+class ContentIndex(object):
+    """Index of file contents, used to ignore changes that change nothing.
+
+    Call seed() when the watches are set up to hash the watched files in a
+    background thread, giving a baseline against which the first reported
+    change to each file can be compared.  A change to a file that isn't in
+    the index yet is always treated as real, since we don't know what it
+    contained before.  If index_file is given, the index is saved there so
+    that it survives restarts of the autoreload process.
+    """
+
+    def __init__(self,index_file=None):
+        self.index_file = index_file
+        self.digests = {}
+        self._lock = threading.Lock()
+        if index_file is not None:
+            try:
+                with open(index_file,"r") as f:
+                    self.digests = json.load(f)
+            except (EnvironmentError,ValueError):
+                pass
+
+    def seed(self,watches,patterns=("*.py",),ignore_patterns=()):
+        """Start hashing the files in the given watches, in the background.
+
+        The watches are (dirnm,recursive) tuples as returned by
+        plan_watches().  Files that are already in the index are skipped,
+        as are any modified since seeding began, since changes to them will
+        be reported anyway.  This returns the background thread.
+        """
+        started_at = time.time()
+        thread = threading.Thread(target=self._seed,
+                                  args=(watches,patterns,ignore_patterns,
+                                        started_at))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _seed(self,watches,patterns,ignore_patterns,started_at):
+        for (dirnm,recursive) in watches:
+            for (subdir,_,filenames) in os.walk(dirnm):
+                for filename in filenames:
+                    if not any(fnmatch.fnmatch(filename,pattern)
+                               for pattern in patterns):
+                        continue
+                    if any(fnmatch.fnmatch(filename,pattern)
+                           for pattern in ignore_patterns):
+                        continue
+                    path = os.path.join(subdir,filename)
+                    if path in self.digests:
+                        continue
+                    signature = cache.file_signature(path)
+                    #  Allow for filesystems with coarse timestamps.
+                    if signature is None or signature[0] >= started_at - 2:
+                        continue
+                    with self._lock:
+                        self.digests.setdefault(path,signature[2])
+                if not recursive:
+                    break
+        with self._lock:
+            self._save()
+
+    def filter_changed(self,paths):
+        """Get the subset of paths whose contents have actually changed."""
+        changed = set()
+        with self._lock:
+            for path in paths:
+                signature = cache.file_signature(path)
+                if signature is None:
+                    digest = self.digests.pop(path,None)
+                else:
+                    digest = self.digests.get(path)
+                    self.digests[path] = signature[2]
+                if digest is None or signature is None \
+                   or digest != signature[2]:
+                    changed.add(path)
+            if changed:
+                self._save()
+        return changed
+
+    def _save(self):
+        if self.index_file is not None:
+            try:
+                cache.atomic_write(self.index_file,json.dumps(self.digests))
+            except EnvironmentError:
+                pass
+
+
+def find_live_code_dirs(modules=None):
+    """Find all directories in which we might have live python code.
+
+    This walks all of the currently-imported modules and adds their
+    containing directory to the list of live dirs.  After normalization
+    and de-duplication, we get a pretty good approximation of the
+    directories on sys.path that are actively in use.
+    """
+    if modules is None:
+        modules = sys.modules.values()
+    live_dirs = []
+    for mod in modules:
+        #  Get the directory containing that module.
+        #  This is deliberately casting a wide net.
+        try:
+            dirnm = os.path.dirname(mod.__file__)
+        except AttributeError:
+            continue
+        #  Normalize it for comparison purposes.
+        dirnm = _normalize_dir(dirnm)
+        #  Check that it's not an egg or some other wierdness
+        if not os.path.isdir(dirnm):
+            continue
+        #  If it's a subdir of one we've already found, ignore it.
+        for dirnm2 in live_dirs:
+            if dirnm.startswith(dirnm2):
+                break
+        else:
+            #  Remove any ones we've found that are subdirs of it.
+            live_dirs = [dirnm2 for dirnm2 in live_dirs\
+                                if not dirnm2.startswith(dirnm)]
+            live_dirs.append(dirnm)
+    return live_dirs
+
+
+def get_interpreter_dirs():
+    """Get the directories containing the stdlib and third-party packages.
+
+    This deliberately doesn't include the interpreter's prefix directories
+    themselves, since projects often live beneath them, e.g. in /usr/src/app
+    with a system python in /usr, or with a virtualenv in the project dir.
+    """
+    prefixes = set([sys.prefix,sys.exec_prefix])
+    for attr in ("real_prefix","base_prefix","base_exec_prefix"):
+        if hasattr(sys,attr):
+            prefixes.add(getattr(sys,attr))
+    dirs = set()
+    for prefix in prefixes:
+        for plat_specific in (False,True):
+            for standard_lib in (False,True):
+                dirs.add(sysconfig.get_python_lib(plat_specific,standard_lib,
+                                                  prefix))
+    #  The site module in older virtualenvs doesn't have these functions.
+    #  On some platforms getsitepackages() includes the prefix itself.
+    if hasattr(site,"getsitepackages"):
+        dirs.update(site.getsitepackages())
+    if hasattr(site,"getusersitepackages"):
+        dirs.add(site.getusersitepackages())
+    prefixes = set(_normalize_dir(prefix) for prefix in prefixes)
+    return [dirnm for dirnm in set(_normalize_dir(dirnm) for dirnm in dirs)
+                  if dirnm not in prefixes]
+
+
+def plan_watches(live_dirs,include=(),exclude=(),max_watches=None):
+    """Plan which directories to watch for changes, within a watch budget.
+
+    This takes the live code directories, drops any that lie within the
+    interpreter's own directories or match one of the exclude patterns,
+    and adds the explicitly included directories.  Excluded directories
+    nested inside a watched directory are skipped too, by watching the
+    directories around them non-recursively.
+
+    Exclude patterns are shell-style patterns matched against the full path
+    of each directory.  Native observers generally need one watch for every
+    directory, so if max_watches is given then directories are added, with
+    explicit includes first and then smallest first, until the budget is
+    used up.
+
+    This returns a tuple (watches,num_watches,skipped) where watches is a
+    list of (dirname,recursive) pairs to schedule, num_watches is the total
+    number of directories they cover, and skipped is a list of directories
+    that did not fit within the budget.
+    """
+    exclude = list(exclude) + get_interpreter_dirs()
+    include = [_normalize_dir(dirnm) for dirnm in include]
+    roots = list(include)
+    for dirnm in live_dirs:
+        dirnm = _normalize_dir(dirnm)
+        if not _is_excluded(dirnm,exclude,ancestors=True):
+            roots.append(dirnm)
+    #  Drop any roots that are nested within another root.
+    roots = [dirnm for (i,dirnm) in enumerate(roots)
+                   if dirnm not in roots[:i]]
+    roots = [dirnm for dirnm in roots
+                   if not any(dirnm != dirnm2 and dirnm.startswith(dirnm2)
+                              for dirnm2 in roots)]
+    #  Expand each root into the directories to schedule, then fit them
+    #  into the budget.  Counting stops early if a root won't fit anyway.
+    expanded = []
+    for dirnm in roots:
+        try:
+            (watches,count) = _expand_watches(dirnm,exclude,[max_watches])
+        except _OverBudget:
+            expanded.append((dirnm not in include,None,dirnm,[]))
+        else:
+            expanded.append((dirnm not in include,count,dirnm,watches))
+    expanded.sort(key=lambda item: (item[0],item[1] is None,item[1]))
+    all_watches = []
+    num_watches = 0
+    skipped = []
+    for (_,count,dirnm,watches) in expanded:
+        if count is None:
+            skipped.append(dirnm)
+        elif max_watches is not None and num_watches+count > max_watches:
+            skipped.append(dirnm)
+        else:
+            all_watches.extend(watches)
+            num_watches += count
+    return (all_watches,num_watches,skipped)
+
+
+class _OverBudget(Exception):
+    pass
+
+
+def _expand_watches(dirnm,exclude,budget):
+    """Expand a directory into (dirname,recursive) pairs to be watched.
+
+    The budget is a single-item list holding the number of directories still
+    allowed, or None for no limit; _OverBudget is raised if it runs out.
+    """
+    if budget[0] is not None:
+        budget[0] -= 1
+        if budget[0] < 0:
+            raise _OverBudget(dirnm)
+    try:
+        names = sorted(os.listdir(dirnm))
+    except EnvironmentError:
+        names = []
+    pruned = False
+    children = []
+    for name in names:
+        child = os.path.join(dirnm,name)
+        if not os.path.isdir(child) or os.path.islink(child):
+            continue
+        child = child + os.sep
+        if _is_excluded(child,exclude):
+            pruned = True
+        else:
+            children.append(_expand_watches(child,exclude,budget))
+    count = 1 + sum(child_count for (_,child_count) in children)
+    if not pruned:
+        for (child_watches,_) in children:
+            if len(child_watches) != 1 or not child_watches[0][1]:
+                break
+        else:
+            return ([(dirnm,True)],count)
+    watches = [(dirnm,False)]
+    for (child_watches,_) in children:
+        watches.extend(child_watches)
+    return (watches,count)
+
+
+def _is_excluded(dirnm,exclude,ancestors=False):
+    """Check whether a directory matches any of the exclude patterns.
+
+    If ancestors is true then a directory inside an excluded directory is
+    also considered to be excluded.
+    """
+    candidates = [dirnm]
+    if ancestors:
+        parent = os.path.dirname(dirnm.rstrip(os.sep))
+        while parent and parent not in candidates:
+            candidates.append(parent)
+            parent = os.path.dirname(parent)
+    for candidate in candidates:
+        candidate = candidate.rstrip(os.sep) or os.sep
+        for pattern in exclude:
+            if fnmatch.fnmatch(candidate,pattern.rstrip(os.sep) or os.sep):
+                return True
+    return False
+
+
+def _normalize_dir(dirnm):
+    """Normalize a directory name for comparison purposes."""
+    dirnm = os.path.realpath(os.path.abspath(dirnm))
+    if not dirnm.endswith(os.sep):
+        dirnm += os.sep
+    return dirnm
@@ -0,0 +1,239 @@
+"""
+
+djsupervisor.benchmarks:  benchmarks for the djsupervisor config pipeline
+-------------------------------------------------------------------------
+
+This module times the various stages of producing the merged supervisord
+config, against synthetic projects with increasing numbers of programs.
+Run it like so::
+
+    python -m djsupervisor.benchmarks --sizes=10,100,1000 --output=bench.json
+
+The results are written out as JSON, so they can be compared across releases
+to catch any regressions.  If DJANGO_SETTINGS_MODULE is not set then it will
+configure some minimal settings of its own.
+
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+DEFAULT_SIZES = [10,100,1000,5000]
+
+#  The template for each generated program section.  This deliberately
+#  uses a good mix of tags, filters and lookups into settings and environ.
+PROGRAM_TEMPLATE = """
+[program:%(name)s]
+{%% if settings.DEBUG %%}
+command={{ PYTHON }} {{ PROJECT_DIR }}/manage.py %(name)s --debug
+{%% else %%}
+command={{ PYTHON }} {{ PROJECT_DIR }}/manage.py %(name)s
+{%% endif %%}
+directory={{ PROJECT_DIR|default:"/tmp" }}
+environment=HOME="{{ environ.HOME|default:"/" }}",NAME="{{ "%(name)s"|upper }}"
+{%% for opt in "abc" %%}
+; option {{ forloop.counter }} is {{ opt|upper }}
+{%% endfor %%}
+priority={{ %(index)d|add:100 }}
+%(templated)s
+"""
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m djsupervisor.benchmarks",
+        description="benchmark the djsupervisor config pipeline",
+    )
+    parser.add_argument(
+        "--sizes",
+        default=",".join(str(size) for size in DEFAULT_SIZES),
+        help="comma-separated numbers of programs to benchmark with"
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="number of times to repeat each timing"
+    )
+    parser.add_argument(
+        "--output",
+        help="write the JSON results to this file, rather than stdout"
+    )
+    args = parser.parse_args(argv)
+    setup_django()
+    results = {
+        "djsupervisor": get_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "results": [],
+    }
+    for size in args.sizes.split(","):
+        size = int(size)
+        print>>sys.stderr, "benchmarking with %d programs..." % (size,)
+        results["results"].extend(run_benchmarks(size,args.repeat))
+    data = json.dumps(results,indent=2,sort_keys=True)
+    if args.output:
+        with open(args.output,"w") as f:
+            f.write(data)
+    else:
+        print data
+    return 0
+
+
+def setup_django():
+    """Make sure Django is configured, using minimal settings if need be."""
+    from django.conf import settings
+    if not os.environ.get("DJANGO_SETTINGS_MODULE"):
+        settings.configure(
+            DEBUG=True,
+            SECRET_KEY="djsupervisor-benchmarks",
+            INSTALLED_APPS=["djsupervisor"],
+            TEMPLATES=[{
+                "BACKEND": "django.template.backends.django.DjangoTemplates",
+            }],
+        )
+    import django
+    django.setup()
+
+
+def get_version():
+    import djsupervisor
+    return djsupervisor.__version__
+
+
+def run_benchmarks(size,repeat):
+    """Run all the benchmarks against a project with the given size."""
+    from djsupervisor import config
+    from djsupervisor.management.commands.supervisor import Command
+    project_dir = make_project(size)
+    try:
+        config_file = os.path.join(project_dir,"supervisord.conf")
+        with open(config_file,"r") as f:
+            config_data = f.read()
+        options = {
+            "project_dir": project_dir,
+            "launch": ["prog%d" % (i,) for i in xrange(0,size,2)],
+            "nolaunch": ["prog%d" % (i,) for i in xrange(1,size,2)],
+            "exclude": ["prog%d" % (i,) for i in xrange(0,size,10)],
+            "autoreload": ["prog%d" % (i,) for i in xrange(0,size,3)],
+        }
+        ctx = {
+            "PROJECT_DIR": project_dir,
+            "PYTHON": sys.executable,
+            "SUPERVISOR_OPTIONS": config.rerender_options(options),
+            "settings": config.settings,
+            "environ": os.environ,
+        }
+        merged = config.get_merged_config(**options)
+
+        def render_cold():
+            config._template_cache.clear()
+            config.render_config(config_data,ctx)
+
+        def render_warm():
+            config.render_config(config_data,ctx)
+
+        def options_config():
+            config.get_config_from_options(**options)
+
+        def merge_cold():
+            config._template_cache.clear()
+            config.get_merged_config(refresh_config=True,**options)
+
+        def merge_warm():
+            config.get_merged_config(**options)
+
+        def autoreload_programs():
+            Command()._get_autoreload_programs(StringIO(merged))
+
+        benchmarks = [
+            ("render_config.cold",render_cold),
+            ("render_config.warm",render_warm),
+            ("get_config_from_options",options_config),
+            ("get_merged_config.cold",merge_cold),
+            ("get_merged_config.warm",merge_warm),
+            ("_get_autoreload_programs",autoreload_programs),
+        ]
+        results = []
+        for (name,func) in benchmarks:
+            timings = time_func(func,repeat)
+            results.append({
+                "benchmark": name,
+                "programs": size,
+                "repeat": repeat,
+                "min": min(timings),
+                "max": max(timings),
+                "mean": sum(timings) / len(timings),
+                "median": sorted(timings)[len(timings) // 2],
+            })
+        return results
+    finally:
+        shutil.rmtree(project_dir)
+
+
+def time_func(func,repeat):
+    """Time repeated calls to the given function, returning a list."""
+    timings = []
+    for _ in xrange(repeat):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return timings
+
+
+def make_project(size):
+    """Generate a synthetic project with the given number of programs.
+
+    Half of the programs are defined in the main supervisord.conf file, and
+    the rest are spread over files in the conf.d directory.  One in every ten
+    programs refers to a separate file via the "templated" filter.
+    """
+    project_dir = tempfile.mkdtemp(prefix="djsupervisor-bench-")
+    open(os.path.join(project_dir,"manage.py"),"w").close()
+    os.mkdir(os.path.join(project_dir,"conf.d"))
+    os.mkdir(os.path.join(project_dir,"templated"))
+    sections = ["""
+[program:__defaults__]
+startsecs=5
+[program:prog1*:__defaults__]
+stopwaitsecs=30
+[program:__overrides__]
+user=nobody
+"""]
+    for i in xrange(size):
+        name = "prog%d" % (i,)
+        templated = ""
+        if i % 10 == 0:
+            templated_file = os.path.join("templated","%s.conf" % (name,))
+            with open(os.path.join(project_dir,templated_file),"w") as f:
+                f.write("name={{ PROJECT_DIR }}/%s\n" % (name,))
+            templated = "; config {{ \"%s\"|templated }}" % (templated_file,)
+        sections.append(PROGRAM_TEMPLATE % {
+            "name": name,
+            "index": i,
+            "templated": templated,
+        })
+    half = (len(sections) + 1) // 2
+    with open(os.path.join(project_dir,"supervisord.conf"),"w") as f:
+        f.write("".join(sections[:half]))
+    per_file = 50
+    for i in xrange(half,len(sections),per_file):
+        filename = os.path.join("conf.d","%06d.conf" % (i,))
+        with open(os.path.join(project_dir,filename),"w") as f:
+            f.write("".join(sections[i:i+per_file]))
+    return project_dir
+
+
+if __name__ == "__main__":
+    sys.exit(main())
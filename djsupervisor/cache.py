@@ -0,0 +1,110 @@
+"""
+
+djsupervisor.cache:  on-disk caching helpers for djsupervisor
+-------------------------------------------------------------
+
+Producing the merged supervisord config means rendering several templates and
+parsing the results, which is wasted effort when nothing has changed since the
+last time we did it.  The functions in this module let us store such results
+on disk, keyed by a fingerprint of the inputs that went into producing them
+and along with the signatures of any files that were read along the way.
+
+This module deliberately avoids importing anything from Django, so that it
+can be used by lightweight entry-points that don't want to pay for setup.
+
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+
+
+def fingerprint(*parts):
+    """Get a stable hex digest fingerprinting the given parts.
+
+    The parts can be any combination of JSON-serializable values; anything
+    that's not serializable is included via its repr().
+    """
+    data = json.dumps(parts,sort_keys=True,default=repr)
+    return hashlib.sha1(data.encode("ascii")).hexdigest()
+
+
+def file_signature(path):
+    """Get a signature of the current contents of the given file.
+
+    The signature is a list of [mtime, size, content digest], or None if
+    the file could not be read.
+    """
+    try:
+        st = os.stat(path)
+        with open(path,"rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+    except EnvironmentError:
+        return None
+    return [st.st_mtime,st.st_size,digest]
+
+
+def read_cache(path,key):
+    """Read the data cached at the given path, if it's still fresh.
+
+    This returns None if the cache file is missing or unreadable, if it was
+    stored under a different key, or if any of the files it depends on have
+    changed since it was written.
+    """
+    try:
+        with open(path,"rb") as f:
+            entry = json.loads(f.read().decode("utf8"))
+    except (EnvironmentError,ValueError):
+        return None
+    if entry.get("key") != key:
+        return None
+    for (filepath,signature) in entry.get("files",{}).iteritems():
+        if file_signature(filepath) != signature:
+            return None
+    return entry.get("data")
+
+
+def write_cache(path,key,files,data):
+    """Write data to the cache at the given path.
+
+    The list of files is the set of files on which the data depends; their
+    signatures are recorded so that read_cache() can check for changes.
+    Failure to write the cache is not an error, it just means we'll have to
+    do the work again next time.
+    """
+    entry = {
+        "key": key,
+        "files": dict((fp,file_signature(fp)) for fp in files),
+        "data": data,
+    }
+    try:
+        atomic_write(path,json.dumps(entry).encode("utf8"))
+    except EnvironmentError:
+        pass
+
+
+def atomic_write(path,data,mode=None):
+    """Atomically replace the contents of the given file.
+
+    The data is written to a temporary file in the same directory and then
+    renamed into place, so readers will never see a partially-written file.
+    The file is created private to the current user unless a mode is given.
+    """
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    (fd,tmppath) = tempfile.mkstemp(dir=dirname or None,
+                                    prefix="." + os.path.basename(path))
+    try:
+        with os.fdopen(fd,"wb") as f:
+            f.write(data)
+        if mode is not None:
+            os.chmod(tmppath,mode)
+        os.rename(tmppath,path)
+    except:
+        try:
+            os.unlink(tmppath)
+        except EnvironmentError:
+            pass
+        raise
@@ -0,0 +1,392 @@
+"""
+
+djsupervisor.client:  python client for controlling a running supervisord
+-------------------------------------------------------------------------
+
+This module provides a SupervisorClient class for talking to supervisord over
+its XML-RPC interface, without having to go through supervisorctl.  It keeps
+a small pool of persistent connections, and batches up operations on many
+processes into a single round-trip using system.multicall::
+
+    from djsupervisor.client import get_client
+
+    client = get_client()
+    failures = client.restart(["webserver", "celeryd"])
+
+Process names can be given as "group:name", as "group:*" to refer to every
+process in a group, or as a plain program name to refer to all processes
+for that program.
+
+"""
+
+import os
+import math
+import time
+import socket
+import httplib
+import fnmatch
+import threading
+import xmlrpclib
+from contextlib import contextmanager
+from ConfigParser import RawConfigParser, NoSectionError, NoOptionError
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from supervisor.xmlrpc import SupervisorTransport, Faults
+from supervisor.states import ProcessStates, STOPPED_STATES
+
+
+def get_client(**options):
+    """Get a client for the supervisord belonging to the current project.
+
+    The connection details are taken from the merged config, so this must
+    be called with Django set up.  Any options are as for get_merged_config.
+    """
+    from djsupervisor.config import get_merged_config
+    return SupervisorClient.from_config(get_merged_config(**options))
+
+
+class SupervisorClient(object):
+    """Client for the XML-RPC interface of a running supervisord.
+
+    Instances of this class are safe to share between threads.  Each thread
+    gets a connection from the pool while making a call, and returns it for
+    re-use by later calls.
+    """
+
+    def __init__(self,serverurl,username=None,password=None,
+                      pool_size=4,batch_size=200):
+        self.serverurl = serverurl
+        self.username = username
+        self.password = password
+        self.pool_size = pool_size
+        self.batch_size = batch_size
+        self._pool = []
+        self._pool_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls,data,**kwds):
+        """Create a client from the [supervisorctl] section of a config."""
+        cfg = RawConfigParser()
+        cfg.readfp(StringIO(data))
+        def get(option):
+            try:
+                return cfg.get("supervisorctl",option)
+            except (NoSectionError,NoOptionError):
+                return None
+        serverurl = get("serverurl")
+        if serverurl is None:
+            raise ValueError("config has no supervisorctl serverurl")
+        return cls(serverurl,get("username"),get("password"),**kwds)
+
+    @classmethod
+    def from_environ(cls,environ=None,**kwds):
+        """Create a client from the environment of a supervised process.
+
+        supervisord sets SUPERVISOR_SERVER_URL in the environment of all
+        its child processes; the username and password can be provided in
+        SUPERVISOR_USERNAME and SUPERVISOR_PASSWORD respectively.
+        """
+        if environ is None:
+            environ = os.environ
+        return cls(environ["SUPERVISOR_SERVER_URL"],
+                   environ.get("SUPERVISOR_USERNAME"),
+                   environ.get("SUPERVISOR_PASSWORD"),
+                   **kwds)
+
+    @contextmanager
+    def connection(self):
+        """Context manager to borrow a connection from the pool.
+
+        This yields an xmlrpclib.ServerProxy object.  If there is an error
+        talking to the server then the connection is thrown away rather than
+        being returned to the pool.
+        """
+        with self._pool_lock:
+            if self._pool:
+                (proxy,transport) = self._pool.pop()
+            else:
+                (proxy,transport) = (None,None)
+        if proxy is None:
+            transport = SupervisorTransport(self.username,self.password,
+                                            self.serverurl)
+            #  The URL is ignored, the transport uses serverurl instead.
+            proxy = xmlrpclib.ServerProxy("http://127.0.0.1",transport)
+        try:
+            yield proxy
+        except (socket.error,httplib.HTTPException,xmlrpclib.ProtocolError):
+            transport.close()
+            raise
+        with self._pool_lock:
+            if len(self._pool) < self.pool_size:
+                self._pool.append((proxy,transport))
+                transport = None
+        if transport is not None:
+            transport.close()
+
+    def close(self):
+        """Close all pooled connections."""
+        with self._pool_lock:
+            pool = self._pool
+            self._pool = []
+        for (_,transport) in pool:
+            transport.close()
+
+    def call(self,method,*params):
+        """Call a single XML-RPC method, e.g. "supervisor.getState"."""
+        with self.connection() as proxy:
+            return getattr(proxy,method)(*params)
+
+    def multicall(self,calls):
+        """Make many XML-RPC calls using as few round-trips as possible.
+
+        The calls are given as a list of (method,params) pairs, and sent to
+        the server in batches of at most batch_size calls.  This returns a
+        list of results in the corresponding order.  Any faults are returned
+        as xmlrpclib.Fault instances rather than being raised.
+        """
+        results = []
+        calls = list(calls)
+        for i in xrange(0,len(calls),self.batch_size):
+            batch = [{"methodName": method, "params": list(params)}
+                     for (method,params) in calls[i:i+self.batch_size]]
+            with self.connection() as proxy:
+                batch_results = proxy.system.multicall(batch)
+            for result in batch_results:
+                if isinstance(result,dict) and "faultCode" in result:
+                    result = xmlrpclib.Fault(result["faultCode"],
+                                             result["faultString"])
+                results.append(result)
+        return results
+
+    def get_all_process_info(self):
+        """Get the info dicts for all processes managed by supervisord."""
+        return self.call("supervisor.getAllProcessInfo")
+
+    def get_process_names(self,names,infos=None):
+        """Expand the given names into a list of "group:name" process names.
+
+        See expand_process_names() for details.  The process info is fetched
+        from the server if not provided.
+        """
+        if infos is None:
+            infos = self.get_all_process_info()
+        return expand_process_names(names,infos)
+
+    def start(self,names,wait=True,timeout=None):
+        """Start the named processes.
+
+        All the processes are started in a single batch.  If wait is true
+        then this waits until they have either entered the RUNNING state
+        or failed to start, for at most timeout seconds.
+
+        This returns a list of (name,description) pairs for any processes
+        that failed to start.
+        """
+        names = self.get_process_names(names)
+        calls = [("supervisor.startProcess",(name,False)) for name in names]
+        results = self.multicall(calls)
+        failures = _get_failures(names,results,Faults.ALREADY_STARTED)
+        if wait:
+            failed = set(name for (name,_) in failures)
+            pending = [name for name in names if name not in failed]
+            infos = self.wait_for(pending,_is_started,timeout)
+            for name in pending:
+                info = infos.get(name)
+                if info is None or info["state"] != ProcessStates.RUNNING:
+                    failures.append((name,_describe(info)))
+        return failures
+
+    def stop(self,names,wait=True,timeout=None):
+        """Stop the named processes.
+
+        All the processes are stopped in a single batch.  If wait is true
+        then this waits until they have actually stopped, for at most
+        timeout seconds.
+
+        This returns a list of (name,description) pairs for any processes
+        that failed to stop.
+        """
+        names = self.get_process_names(names)
+        calls = [("supervisor.stopProcess",(name,False)) for name in names]
+        results = self.multicall(calls)
+        failures = _get_failures(names,results,Faults.NOT_RUNNING)
+        if wait:
+            failed = set(name for (name,_) in failures)
+            pending = [name for name in names if name not in failed]
+            infos = self.wait_for(pending,_is_stopped,timeout)
+            for name in pending:
+                info = infos.get(name)
+                if info is None or not _is_stopped(info):
+                    failures.append((name,_describe(info)))
+        return failures
+
+    def restart(self,names,wait=True,timeout=None):
+        """Restart the named processes.
+
+        This stops all the processes in a single batch, then starts them
+        all again in another batch.  The return value is as for start().
+        """
+        names = self.get_process_names(names)
+        failures = self.stop(names,wait=True,timeout=timeout)
+        failed = set(name for (name,_) in failures)
+        names = [name for name in names if name not in failed]
+        return failures + self.start(names,wait=wait,timeout=timeout)
+
+    def rolling_restart(self,names,batch_size=1,settle=0,timeout=None,
+                             progress=None):
+        """Restart the named processes a few at a time.
+
+        The processes are restarted in batches of batch_size, which can be
+        either a number of processes or a percentage string like "25%".
+        Each batch must reach the RUNNING state and then stay up for settle
+        seconds before the next batch is restarted.  If progress is given,
+        it is called with the list of names in each batch before it starts.
+
+        If any process fails to come back up then the remaining batches are
+        not restarted, and this returns a list of (name,description) pairs
+        for the failed processes.
+        """
+        names = self.get_process_names(names)
+        batch_size = get_batch_size(batch_size,len(names))
+        for i in xrange(0,len(names),batch_size):
+            batch = names[i:i+batch_size]
+            if progress is not None:
+                progress(batch)
+            failures = self.restart(batch,wait=True,timeout=timeout)
+            if not failures and settle:
+                failures = self.check_settled(batch,settle)
+            if failures:
+                return failures
+        return []
+
+    def check_settled(self,names,settle):
+        """Check that the named processes stay up for settle seconds.
+
+        This returns a list of (name,description) pairs for any processes
+        that stop running, or that are restarted by supervisord, during that
+        time.  It returns as soon as any such failure is seen.
+        """
+        deadline = time.time() + settle
+        pids = None
+        while True:
+            infos = {}
+            for info in self.get_all_process_info():
+                infos["%s:%s" % (info["group"],info["name"])] = info
+            if pids is None:
+                pids = dict((name,infos[name]["pid"])
+                            for name in names if name in infos)
+            failures = []
+            for name in names:
+                info = infos.get(name)
+                if info is None or info["state"] != ProcessStates.RUNNING:
+                    failures.append((name,_describe(info)))
+                elif info["pid"] != pids.get(name):
+                    failures.append((name,"restarted while settling"))
+            if failures:
+                return failures
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return []
+            time.sleep(min(remaining,0.5))
+
+    def wait_for(self,names,predicate,timeout=None):
+        """Wait until the given predicate is true for all named processes.
+
+        The predicate is called with the info dict of each process.  This
+        polls the server at increasing intervals until the predicate is
+        satisfied or the timeout expires, and returns a dict mapping each
+        name to its most recent info.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        delay = 0.05
+        while True:
+            infos = {}
+            for info in self.get_all_process_info():
+                infos["%s:%s" % (info["group"],info["name"])] = info
+            done = True
+            for name in names:
+                info = infos.get(name)
+                if info is not None and not predicate(info):
+                    done = False
+                    break
+            if done:
+                return infos
+            if timeout is not None and time.time() + delay > deadline:
+                return infos
+            time.sleep(delay)
+            delay = min(delay * 2,1)
+
+
+def expand_process_names(names,infos):
+    """Expand the given names into a list of "group:name" process names.
+
+    Each name can be a full "group:name" process name, a "group:*" name for
+    all processes in a group, or a plain program name.  Shell-style wildcards
+    are also accepted.  Names that don't match any process are passed through
+    unchanged, so that the server can report them as errors.
+    """
+    expanded = []
+    seen = set()
+    for name in names:
+        if ":" in name:
+            (group,process) = name.split(":",1)
+        else:
+            (group,process) = (name,"*")
+        matched = False
+        for info in infos:
+            if fnmatch.fnmatchcase(info["group"],group):
+                if fnmatch.fnmatchcase(info["name"],process):
+                    matched = True
+                    fullname = "%s:%s" % (info["group"],info["name"])
+                    if fullname not in seen:
+                        seen.add(fullname)
+                        expanded.append(fullname)
+        if not matched and name not in seen:
+            seen.add(name)
+            expanded.append(name)
+    return expanded
+
+
+def get_batch_size(batch_size,total):
+    """Get the number of processes in each batch of a rolling restart.
+
+    The batch_size can be a number of processes, or a string giving either
+    a number or a percentage of the total, like "25%".  This always returns
+    at least one.
+    """
+    if isinstance(batch_size,basestring):
+        batch_size = batch_size.strip()
+        if batch_size.endswith("%"):
+            percent = float(batch_size[:-1])
+            batch_size = int(math.ceil(total * percent / 100))
+    return max(int(batch_size),1)
+
+
+def _get_failures(names,results,ignore_code):
+    """Get (name,description) pairs for any faults in a multicall result."""
+    failures = []
+    for (name,result) in zip(names,results):
+        if isinstance(result,xmlrpclib.Fault):
+            if result.faultCode != ignore_code:
+                failures.append((name,result.faultString))
+    return failures
+
+
+def _is_started(info):
+    return info["state"] not in (ProcessStates.STARTING,ProcessStates.BACKOFF)
+
+
+def _is_stopped(info):
+    return info["state"] in STOPPED_STATES
+
+
+def _describe(info):
+    if info is None:
+        return "no such process"
+    if info.get("spawnerr"):
+        return "%s: %s" % (info["statename"],info["spawnerr"])
+    return info["statename"]
@@ -12,22 +12,72 @@ and producing a final config file to control supervisord/supervisorctl.
 
 import sys
 import os
+import re
+import glob
+import platform
+import fnmatch
 import hashlib
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
-
-from ConfigParser import RawConfigParser, NoSectionError, NoOptionError
+from ConfigParser import RawConfigParser
+from ConfigParser import MissingSectionHeaderError, ParsingError
 
 from django import template
+from django.apps import apps
 from django.conf import settings
 from importlib import import_module
 
+import djsupervisor
+from djsupervisor import cache
+from djsupervisor.host import HostFacts
+from djsupervisor.zygote import get_spawn_command
 from djsupervisor.templatetags import djsupervisor_tags
 
 CONFIG_FILE = getattr(settings, "SUPERVISOR_CONFIG_FILE", "supervisord.conf")
+CONFIG_CACHE = getattr(settings, "SUPERVISOR_CONFIG_CACHE", True)
+CONFIG_CACHE_DIR = getattr(settings, "SUPERVISOR_CONFIG_CACHE_DIR", None)
+CONFIG_INCLUDE = getattr(settings, "SUPERVISOR_CONFIG_INCLUDE", "conf.d/*.conf")
+RENDER_THREADS = getattr(settings, "SUPERVISOR_RENDER_THREADS", 4)
+TEMPLATE_CACHE_SIZE = getattr(settings, "SUPERVISOR_TEMPLATE_CACHE_SIZE", 64)
+
+SECTION_RE = RawConfigParser.SECTCRE
+OPTION_RE = RawConfigParser.OPTCRE
+BOOLEAN_STATES = {"1": True, "yes": True, "true": True, "on": True,
+                  "0": False, "no": False, "false": False, "off": False}
+
+#  Built-in processes that are only included in the config if some program
+#  has one of the given options.  Their names are prefixed so that they can't
+#  clash with the project's own programs.
+BUILTIN_PROCESS_OPTIONS = [
+    ("eventlistener:djsupervisor_memwatch",("max_rss",)),
+    ("program:djsupervisor_healthcheck",("healthcheck_http",
+                                         "healthcheck_tcp",
+                                         "healthcheck_cmd")),
+    ("program:djsupervisor_startup",("depends_on",)),
+    ("program:djsupervisor_zygote",("zygote",)),
+]
+
+#  Options given to event listeners that are run by "supervisor listen",
+#  unless they set them themselves.  Other event listeners don't get them.
+LISTEN_OPTIONS = [
+    ("buffer_size","1024"),
+    ("autoreload","true"),
+]
+
+#  Section prefixes for programs, including those converted into
+#  [fcgi-program:x] sections by a listen option.
+PROGRAM_SECTIONS = ("program:","fcgi-program:")
+
+#  The listening socket of a program with a listen option is passed to each
+#  of its processes as this file descriptor, i.e. as stdin.
+SOCKET_FD = 0
+
+#  Compiled templates, keyed by a hash of their source.
+#  This is kept in least-recently-used order for eviction.
+_template_cache = OrderedDict()
+_template_cache_lock = threading.Lock()
 
 
 def get_merged_config(**options):
@@ -37,7 +87,11 @@ def get_merged_config(**options):
     the config file from the main project with default settings and those
     specified in the command-line, processes various special section names,
     and returns the resulting configuration as a string.
+
+    The result is cached on disk, keyed by a fingerprint of the inputs that
+    went into it.  Pass refresh_config=True to ignore any cached copy.
     """
+    refresh = options.pop("refresh_config",False)
     #  Find and load the containing project module.
     #  This can be specified explicity using the --project-dir option.
     #  Otherwise, we attempt to guess by looking for the manage.py file.
@@ -57,85 +111,509 @@ def get_merged_config(**options):
         "SUPERVISOR_OPTIONS": rerender_options(options),
         "settings": settings,
         "environ": os.environ,
+        "HOST": HostFacts(),
+        "SOCKET_FD": SOCKET_FD,
     }
-    #  Initialise the ConfigParser.
-    #  Fortunately for us, ConfigParser has merge-multiple-config-files
-    #  functionality built into it.  You just read each file in turn, and
-    #  values from later files overwrite values from former.
-    cfg = RawConfigParser()
-    #  Start from the default configuration options.
-    data = render_config(DEFAULT_CONFIG,ctx)
-    cfg.readfp(StringIO(data))
-    #  Add in the project-specific config file.
-    with open(config_file,"r") as f:
-        data = render_config(f.read(),ctx)
-    cfg.readfp(StringIO(data))
-    #  Add in the options specified on the command-line.
-    cfg.readfp(StringIO(get_config_from_options(**options)))
-    #  Add options from [program:__defaults__] to each program section
-    #  if it happens to be missing that option.
-    PROG_DEFAULTS = "program:__defaults__"
-    if cfg.has_section(PROG_DEFAULTS):
-        for option in cfg.options(PROG_DEFAULTS):
-            default = cfg.get(PROG_DEFAULTS,option)
-            for section in cfg.sections():
-                if section.startswith("program:"):
-                    if not cfg.has_option(section,option):
-                        cfg.set(section,option,default)
-        cfg.remove_section(PROG_DEFAULTS)
-    #  Add options from [program:__overrides__] to each program section
-    #  regardless of whether they already have that option.
-    PROG_OVERRIDES = "program:__overrides__"
-    if cfg.has_section(PROG_OVERRIDES):
-        for option in cfg.options(PROG_OVERRIDES):
-            override = cfg.get(PROG_OVERRIDES,option)
-            for section in cfg.sections():
-                if section.startswith("program:"):
-                    cfg.set(section,option,override)
-        cfg.remove_section(PROG_OVERRIDES)
+    #  Find all the config fragments to be merged together.
+    fragments = find_config_fragments(project_dir,config_file)
+    if not CONFIG_CACHE:
+        rendered = render_fragments(ctx,fragments)
+        data = merge_config([data for (data,_) in rendered],options)
+        write_control_cache(project_dir,get_rendered_files(rendered),data)
+        return data
+    #  Re-use the cached config if none of its inputs have changed.
+    #  Any files read while rendering are recorded by the "templated"
+    #  filter so that the cache can be checked against them too.
+    cache_file = get_cache_file(project_dir,"merged-config.json")
+    base_key = get_config_fingerprint(ctx)
+    key = cache.fingerprint(base_key,fragments)
+    #  The connection details for djsupervisor.ctl are written along with
+    #  it, so if they have gone stale then merge it again to refresh them.
+    if not refresh:
+        data = cache.read_cache(cache_file,key)
+        if data is not None and read_control_cache(project_dir) is not None:
+            return str(data)
+    #  Otherwise, merge it from the individual fragments.  These have their
+    #  own cache so that we only re-render the ones that have changed.
+    rendered = render_fragments(ctx,fragments,base_key,refresh)
+    files = get_rendered_files(rendered)
+    data = merge_config([data for (data,_) in rendered],options)
+    cache.write_cache(cache_file,key,files,data)
+    write_control_cache(project_dir,files,data)
+    return data
+
+
+def get_rendered_files(rendered):
+    """Get all the files that went into the given rendered fragments.
+
+    This includes the settings file, since the fragments can use settings.
+    """
+    files = []
+    settings_file = get_settings_file()
+    if settings_file is not None:
+        files.append(settings_file)
+    for (_,fragment_files) in rendered:
+        files.extend(fragment_files)
+    return files
+
+
+def read_control_cache(project_dir):
+    """Read the cached supervisorctl connection details, if still fresh."""
+    from djsupervisor.ctl import get_control_info
+    cache_dir = os.path.dirname(get_cache_file(project_dir,"control.json"))
+    return get_control_info(project_dir,cache_dir)
+
+
+def write_control_cache(project_dir,files,data):
+    """Cache the details needed to control supervisord via supervisorctl.
+
+    This lets the lightweight entry-point in djsupervisor.ctl talk to a
+    running supervisord without having to set up Django or merge the config,
+    for as long as the files that went into the config remain unchanged and
+    it's run with the same environment.  Since it can't check the list of
+    installed apps, it also records what was matched by
+    SUPERVISOR_CONFIG_INCLUDE.  This is written even when the merged config
+    itself isn't cached.
+    """
+    from djsupervisor.ctl import get_control_key
+    include = None
+    if CONFIG_INCLUDE:
+        pattern = os.path.join(project_dir,CONFIG_INCLUDE)
+        include = [pattern,sorted(glob.glob(pattern))]
+    info = dict(parse_config(data).get("supervisorctl",{}))
+    info["include"] = include
+    info["settings_module"] = os.environ.get("DJANGO_SETTINGS_MODULE")
+    cache_file = get_cache_file(project_dir,"control.json")
+    cache.write_cache(cache_file,get_control_key(project_dir),files,info)
+
+
+def find_config_fragments(project_dir,config_file):
+    """Find all the config files to be merged, in order of precedence.
+
+    This returns a list of (path,app_dir) pairs, starting with the config
+    files provided by installed apps, then the main project config file,
+    then any matching files from the project's include directory.  The
+    app_dir is None for files that don't belong to an app.
+    """
+    fragments = []
+    for app_config in apps.get_app_configs():
+        app_dir = os.path.abspath(app_config.path)
+        filepath = os.path.join(app_dir,"management",CONFIG_FILE)
+        if os.path.isfile(filepath):
+            fragments.append((filepath,app_dir))
+    fragments.append((os.path.abspath(config_file),None))
+    if CONFIG_INCLUDE:
+        pattern = os.path.join(project_dir,CONFIG_INCLUDE)
+        for filepath in sorted(glob.glob(pattern)):
+            fragments.append((os.path.abspath(filepath),None))
+    return fragments
+
+
+def render_fragments(ctx,fragments,key=None,refresh=False):
+    """Render the given config fragments, returning the data for each.
+
+    Fragments are rendered concurrently using a small pool of threads.  If
+    a cache key is given then each fragment is separately cached under
+    that key, so they only have to be re-rendered when they change.
+
+    This returns a list of (data,files) pairs, where the files are all
+    those that were read while rendering the corresponding fragment.
+    """
+    def render(fragment):
+        (filepath,app_dir) = fragment
+        return render_fragment(ctx,filepath,app_dir,key,refresh)
+    rendered = [(render_config(DEFAULT_CONFIG,ctx),[])]
+    if RENDER_THREADS > 1 and len(fragments) > 1:
+        pool = ThreadPool(min(RENDER_THREADS,len(fragments)))
+        try:
+            rendered.extend(pool.map(render,fragments))
+        finally:
+            #  Don't join() the pool; its worker threads exit on their own,
+            #  but waiting for them adds a fixed delay of a tenth of a second.
+            pool.close()
+    else:
+        rendered.extend(render(fragment) for fragment in fragments)
+    return rendered
+
+
+def render_fragment(ctx,filepath,app_dir=None,key=None,refresh=False):
+    """Render a single config fragment, using the cache if possible.
+
+    This returns a (data,files) pair as described in render_fragments().
+    """
+    if app_dir is not None:
+        ctx = dict(ctx,APP_DIR=app_dir)
+    if key is not None:
+        key = cache.fingerprint(key,filepath,app_dir)
+        cache_name = hashlib.sha1(filepath).hexdigest() + ".json"
+        cache_file = get_cache_file(ctx["PROJECT_DIR"],
+                                    os.path.join("fragments",cache_name))
+        if not refresh:
+            cached = cache.read_cache(cache_file,key)
+            if cached is not None:
+                return (str(cached["data"]),cached["files"])
+    files = [filepath]
+    djsupervisor_tags.current.files = files
+    try:
+        with open(filepath,"r") as f:
+            data = render_config(f.read(),ctx)
+    finally:
+        djsupervisor_tags.current.files = None
+    if key is not None:
+        cached = {"data": data, "files": files}
+        cache.write_cache(cache_file,key,files,cached)
+    return (data,files)
+
+
+def merge_config(fragments,options):
+    """Merge rendered config fragments and command-line options.
+
+    This does the actual work for get_merged_config(), without any caching.
+    """
+    #  Merge all the config data into a single ordered dict of sections.
+    #  Just like ConfigParser, values from later files overwrite those
+    #  from earlier ones.  The command-line options come last of all.
+    sections = OrderedDict()
+    for data in fragments + [get_config_from_options(**options)]:
+        for (name,items) in parse_config(data).iteritems():
+            try:
+                sections[name].update(items)
+            except KeyError:
+                sections[name] = items
+    #  Pull out the special [program:__defaults__] and [program:__overrides__]
+    #  sections, along with pattern-scoped variants such as
+    #  [program:celery_*:__defaults__], to be applied in a single pass below.
+    #  Pattern-scoped sections take precedence over the global ones, and
+    #  later sections take precedence over earlier ones.  The same goes for
+    #  [eventlistener:__defaults__] and friends, which are kept separate.
+    defaults = {"program": [], "eventlistener": []}
+    overrides = {"program": [], "eventlistener": []}
+    for name in list(sections):
+        (kind,_,rest) = name.partition(":")
+        if kind in defaults:
+            (pattern,_,special) = rest.rpartition(":")
+            if special not in ("__defaults__","__overrides__"):
+                continue
+            if not pattern:
+                matcher = None
+            else:
+                matcher = re.compile(fnmatch.translate(pattern)).match
+            if special == "__defaults__":
+                defaults[kind].insert(0,(matcher,sections.pop(name)))
+            else:
+                overrides[kind].append((matcher,sections.pop(name)))
+    for kind in defaults:
+        defaults[kind].sort(key=lambda item: item[0] is None)
+        overrides[kind].sort(key=lambda item: item[0] is not None)
     #  Make sure we've got a port configured for supervisorctl to
     #  talk to supervisord.  It's passworded based on secret key.
     #  If they have configured a unix socket then use that, otherwise
     #  use an inet server on localhost at fixed-but-randomish port.
     username = hashlib.md5(settings.SECRET_KEY).hexdigest()[:7]
     password = hashlib.md5(username).hexdigest()
-    if cfg.has_section("unix_http_server"):
-        set_if_missing(cfg,"unix_http_server","username",username)
-        set_if_missing(cfg,"unix_http_server","password",password)
-        serverurl = "unix://" + cfg.get("unix_http_server","file")
+    if "unix_http_server" in sections:
+        set_if_missing(sections,"unix_http_server","username",username)
+        set_if_missing(sections,"unix_http_server","password",password)
+        serverurl = "unix://" + sections["unix_http_server"]["file"]
     else:
         #  This picks a "random" port in the 9000 range to listen on.
         #  It's derived from the secret key, so it's stable for a given
         #  project but multiple projects are unlikely to collide.
         port = int(hashlib.md5(password).hexdigest()[:3],16) % 1000
         addr = "127.0.0.1:9%03d" % (port,)
-        set_if_missing(cfg,"inet_http_server","port",addr)
-        set_if_missing(cfg,"inet_http_server","username",username)
-        set_if_missing(cfg,"inet_http_server","password",password)
-        serverurl = "http://" + cfg.get("inet_http_server","port")
-    set_if_missing(cfg,"supervisorctl","serverurl",serverurl)
-    set_if_missing(cfg,"supervisorctl","username",username)
-    set_if_missing(cfg,"supervisorctl","password",password)
-    set_if_missing(cfg,"rpcinterface:supervisor",
-                       "supervisor.rpcinterface_factory",
-                       "supervisor.rpcinterface:make_main_rpcinterface")
-    #  Remove any [program:] sections with exclude=true
-    for section in cfg.sections():
-        try:
-            if cfg.getboolean(section,"exclude"):
-                cfg.remove_section(section)
-        except NoOptionError:
-            pass
-    #  Sanity-check to give better error messages.
-    for section in cfg.sections():
-        if section.startswith("program:"):
-            if not cfg.has_option(section,"command"):
+        set_if_missing(sections,"inet_http_server","port",addr)
+        set_if_missing(sections,"inet_http_server","username",username)
+        set_if_missing(sections,"inet_http_server","password",password)
+        serverurl = "http://" + sections["inet_http_server"]["port"]
+    set_if_missing(sections,"supervisorctl","serverurl",serverurl)
+    set_if_missing(sections,"supervisorctl","username",username)
+    set_if_missing(sections,"supervisorctl","password",password)
+    set_if_missing(sections,"rpcinterface:supervisor",
+                            "supervisor.rpcinterface_factory",
+                            "supervisor.rpcinterface:make_main_rpcinterface")
+    #  Now make a single pass over the sections to apply the defaults and
+    #  overrides, remove any sections with exclude=true, and sanity-check
+    #  the program sections to give better error messages.
+    inherited = sections.get("DEFAULT",{})
+    excluded = set()
+    for name in list(sections):
+        if name == "DEFAULT":
+            continue
+        section = sections[name]
+        (kind,_,progname) = name.partition(":")
+        if kind in defaults:
+            for (matcher,items) in defaults[kind]:
+                if matcher is None or matcher(progname):
+                    for (option,value) in items.iteritems():
+                        if option not in section and option not in inherited:
+                            section[option] = value
+            if kind == "eventlistener" and \
+               is_listen_command(section.get("command","")):
+                for (option,value) in LISTEN_OPTIONS:
+                    if option not in section and option not in inherited:
+                        section[option] = value
+            for (matcher,items) in overrides[kind]:
+                if matcher is None or matcher(progname):
+                    section.update(items)
+        exclude = section.get("exclude",inherited.get("exclude"))
+        if exclude is not None and get_boolean(exclude):
+            del sections[name]
+            excluded.add(name)
+        elif name.startswith("program:"):
+            if "command" not in section and "command" not in inherited:
                 msg = "Process name '%s' has no command configured"
-                raise ValueError(msg % (section.split(":",1)[-1]))
-    #  Write it out to a StringIO and return the data
-    s = StringIO()
-    cfg.write(s)
-    return s.getvalue()
+                raise ValueError(msg % (name.split(":",1)[-1]))
+    resolve_dependencies(sections,excluded)
+    #  Some built-in processes are only needed if a program uses them.
+    for (builtin,triggers) in BUILTIN_PROCESS_OPTIONS:
+        for (name,section) in sections.iteritems():
+            if name.startswith("program:") and name != builtin:
+                if any(option in section for option in triggers):
+                    break
+        else:
+            sections.pop(builtin,None)
+    if "program:djsupervisor_zygote" in sections:
+        use_zygote(sections,get_zygote_socket(options.get("project_dir")))
+    sections = bind_listen_sockets(sections)
+    return write_config(sections)
+
+
+def resolve_dependencies(sections,excluded=()):
+    """Check and prepare the depends_on options of program sections.
+
+    Programs with dependencies are started by the built-in startup program
+    once their dependencies are ready, so rather than having supervisord
+    start them itself, their autostart option is moved to deferred_autostart.
+    The same goes for programs that others depend on with a "log:" readiness
+    condition, so that the startup program can note where their logs end
+    before starting them, and not be fooled by output from a previous run.
+    Dependencies on excluded programs are dropped, and dependencies on
+    unknown programs or cycles of dependencies raise ValueError.
+    """
+    graph = {}
+    for (name,section) in sections.iteritems():
+        if name.startswith("program:") and "depends_on" in section:
+            deps = section["depends_on"].replace(","," ").split()
+            for dep in deps:
+                if "program:" + dep not in sections and \
+                   "program:" + dep not in excluded:
+                    msg = "Program '%s' depends on unknown program '%s'"
+                    raise ValueError(msg % (name.split(":",1)[1],dep))
+            deps = [dep for dep in deps if "program:" + dep in sections]
+            section["depends_on"] = " ".join(deps)
+            graph[name.split(":",1)[1]] = deps
+    for deps in graph.values():
+        for dep in deps:
+            section = sections["program:" + dep]
+            if section.get("ready_when","").strip().startswith("log:"):
+                section.setdefault("depends_on","")
+    for (name,section) in sections.iteritems():
+        if name.startswith("program:") and "depends_on" in section:
+            autostart = section.get("autostart","true")
+            section["deferred_autostart"] = autostart
+            section["autostart"] = "false"
+    #  Check for cycles with a depth-first search.
+    done = set()
+    def visit(progname,path):
+        if progname in path:
+            cycle = path[path.index(progname):] + [progname]
+            raise ValueError("Programs depend on each other: %s"
+                             % (" -> ".join(cycle),))
+        if progname not in done:
+            for dep in graph.get(progname,()):
+                visit(dep,path + [progname])
+            done.add(progname)
+    for progname in sorted(graph):
+        visit(progname,[])
+
+
+def use_zygote(sections,socket_path):
+    """Have programs with zygote=true forked from the built-in zygote.
+
+    Their commands must run manage.py, and are changed to run the spawn
+    script instead, which asks the zygote listening on the given socket to
+    fork a worker running the same command.
+    """
+    for (name,section) in sections.iteritems():
+        if not name.startswith("program:") or name == "program:djsupervisor_zygote":
+            continue
+        if not get_boolean(section.pop("zygote","false")):
+            continue
+        try:
+            section["command"] = get_spawn_command(section["command"],
+                                                   socket_path)
+        except ValueError:
+            msg = "Program '%s' uses the zygote but doesn't run manage.py"
+            raise ValueError(msg % (name.split(":",1)[1],))
+
+
+def bind_listen_sockets(sections):
+    """Convert programs with a listen option into [fcgi-program:x] sections.
+
+    supervisord binds the socket for an fcgi-program once, before starting
+    any of its processes, and passes it to each of them as SOCKET_FD.  So
+    all the processes of the group accept connections on the same socket,
+    and the kernel shares them out.  This returns a new ordered dict of
+    sections, in the same order as before.
+    """
+    result = OrderedDict()
+    for (name,section) in sections.iteritems():
+        if name.startswith("program:") and "listen" in section:
+            progname = name.split(":",1)[1]
+            if "socket" in section:
+                msg = "Program '%s' has both listen and socket configured"
+                raise ValueError(msg % (progname,))
+            section["socket"] = parse_listen_address(section.pop("listen"))
+            name = "fcgi-program:" + progname
+        result[name] = section
+    return result
+
+
+def parse_listen_address(value):
+    """Parse a listen option into a socket URL for supervisord.
+
+    This accepts "[<host>:]<port>" or a path for a unix socket, as well as
+    "tcp://<host>:<port>" and "unix://<path>" URLs.  The host defaults to
+    127.0.0.1, or use "*" to listen on all interfaces.
+    """
+    value = value.strip()
+    if value.startswith("unix://"):
+        return value
+    if value.startswith("/"):
+        return "unix://" + value
+    (host,_,port) = value.replace("tcp://","",1).rpartition(":")
+    if not port.isdigit():
+        raise ValueError("Invalid listen address: %s" % (value,))
+    if host == "*":
+        host = "0.0.0.0"
+    return "tcp://%s:%s" % (host or "127.0.0.1",port)
+
+
+def parse_config(data,filename="<string>"):
+    """Parse config data into an ordered dict of sections.
+
+    Each section is itself an ordered dict mapping option names to values.
+    This follows the same syntax rules as RawConfigParser, but produces
+    a plain data structure that can be cheaply merged and manipulated.
+    """
+    sections = OrderedDict()
+    section = None
+    option = None
+    error = None
+    for (lineno,line) in enumerate(data.split("\n"),1):
+        #  Skip comments and blank lines.
+        if line.strip() == "" or line[0] in "#;":
+            continue
+        if line.split(None,1)[0].lower() == "rem" and line[0] in "rR":
+            continue
+        #  Collect continuation lines for the current option.
+        if line[0].isspace() and section is not None and option:
+            value = line.strip()
+            if value:
+                section[option].append(value)
+            continue
+        #  Start a new section, or add an option to the current one.
+        mo = SECTION_RE.match(line)
+        if mo:
+            section = sections.setdefault(mo.group("header"),OrderedDict())
+            option = None
+        elif section is None:
+            raise MissingSectionHeaderError(filename,lineno,line)
+        else:
+            mo = OPTION_RE.match(line)
+            if mo:
+                (option,value) = mo.group("option","value")
+                option = option.rstrip().lower()
+                if ";" in value:
+                    pos = value.find(";")
+                    if value[pos-1].isspace():
+                        value = value[:pos]
+                value = value.strip()
+                if value == '""':
+                    value = ""
+                section[option] = [value]
+            else:
+                if error is None:
+                    error = ParsingError(filename)
+                error.append(lineno,repr(line))
+    if error is not None:
+        raise error
+    for section in sections.itervalues():
+        for (option,value) in section.iteritems():
+            section[option] = "\n".join(value)
+    return sections
+
+
+def write_config(sections):
+    """Write an ordered dict of sections out as config data.
+
+    The output is formatted exactly as RawConfigParser would write it.
+    """
+    data = []
+    names = list(sections)
+    if "DEFAULT" in sections:
+        names.remove("DEFAULT")
+        if sections["DEFAULT"]:
+            names.insert(0,"DEFAULT")
+    for name in names:
+        data.append("[%s]\n" % (name,))
+        for (option,value) in sections[name].iteritems():
+            data.append("%s = %s\n" % (option,value.replace("\n","\n\t")))
+        data.append("\n")
+    return "".join(data)
+
+
+def get_boolean(value):
+    """Interpret a config value as a boolean, like RawConfigParser does."""
+    try:
+        return BOOLEAN_STATES[value.lower()]
+    except KeyError:
+        raise ValueError("Not a boolean: %s" % (value,))
+
+
+def get_process_names(cfg,section):
+    """Get the "group:name" of each process of the given program section.
+
+    This expands the program's process_name for each of its numprocs, and
+    accounts for programs that have been put in a [group:x] section.
+    """
+    return [name for (name,_) in get_processes(cfg,section)]
+
+
+def get_processes(cfg,section):
+    """Get the processes of the given program section.
+
+    This returns a list of ("group:name",expansions) pairs, where the
+    expansions are those that supervisord makes available to the program's
+    options for that process, such as %(process_num)s.
+    """
+    program = section.split(":",1)[1]
+    group = program
+    for other in cfg.sections():
+        if other.startswith("group:") and cfg.has_option(other,"programs"):
+            members = [name.strip()
+                       for name in cfg.get(other,"programs").split(",")]
+            if program in members:
+                group = other.split(":",1)[1]
+    numprocs = 1
+    if cfg.has_option(section,"numprocs"):
+        numprocs = int(cfg.get(section,"numprocs"))
+    numprocs_start = 0
+    if cfg.has_option(section,"numprocs_start"):
+        numprocs_start = int(cfg.get(section,"numprocs_start"))
+    process_name = "%(program_name)s"
+    if cfg.has_option(section,"process_name"):
+        process_name = cfg.get(section,"process_name")
+    processes = []
+    for process_num in xrange(numprocs_start,numprocs_start + numprocs):
+        expansions = {"program_name": program, "group_name": program,
+                      "process_num": process_num,
+                      "host_node_name": platform.node()}
+        for (key,value) in os.environ.iteritems():
+            expansions["ENV_" + key] = value
+        name = "%s:%s" % (group,process_name % expansions)
+        processes.append((name,expansions))
+    return processes
 
 
 def render_config(data,ctx):
@@ -144,13 +622,37 @@ def render_config(data,ctx):
     This function takes a config data string and a dict of context variables,
     renders the data through Django's template system, and returns the result.
     """
-    djsupervisor_tags.current_context = ctx
-    data = "{% load djsupervisor_tags %}" + data
-    t = template.Template(data)
+    djsupervisor_tags.current.context = ctx
+    t = get_template(data)
     c = template.Context(ctx)
     return t.render(c).encode("ascii")
 
 
+def get_template(data):
+    """Get the compiled template for the given config data.
+
+    Compiling templates is a big part of the cost of rendering them, and the
+    same ones tend to be rendered over and over.  So we memoize them by the
+    hash of their source, keeping only the most recently used ones.
+    """
+    key = hashlib.sha1(data).hexdigest()
+    with _template_cache_lock:
+        try:
+            t = _template_cache.pop(key)
+        except KeyError:
+            t = None
+        else:
+            _template_cache[key] = t
+    if t is None:
+        t = template.Template("{% load djsupervisor_tags %}" + data)
+        with _template_cache_lock:
+            while _template_cache and \
+                  len(_template_cache) >= TEMPLATE_CACHE_SIZE:
+                _template_cache.popitem(last=False)
+            _template_cache[key] = t
+    return t
+
+
 def get_config_from_options(**options):
     """Get config file fragment reflecting command-line options."""
     data = []
@@ -177,10 +679,11 @@ def get_config_from_options(**options):
         data.append("[program:%s]\nexclude=true\n" % (progname,))
     #  Set which programs to autoreload when code changes.
     #  When this option is specified, the default for all other
-    #  programs becomes autoreload=false.
+    #  programs and event listeners becomes autoreload=false.
     if options.get("autoreload",None):
         data.append("[program:autoreload]\nexclude=false\nautostart=true\n")
         data.append("[program:__defaults__]\nautoreload=false\n")
+        data.append("[eventlistener:__defaults__]\nautoreload=false\n")
         for progname in options["autoreload"]:
             data.append("[program:%s]\nautoreload=true\n" % (progname,))
     #  Set whether to use the autoreloader at all.
@@ -189,6 +692,60 @@ def get_config_from_options(**options):
     return "".join(data)
 
 
+def get_config_fingerprint(ctx):
+    """Get a fingerprint of the inputs to the merged config.
+
+    This covers everything that can affect the merged config apart from
+    the contents of the files read while producing it: the template context
+    variables, the environment, and any settings we know to be relevant.
+    Of the host facts, only the ones that don't change over time are used.
+    """
+    setting_names = ["DEBUG","SECRET_KEY"]
+    setting_names.extend(nm for nm in dir(settings)
+                            if nm.startswith("SUPERVISOR_"))
+    return cache.fingerprint(
+        djsupervisor.__version__,
+        DEFAULT_CONFIG,
+        ctx["PROJECT_DIR"],
+        ctx["PYTHON"],
+        ctx["SUPERVISOR_OPTIONS"],
+        ctx["HOST"].fingerprint(),
+        sorted(os.environ.items()),
+        [(nm,getattr(settings,nm,None)) for nm in sorted(setting_names)],
+    )
+
+
+def get_cache_file(project_dir,name):
+    """Get the path to the named cache file for the given project."""
+    cache_dir = CONFIG_CACHE_DIR
+    if cache_dir is None:
+        cache_dir = os.path.join(project_dir,".supervisor-cache")
+    return os.path.join(cache_dir,name)
+
+
+def get_zygote_socket(project_dir=None):
+    """Get the path to the unix socket the zygote listens on."""
+    if project_dir is None:
+        project_dir = guess_project_dir()
+    return get_cache_file(project_dir,"zygote.sock")
+
+
+def get_settings_file():
+    """Get the path to the source file of the active settings module.
+
+    Many settings can be used from within the config templates, so rather
+    than trying to track them individually we just watch the file that
+    defines them.
+    """
+    try:
+        filepath = sys.modules[settings.SETTINGS_MODULE].__file__
+    except (AttributeError,KeyError):
+        return None
+    if filepath.endswith((".pyc",".pyo")) and os.path.exists(filepath[:-1]):
+        filepath = filepath[:-1]
+    return os.path.abspath(filepath)
+
+
 def guess_project_dir():
     """Find the top-level Django project directory.
 
@@ -216,25 +773,27 @@ def guess_project_dir():
     raise RuntimeError(msg)
 
 
-def set_if_missing(cfg,section,option,value):
+def is_listen_command(command):
+    """Check whether a command runs the "supervisor listen" command."""
+    args = command.split()
+    return any(arg.endswith("manage.py") for arg in args) and \
+           "supervisor" in args and "listen" in args
+
+
+def set_if_missing(sections,section,option,value):
     """If the given option is missing, set to the given value."""
-    try:
-        cfg.get(section,option)
-    except NoSectionError:
-        cfg.add_section(section)
-        cfg.set(section,option,value)
-    except NoOptionError:
-        cfg.set(section,option,value)
+    sections.setdefault(section,OrderedDict()).setdefault(option,value)
 
 
 def rerender_options(options):
     """Helper function to re-render command-line options.
 
     This assumes that command-line options use the same name as their
-    key in the options dictionary.
+    key in the options dictionary.  Options are rendered in sorted order,
+    so that the result is stable for use in the config cache fingerprint.
     """
     args = []
-    for name,value in options.iteritems():
+    for name,value in sorted(options.iteritems()):
         name = name.replace("_","-")
         if value is None:
             pass
@@ -262,6 +821,47 @@ autoreload=true
 exclude=true
 {% endif %}
 
+{% if settings.SUPERVISOR_METRICS_PORT %}
+;  If enabled, export process metrics over HTTP in Prometheus format.
+[eventlistener:metrics]
+command={{ PYTHON }} {{ PROJECT_DIR }}/manage.py supervisor {{ SUPERVISOR_OPTIONS }} metrics
+events=PROCESS_STATE,TICK_5
+autoreload=false
+{% endif %}
+
+;  Restart processes that use too much memory.  This is only included if
+;  some program has a max_rss option.
+[eventlistener:djsupervisor_memwatch]
+command={{ PYTHON }} {{ PROJECT_DIR }}/manage.py supervisor {{ SUPERVISOR_OPTIONS }} memwatch
+events=TICK_5
+autoreload=false
+
+;  Probe the health of programs, restarting them if they fail.  This is only
+;  included if some program has a healthcheck option.
+[program:djsupervisor_healthcheck]
+command={{ PYTHON }} {{ PROJECT_DIR }}/manage.py supervisor {{ SUPERVISOR_OPTIONS }} healthcheck
+autoreload=false
+
+;  Start programs with dependencies once their dependencies are ready.  This
+;  is only included if some program has a depends_on option.
+[program:djsupervisor_startup]
+command={{ PYTHON }} {{ PROJECT_DIR }}/manage.py supervisor {{ SUPERVISOR_OPTIONS }} startup
+autoreload=false
+autorestart=false
+startsecs=0
+priority=1
+
+;  Fork Django programs from a single preloaded process.  This is only
+;  included if some program has a zygote option.
+[program:djsupervisor_zygote]
+command={{ PYTHON }} {{ PROJECT_DIR }}/manage.py supervisor {{ SUPERVISOR_OPTIONS }} zygote
+priority=1
+
+;  Event listeners are run by "supervisor listen" unless they give their own
+;  command, which dispatches events to handlers registered in Django.
+[eventlistener:__defaults__]
+command={{ PYTHON }} {{ PROJECT_DIR }}/manage.py supervisor {{ SUPERVISOR_OPTIONS }} listen %(program_name)s
+
 ;  All programs are auto-reloaded by default.
 [program:__defaults__]
 autoreload=true
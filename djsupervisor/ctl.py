@@ -0,0 +1,158 @@
+"""
+
+djsupervisor.ctl:  lightweight entry-point for controlling supervisord
+----------------------------------------------------------------------
+
+Running "manage.py supervisor status" means setting up Django and merging the
+config before supervisorctl even gets a look in, which adds a noticeable
+delay to every call from e.g. a health-check script.  This module provides
+a faster way to run such control commands::
+
+    $ python -m djsupervisor.ctl status
+    $ python -m djsupervisor.ctl restart celeryd
+
+It uses the connection details cached by the last full run of the supervisor
+command, without importing Django at all.  If the cache is missing, or any of
+the files that went into the config have changed, or the command is run with
+a different environment or python interpreter, it falls back to running the
+full "manage.py supervisor" command instead.
+
+"""
+
+import os
+import sys
+import glob
+import argparse
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from djsupervisor import cache
+
+#  Environment variables that manage.py and Django set for themselves, and so
+#  which are left out of the cache key.  The settings file is one of the
+#  files the cache depends on, so changes to the TZ it sets are still noticed.
+SELF_SET_ENVIRON = ("DJANGO_SETTINGS_MODULE","TZ")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m djsupervisor.ctl",
+        description="run supervisorctl commands for a django project",
+    )
+    parser.add_argument(
+        "--project-dir",
+        help="the root directory for the django project"
+             " (by default, the nearest directory containing manage.py)"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="the directory containing the config cache"
+             " (by default this is <project-dir>/.supervisor-cache)"
+    )
+    parser.add_argument("command",nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+    project_dir = args.project_dir
+    if project_dir is None:
+        project_dir = find_project_dir(os.getcwd())
+        if project_dir is None:
+            parser.error("unable to find manage.py; use --project-dir")
+    command = tuple(args.command)
+    if command and is_control_command(command[0]):
+        info = get_control_info(project_dir,args.cache_dir)
+        if info is not None:
+            return run_supervisorctl(info,command)
+    if args.project_dir is not None:
+        command = ("--project-dir=%s" % (project_dir,),) + command
+    return run_manage_py(project_dir,command)
+
+
+def find_project_dir(dirnm):
+    """Find the nearest enclosing directory that contains manage.py."""
+    dirnm = os.path.abspath(dirnm)
+    while True:
+        if os.path.isfile(os.path.join(dirnm,"manage.py")):
+            return dirnm
+        parent = os.path.dirname(dirnm)
+        if parent == dirnm:
+            return None
+        dirnm = parent
+
+
+def is_control_command(name):
+    """Check whether the named command can be handled by supervisorctl."""
+    from supervisor.supervisorctl import DefaultControllerPlugin
+    if name == "shell":
+        return True
+    return hasattr(DefaultControllerPlugin,"do_" + name)
+
+
+def get_control_info(project_dir,cache_dir=None):
+    """Get the cached supervisorctl connection details, if still fresh.
+
+    This returns a dict of the options from the [supervisorctl] section of
+    the merged config, or None if they can't safely be re-used.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(project_dir,".supervisor-cache")
+    cache_file = os.path.join(cache_dir,"control.json")
+    info = cache.read_cache(cache_file,get_control_key(project_dir))
+    if info is None:
+        return None
+    settings_module = os.environ.get("DJANGO_SETTINGS_MODULE")
+    if settings_module not in (None,info["settings_module"]):
+        return None
+    #  A new file matching the include pattern could change the config,
+    #  and it won't be noticed by checking the files we already know about.
+    if info["include"] is not None:
+        (pattern,matches) = info["include"]
+        if sorted(glob.glob(pattern)) != matches:
+            return None
+    return info
+
+
+def get_control_key(project_dir):
+    """Get the key under which the connection details are cached.
+
+    This covers the inputs to the merged config that can be checked without
+    setting up Django: the project, the python interpreter and the whole
+    environment, apart from the variables in SELF_SET_ENVIRON.  The settings
+    file is one of the files that the cache depends on, so changes to the
+    settings are noticed too.  DJANGO_SETTINGS_MODULE is checked separately
+    by get_control_info().
+    """
+    environ = dict(os.environ)
+    for name in SELF_SET_ENVIRON:
+        environ.pop(name,None)
+    return cache.fingerprint(
+        os.path.abspath(project_dir),
+        os.path.realpath(os.path.abspath(sys.executable)),
+        sorted(environ.items()),
+    )
+
+
+def run_supervisorctl(info,command):
+    """Run the given supervisorctl command with the given connection info."""
+    from supervisor import supervisorctl
+    cfg = ["[supervisorctl]\n"]
+    for name in ("serverurl","username","password"):
+        if info.get(name):
+            cfg.append("%s = %s\n" % (name,info[name]))
+    args = ("-c",StringIO(str("".join(cfg))))
+    if command[0] == "shell":
+        args += ("--interactive",)
+        command = command[1:]
+    return supervisorctl.main(args + command)
+
+
+def run_manage_py(project_dir,command):
+    """Fall back to running the full "manage.py supervisor" command."""
+    manage_py = os.path.join(project_dir,"manage.py")
+    argv = [sys.executable,manage_py,"supervisor"]
+    argv.extend(command)
+    os.execv(sys.executable,argv)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
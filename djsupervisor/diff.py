@@ -0,0 +1,199 @@
+"""
+
+djsupervisor.diff:  work out and apply minimal changes to a running config
+--------------------------------------------------------------------------
+
+This module compares a new supervisord config with the one that supervisord
+is currently running, and applies just the differences.  It's the machinery
+behind the "supervisor diffconfig" and "supervisor applyconfig" commands.
+
+supervisord itself can only tell us which process groups have changed in
+some way.  To do better, we keep a snapshot of the process configs that
+supervisord is running, taken when it is launched and updated whenever we
+apply changes.  Comparing against this snapshot lets us see exactly which
+options have changed, and hence whether the running processes really need
+to be restarted for the change to take effect.
+
+"""
+
+import types
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from djsupervisor import cache
+
+#  Options that only affect how supervisord manages a process, and not the
+#  process itself.  Changes to these don't require a running process to be
+#  restarted, and can wait until the group is next updated while stopped.
+DEFERRED_OPTIONS = frozenset([
+    "autostart",
+    "autorestart",
+    "startsecs",
+    "startretries",
+    "exitcodes",
+    "stopsignal",
+    "stopwaitsecs",
+    "stopasgroup",
+    "killasgroup",
+    "priority",
+])
+
+#  The key under which group-level options are stored in a snapshot.
+GROUP_KEY = "__group__"
+
+
+def get_process_configs(data):
+    """Parse a config into a snapshot of its process configs.
+
+    The config is parsed by supervisord's own option-handling code, so the
+    snapshot reflects exactly what supervisord would run.  It is a dict
+    mapping each group name to a dict of its processes, each of which maps
+    option names to a canonical string form of their value.  Options for
+    the group as a whole are stored under the special name GROUP_KEY.
+    """
+    from supervisor.options import ServerOptions
+    options = ServerOptions()
+    options.configfile = StringIO(data)
+    options.process_config(do_usage=False)
+    snapshot = {}
+    for gconfig in options.process_group_configs:
+        group = {}
+        group[GROUP_KEY] = dict((name,_canonical(value))
+                                for (name,value) in vars(gconfig).iteritems()
+                                if name not in ("options","process_configs"))
+        for pconfig in gconfig.process_configs:
+            names = pconfig.req_param_names + pconfig.optional_param_names
+            group[pconfig.name] = dict((name,_canonical(getattr(pconfig,name)))
+                                       for name in names)
+        snapshot[gconfig.name] = group
+    return snapshot
+
+
+def read_snapshot(cache_file,key):
+    """Read the snapshot of the running config, or None if there isn't one."""
+    return cache.read_cache(cache_file,key)
+
+
+def write_snapshot(cache_file,key,snapshot):
+    """Write out the snapshot of the running config."""
+    cache.write_cache(cache_file,key,[],snapshot)
+
+
+def get_changes(added,changed,removed,old,new):
+    """Classify the changes to each group reported by supervisord.
+
+    The added, changed and removed arguments are lists of group names as
+    returned by the supervisor.reloadConfig() method, and old and new are
+    the snapshots of the running and new configs.  This returns a list of
+    (group,action,options) tuples, where action is one of:
+
+        * "add":      the group is new, and should be added.
+        * "remove":   the group has gone, and should be removed.
+        * "restart":  the group has changed in a way that means its processes
+                      must be restarted.
+        * "defer":    only options in DEFERRED_OPTIONS have changed, so there
+                      is no need to restart its processes.
+
+    and options is a sorted list of the options that have changed.  If a
+    group isn't in the old snapshot, it is assumed to need a restart.
+    """
+    changes = []
+    for group in sorted(added):
+        changes.append((group,"add",[]))
+    for group in sorted(removed):
+        changes.append((group,"remove",[]))
+    for group in sorted(changed):
+        if group not in old or group not in new:
+            changes.append((group,"restart",[]))
+            continue
+        options = _diff_group(old[group],new[group])
+        if options is not None and options.issubset(DEFERRED_OPTIONS):
+            changes.append((group,"defer",sorted(options)))
+        else:
+            changes.append((group,"restart",sorted(options or ())))
+    return changes
+
+
+def apply_changes(client,changes,force=False):
+    """Apply the given changes to a running supervisord.
+
+    Groups whose changes are deferred are only updated if none of their
+    processes are currently running, unless force is true.  This returns
+    a tuple (applied,failures) where applied is the list of groups that were
+    updated and failures is a list of (name,description) pairs.
+    """
+    infos = client.get_all_process_info()
+    running = set(info["group"] for info in infos
+                  if info["statename"] in ("STARTING","RUNNING","BACKOFF"))
+    to_stop = []
+    to_remove = []
+    to_add = []
+    for (group,action,_) in changes:
+        if action == "defer" and group in running and not force:
+            continue
+        if action != "add":
+            to_stop.append(group)
+            to_remove.append(group)
+        if action != "remove":
+            to_add.append(group)
+    failures = []
+    if to_stop:
+        failures.extend(client.stop([group + ":*" for group in to_stop]))
+    failed = set(name.split(":",1)[0] for (name,_) in failures)
+    to_remove = [group for group in to_remove if group not in failed]
+    to_add = [group for group in to_add if group not in failed]
+    calls = [("supervisor.removeProcessGroup",(group,))
+             for group in to_remove]
+    failures.extend(_get_failures(to_remove,client.multicall(calls)))
+    failed = set(name for (name,_) in failures)
+    to_add = [group for group in to_add if group not in failed]
+    calls = [("supervisor.addProcessGroup",(group,)) for group in to_add]
+    failures.extend(_get_failures(to_add,client.multicall(calls)))
+    failed = set(name.split(":",1)[0] for (name,_) in failures)
+    applied = [group for group in set(to_remove + to_add)
+                     if group not in failed]
+    return (sorted(applied),failures)
+
+
+def _diff_group(old,new):
+    """Get the set of options that differ between two group snapshots.
+
+    This returns None if the set of processes in the group has changed.
+    """
+    if set(old) != set(new):
+        return None
+    options = set()
+    for name in old:
+        for option in set(old[name]) | set(new[name]):
+            if old[name].get(option) != new[name].get(option):
+                options.add(option)
+    return options
+
+
+def _get_failures(names,results):
+    from xmlrpclib import Fault
+    failures = []
+    for (name,result) in zip(names,results):
+        if isinstance(result,Fault):
+            failures.append((name,result.faultString))
+    return failures
+
+
+def _canonical(value):
+    """Get a canonical string form of a config value, for comparison."""
+    if isinstance(value,(type,types.ClassType)):
+        return value.__name__
+    if isinstance(value,(types.FunctionType,types.BuiltinFunctionType)):
+        return "%s.%s" % (value.__module__,value.__name__)
+    if isinstance(value,(list,tuple)):
+        return repr([_canonical(item) for item in value])
+    if isinstance(value,dict):
+        return repr(sorted(value.items()))
+    from supervisor.datatypes import SocketConfig
+    if isinstance(value,SocketConfig):
+        #  The repr of a socket config includes its id(), so compare its
+        #  URL, owner, mode and so on instead.
+        return "%s %r" % (value.__class__.__name__,sorted(vars(value).items()))
+    return repr(value)
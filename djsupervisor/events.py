@@ -1,24 +1,80 @@
 
+import sys
 import time
+import threading
+import traceback
 
 from watchdog.events import PatternMatchingEventHandler
+from watchdog.utils import has_attribute
+try:
+    from watchdog.utils.patterns import match_any_paths
+except ImportError:
+    from pathtools.patterns import match_any_paths
 
 
 class CallbackModifiedHandler(PatternMatchingEventHandler):
     """
     A pattern matching event handler that calls the provided
-    callback when a file is modified.
+    callback when files are created, modified, moved or deleted.
+
+    Events are debounced: the callback fires once things have been quiet
+    for quiet_period seconds, or once max_wait seconds have passed since
+    the first unreported event, whichever comes first.  It is called from
+    a background thread with the set of paths that changed in that time.
     """
     def __init__(self, callback, *args, **kwargs):
         self.callback = callback
-        self.repeat_delay = kwargs.pop("repeat_delay", 0)
-        self.last_fired_time = 0
+        #  For backwards-compatibility, repeat_delay sets the quiet period.
+        repeat_delay = kwargs.pop("repeat_delay", 0.5)
+        self.quiet_period = kwargs.pop("quiet_period", repeat_delay)
+        self.max_wait = kwargs.pop("max_wait", 5)
+        self.changed_paths = set()
+        self.first_event_time = None
+        self.last_event_time = None
+        self._condition = threading.Condition()
         super(CallbackModifiedHandler, self).__init__(*args, **kwargs)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
 
-    def on_modified(self, event):
-        super(CallbackModifiedHandler, self).on_modified(event)
+    def on_any_event(self, event):
+        super(CallbackModifiedHandler, self).on_any_event(event)
+        if event.is_directory:
+            return
+        paths = [event.src_path]
+        if has_attribute(event, "dest_path"):
+            paths.append(event.dest_path)
+        #  Only report paths that match our patterns, e.g. not the source
+        #  of an editor moving a temporary file into place.
+        paths = [path for path in paths
+                      if match_any_paths([path],
+                                         included_patterns=self.patterns,
+                                         excluded_patterns=self.ignore_patterns,
+                                         case_sensitive=self.case_sensitive)]
+        if not paths:
+            return
         now = time.time()
-        if self.last_fired_time + self.repeat_delay < now:
-            if not event.is_directory:
-                self.last_fired_time = now
-                self.callback()
+        with self._condition:
+            if not self.changed_paths:
+                self.first_event_time = now
+            self.last_event_time = now
+            self.changed_paths.update(paths)
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self.changed_paths:
+                    self._condition.wait()
+                deadline = min(self.last_event_time + self.quiet_period,
+                               self.first_event_time + self.max_wait)
+                now = time.time()
+                if now < deadline:
+                    self._condition.wait(deadline - now)
+                    continue
+                changed_paths = self.changed_paths
+                self.changed_paths = set()
+            try:
+                self.callback(changed_paths)
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
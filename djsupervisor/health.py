@@ -0,0 +1,299 @@
+"""
+
+djsupervisor.health:  health-check probes for supervised processes
+------------------------------------------------------------------
+
+This module implements the "supervisor healthcheck" command, a single
+process that probes the health of all programs configured with one of the
+following options:
+
+    * healthcheck_http:  a URL that must respond with a non-error status
+    * healthcheck_tcp:   a host:port that must accept connections
+    * healthcheck_cmd:   a command that must exit with status zero
+
+Probes run concurrently on a pool of threads, and a process is restarted
+once enough probes in a row have failed or been too slow.  The latest
+results are written to a JSON file, which "supervisor health" displays.
+
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import socket
+import urllib2
+import subprocess
+from Queue import Queue, Empty
+from multiprocessing.pool import ThreadPool
+
+from djsupervisor import cache
+from djsupervisor.config import PROGRAM_SECTIONS, get_processes
+
+KINDS = ("http","tcp","cmd")
+
+#  Default values for the per-program healthcheck options, in seconds
+#  apart from healthcheck_failures.
+DEFAULTS = {
+    "interval": 10,
+    "timeout": 5,
+    "max_latency": None,
+    "failures": 3,
+    "grace": 10,
+}
+
+
+def get_checks(cfg,own_name=None):
+    """Get the health checks for each process from the merged config.
+
+    This returns a list of dicts, one for each process of each program that
+    has a healthcheck option, named as supervisord names them (so taking
+    any [group:x] section into account).  Options can use the same
+    %(process_num)s style expansions as the program's command, so that each
+    process of a multi-process program can be checked separately.
+    """
+    checks = []
+    for section in cfg.sections():
+        if not section.startswith(PROGRAM_SECTIONS):
+            continue
+        options = dict(cfg.items(section))
+        kinds = [kind for kind in KINDS if "healthcheck_" + kind in options]
+        if not kinds:
+            continue
+        for (name,expansions) in get_processes(cfg,section):
+            if name == own_name:
+                continue
+            check = {"name": name, "group": name.split(":",1)[0]}
+            check["kind"] = kinds[0]
+            check["target"] = options["healthcheck_" + kinds[0]] % expansions
+            for (option,default) in DEFAULTS.iteritems():
+                value = options.get("healthcheck_" + option)
+                if value is None:
+                    check[option] = default
+                elif option == "failures":
+                    check[option] = max(int(value),1)
+                else:
+                    check[option] = float(value)
+            checks.append(check)
+    return checks
+
+
+def probe(check):
+    """Run a single health-check probe.
+
+    This returns a tuple (healthy,latency,error) where error describes
+    why the probe failed, or is None if it succeeded.
+    """
+    start = time.time()
+    try:
+        if check["kind"] == "http":
+            error = _probe_http(check["target"],check["timeout"])
+        elif check["kind"] == "tcp":
+            error = _probe_tcp(check["target"],check["timeout"])
+        else:
+            error = _probe_cmd(check["target"],check["timeout"])
+    except Exception as e:
+        error = str(e) or e.__class__.__name__
+    latency = time.time() - start
+    if error is None and check["max_latency"] is not None:
+        if latency > check["max_latency"]:
+            error = "too slow (%.3fs)" % (latency,)
+    return (error is None,latency,error)
+
+
+def _probe_http(url,timeout):
+    try:
+        f = urllib2.urlopen(url,timeout=timeout)
+    except urllib2.HTTPError as e:
+        return "HTTP status %d" % (e.code,)
+    try:
+        f.read(4096)
+    finally:
+        f.close()
+    return None
+
+
+def _probe_tcp(address,timeout):
+    (host,_,port) = address.rpartition(":")
+    sock = socket.create_connection((host or "127.0.0.1",int(port)),timeout)
+    sock.close()
+    return None
+
+
+def _probe_cmd(command,timeout):
+    with open(os.devnull,"r+") as devnull:
+        proc = subprocess.Popen(shlex.split(command),stdin=devnull,
+                                stdout=devnull,stderr=devnull)
+        deadline = time.time() + timeout
+        while proc.poll() is None:
+            if time.time() >= deadline:
+                proc.kill()
+                proc.wait()
+                return "timed out"
+            time.sleep(0.05)
+    if proc.returncode != 0:
+        return "exit status %d" % (proc.returncode,)
+    return None
+
+
+class HealthChecker(object):
+    """Run health-check probes, restarting processes that fail them.
+
+    Probes run on a pool of the given number of threads.  At most one
+    process from each group is restarted at a time, so that a problem
+    affecting a whole group (e.g. a database going away) doesn't take down
+    all its processes at once.  Restarts have a separate pool with a thread
+    for each group, so that a slow restart never holds up the probes.
+    """
+
+    def __init__(self,client,checks,threads=32,state_file=None,stream=None):
+        self.client = client
+        self.checks = dict((check["name"],check) for check in checks)
+        self.pool = ThreadPool(max(min(threads,len(checks)),1))
+        groups = set(check["group"] for check in checks)
+        self.restart_pool = ThreadPool(max(len(groups),1))
+        self.state_file = state_file
+        self.stream = stream
+        self.results = Queue()
+        #  Maps each process name to the dict of its latest status.
+        self.state = {}
+        self.due = dict((name,0) for name in self.checks)
+        self.in_flight = set()
+        self.restarting = set()
+        self.state_written = 0
+
+    def run(self):
+        """Run the probes until interrupted."""
+        if not self.checks:
+            while True:
+                time.sleep(3600)
+        while True:
+            now = time.time()
+            if any(due <= now for due in self.due.itervalues()):
+                self.start_probes(now)
+            timeout = max(min(self.due.itervalues()) - time.time(),0)
+            try:
+                result = self.results.get(timeout=min(timeout,1))
+            except Empty:
+                pass
+            else:
+                self.handle_result(*result)
+                while True:
+                    try:
+                        self.handle_result(*self.results.get_nowait())
+                    except Empty:
+                        break
+            if self.state_written < time.time() - 1:
+                self.write_state()
+
+    def start_probes(self,now):
+        """Start probes for all processes that are due to be checked."""
+        infos = {}
+        for info in self.client.get_all_process_info():
+            infos["%s:%s" % (info["group"],info["name"])] = info
+        for (name,check) in self.checks.iteritems():
+            if self.due[name] > now:
+                continue
+            self.due[name] = now + check["interval"]
+            info = infos.get(name)
+            state = self.state.setdefault(name,{
+                "kind": check["kind"],
+                "target": check["target"],
+                "status": "unknown",
+                "failures": 0,
+            })
+            if info is None or info["statename"] != "RUNNING":
+                state.update(status="not running",failures=0,latency=None,
+                             error=None)
+                continue
+            if info["now"] - info["start"] < check["grace"]:
+                state.update(status="starting",failures=0,error=None)
+                continue
+            if name in self.in_flight or check["group"] in self.restarting:
+                continue
+            self.in_flight.add(name)
+            self.pool.apply_async(self._probe,(name,check,info["pid"]),
+                                  callback=self.results.put)
+
+    def _probe(self,name,check,pid):
+        return ("probe",name,pid) + probe(check)
+
+    def handle_result(self,kind,name,*args):
+        """Handle the result of a probe or a restart."""
+        if kind == "restart":
+            (failures,) = args
+            self.restarting.discard(self.checks[name]["group"])
+            for (failed_name,error) in failures:
+                self.log("%s failed to restart: %s" % (failed_name,error))
+            return
+        (pid,healthy,latency,error) = args
+        self.in_flight.discard(name)
+        check = self.checks[name]
+        state = self.state[name]
+        state.update(checked_at=time.time(),latency=latency,error=error,
+                     pid=pid)
+        if healthy:
+            state.update(status="healthy",failures=0)
+            return
+        state["failures"] += 1
+        state["status"] = "failing"
+        self.log("%s failed health check (%d of %d): %s" %
+                 (name,state["failures"],check["failures"],error))
+        if state["failures"] >= check["failures"]:
+            if check["group"] not in self.restarting:
+                self.log("restarting %s (pid %d)" % (name,pid))
+                state.update(status="restarting",failures=0)
+                self.restarting.add(check["group"])
+                self.restart_pool.apply_async(self._restart,(name,),
+                                              callback=self.results.put)
+
+    def _restart(self,name):
+        try:
+            failures = self.client.restart([name])
+        except Exception as e:
+            failures = [(name,str(e))]
+        return ("restart",name,failures)
+
+    def write_state(self):
+        """Write the latest status of each process to the state file."""
+        self.state_written = time.time()
+        if self.state_file is None:
+            return
+        data = json.dumps(self.state,sort_keys=True)
+        try:
+            cache.atomic_write(self.state_file,data)
+        except EnvironmentError:
+            pass
+
+    def log(self,msg):
+        stream = self.stream or sys.stderr
+        print>>stream, "healthcheck: %s" % (msg,)
+        stream.flush()
+
+
+def read_state(state_file):
+    """Read the latest health-check status, or None if there isn't any."""
+    try:
+        with open(state_file,"r") as f:
+            return json.load(f)
+    except (EnvironmentError,ValueError):
+        return None
+
+
+def write_table(state,stream=None):
+    """Write the health-check status as a human-readable table."""
+    if stream is None:
+        stream = sys.stdout
+    columns = "%-32s %-12s %9s %8s  %s"
+    print>>stream, columns % ("NAME","STATUS","LATENCY","FAILURES","CHECK")
+    for (name,s) in sorted(state.iteritems()):
+        if s.get("latency") is None:
+            latency = "-"
+        else:
+            latency = "%.1fms" % (s["latency"] * 1000,)
+        check = "%s %s" % (s["kind"],s["target"])
+        if s.get("error") and s["status"] != "healthy":
+            check = "%s (%s)" % (check,s["error"])
+        print>>stream, columns % (name,s["status"],latency,s["failures"],
+                                  check)
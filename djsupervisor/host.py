@@ -0,0 +1,215 @@
+"""
+
+djsupervisor.host:  facts about the host machine, for sizing processes
+----------------------------------------------------------------------
+
+This module provides HostFacts, which is available as the HOST variable in
+config templates.  It finds out how many CPUs and how much memory the
+processes will have available, taking into account the CPU affinity mask
+and any cgroup limits such as those imposed by a container.  Each fact is
+only worked out the first time it's used.
+
+"""
+
+import os
+import math
+import multiprocessing
+
+PROC_DIR = "/proc"
+CGROUP_DIR = "/sys/fs/cgroup"
+
+#  Suffixes accepted by parse_bytes(), as powers of 1024.
+BYTE_SUFFIXES = {"": 0, "B": 0, "K": 1, "M": 2, "G": 3, "T": 4}
+
+
+class HostFacts(object):
+    """Lazily-computed facts about the CPUs and memory of the host.
+
+    The available attributes are:
+
+        * cpu_count:         number of CPUs in the machine
+        * usable_cpus:       number of CPUs we can actually use, after the
+                             affinity mask and cgroup CPU quota
+        * memory_total:      total memory in bytes, after cgroup limits
+        * memory_available:  memory available for new processes in bytes,
+                             after cgroup limits
+
+    Memory is rounded down to whole megabytes to keep it stable over time.
+    """
+
+    def __init__(self,proc_dir=PROC_DIR,cgroup_dir=CGROUP_DIR):
+        self.proc_dir = proc_dir
+        self.cgroup_dir = cgroup_dir
+        self._facts = {}
+
+    def __getattr__(self,name):
+        if name.startswith("_") or not hasattr(self,"_get_" + name):
+            raise AttributeError(name)
+        try:
+            return self._facts[name]
+        except KeyError:
+            value = self._facts[name] = getattr(self,"_get_" + name)()
+            return value
+
+    def fingerprint(self):
+        """Get the facts that can affect the config, for the config cache.
+
+        Available memory isn't included, since it changes all the time.
+        """
+        return (self.cpu_count,self.usable_cpus,self.memory_total)
+
+    def _get_cpu_count(self):
+        try:
+            return multiprocessing.cpu_count()
+        except NotImplementedError:
+            return 1
+
+    def _get_usable_cpus(self):
+        cpus = self.cpu_count
+        allowed = _read_key(os.path.join(self.proc_dir,"self","status"),
+                            "Cpus_allowed_list")
+        if allowed:
+            cpus = min(cpus,len(parse_cpu_list(allowed)))
+        quota = self._get_cpu_quota()
+        if quota is not None:
+            cpus = min(cpus,int(math.ceil(quota)))
+        return max(cpus,1)
+
+    def _get_cpu_quota(self):
+        """Get the cgroup CPU quota as a number of CPUs, or None."""
+        #  cgroups v2 has "<quota> <period>", with a quota of "max" if none.
+        data = _read_file(os.path.join(self.cgroup_dir,"cpu.max"))
+        if data is not None:
+            fields = data.split()
+            if len(fields) == 2 and fields[0] != "max":
+                return int(fields[0]) / float(fields[1])
+            return None
+        #  cgroups v1 has them in separate files, with a quota of -1 if none.
+        quota = _read_file(os.path.join(self.cgroup_dir,"cpu",
+                                        "cpu.cfs_quota_us"))
+        period = _read_file(os.path.join(self.cgroup_dir,"cpu",
+                                         "cpu.cfs_period_us"))
+        if quota is None or period is None or int(quota) <= 0:
+            return None
+        return int(quota) / float(period)
+
+    def _get_memory_total(self):
+        total = _read_meminfo(self.proc_dir,"MemTotal")
+        if total is None:
+            total = os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        (limit,_) = self._get_memory_limit()
+        if limit is not None:
+            total = min(total,limit)
+        return _round_mb(total)
+
+    def _get_memory_available(self):
+        available = _read_meminfo(self.proc_dir,"MemAvailable")
+        if available is None:
+            available = _read_meminfo(self.proc_dir,"MemFree")
+        if available is None:
+            available = os.sysconf("SC_AVPHYS_PAGES") * \
+                        os.sysconf("SC_PAGE_SIZE")
+        (limit,usage) = self._get_memory_limit()
+        if limit is not None and usage is not None:
+            available = min(available,max(limit - usage,0))
+        return _round_mb(available)
+
+    def _get_memory_limit(self):
+        """Get the cgroup memory (limit,usage) in bytes, or None for each."""
+        limit = _read_file(os.path.join(self.cgroup_dir,"memory.max"))
+        if limit is not None:
+            usage = _read_file(os.path.join(self.cgroup_dir,"memory.current"))
+        else:
+            limit = _read_file(os.path.join(self.cgroup_dir,"memory",
+                                            "memory.limit_in_bytes"))
+            usage = _read_file(os.path.join(self.cgroup_dir,"memory",
+                                            "memory.usage_in_bytes"))
+        if limit is None or not limit.isdigit():
+            return (None,None)
+        if usage is not None and usage.isdigit():
+            return (int(limit),int(usage))
+        return (int(limit),None)
+
+
+def get_worker_count(host,per_cpu=1,plus=0,memory_per_worker=None,
+                          at_least=1,at_most=None):
+    """Work out how many worker processes to run on the given host.
+
+    This is per_cpu workers for each usable CPU plus a constant, capped so
+    that memory_per_worker (in bytes, or a string like "256M") times the
+    number of workers fits within the host's total memory.  The result
+    is then kept between at_least and at_most.
+    """
+    workers = int(per_cpu * host.usable_cpus + plus)
+    if memory_per_worker:
+        memory_per_worker = parse_bytes(memory_per_worker)
+        workers = min(workers,host.memory_total // memory_per_worker)
+    if at_most is not None:
+        workers = min(workers,int(at_most))
+    return max(workers,int(at_least))
+
+
+def parse_bytes(value):
+    """Parse an amount of memory such as "512M" or "2GB" into bytes."""
+    if isinstance(value,(int,long)):
+        return value
+    value = str(value).strip().upper()
+    if value.endswith("IB"):
+        value = value[:-2]
+    number = value.rstrip("KMGTB")
+    suffix = value[len(number):]
+    if len(suffix) == 2 and suffix.endswith("B"):
+        suffix = suffix[0]
+    try:
+        power = BYTE_SUFFIXES[suffix]
+        return int(float(number) * 1024 ** power)
+    except (KeyError,ValueError):
+        raise ValueError("invalid amount of memory: %r" % (value,))
+
+
+def parse_cpu_list(value):
+    """Parse a list of CPUs such as "0-3,8,10-11" into a set of numbers."""
+    cpus = set()
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if "-" in item:
+            (start,end) = item.split("-",1)
+            cpus.update(xrange(int(start),int(end) + 1))
+        else:
+            cpus.add(int(item))
+    return cpus
+
+
+def _read_file(path):
+    try:
+        with open(path,"r") as f:
+            return f.read().strip()
+    except EnvironmentError:
+        return None
+
+
+def _read_key(path,key):
+    """Read the value for the given key from a "key: value" style file."""
+    try:
+        with open(path,"r") as f:
+            for line in f:
+                (name,_,value) = line.partition(":")
+                if name == key:
+                    return value.strip()
+    except EnvironmentError:
+        pass
+    return None
+
+
+def _read_meminfo(proc_dir,key):
+    value = _read_key(os.path.join(proc_dir,"meminfo"),key)
+    if value is None:
+        return None
+    #  Values are given in kilobytes, as e.g. "16318484 kB".
+    return int(value.split()[0]) * 1024
+
+
+def _round_mb(num):
+    return num - num % (1024 * 1024)
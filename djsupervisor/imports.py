@@ -0,0 +1,159 @@
+"""
+
+djsupervisor.imports:  track which source files each process has imported
+-------------------------------------------------------------------------
+
+This module lets supervised python processes record the set of source files
+they have imported, so that the autoreloader can restart only those processes
+whose code has actually changed.
+
+Each process periodically writes a small JSON record listing its imported
+files into a directory shared by all children of the same supervisord.
+Django processes do this automatically when SUPERVISOR_AUTORELOAD_SELECTIVE
+is enabled; other python programs can call start_reporting() themselves.
+
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+
+from djsupervisor import cache
+
+
+_reporter = None
+_reporter_lock = threading.Lock()
+
+
+def get_records_dir(environ=None):
+    """Get the directory holding import records for this supervisord.
+
+    All children of a supervisord see the same SUPERVISOR_SERVER_URL, so we
+    use a fingerprint of it to name the directory.  This returns None if
+    we are not running under supervisord.
+    """
+    if environ is None:
+        environ = os.environ
+    serverurl = environ.get("SUPERVISOR_SERVER_URL")
+    if serverurl is None:
+        return None
+    dirname = "djsupervisor-imports-%s" % (cache.fingerprint(serverurl)[:16],)
+    return os.path.join(tempfile.gettempdir(),dirname)
+
+
+def get_imported_files(modules=None):
+    """Get the set of source files for all currently-imported modules."""
+    if modules is None:
+        modules = sys.modules.values()
+    files = set()
+    for mod in modules:
+        try:
+            filename = mod.__file__
+        except AttributeError:
+            continue
+        if not filename:
+            continue
+        if filename.endswith((".pyc",".pyo")):
+            filename = filename[:-1]
+        files.add(os.path.realpath(os.path.abspath(filename)))
+    return files
+
+
+def write_record(records_dir,name,pid,files):
+    """Write the import record for the named process."""
+    data = json.dumps({"pid": pid, "files": sorted(files)})
+    if not os.path.isdir(records_dir):
+        try:
+            os.makedirs(records_dir,0700)
+        except EnvironmentError:
+            if not os.path.isdir(records_dir):
+                raise
+    cache.atomic_write(os.path.join(records_dir,name + ".json"),data)
+
+
+def read_records(records_dir):
+    """Read all import records, as a dict mapping process names to records.
+
+    Each record is a dict with keys "pid" and "files", the latter being a
+    set of filenames.
+    """
+    records = {}
+    try:
+        filenames = os.listdir(records_dir)
+    except EnvironmentError:
+        return records
+    for filename in filenames:
+        if not filename.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(records_dir,filename),"r") as f:
+                record = json.load(f)
+        except (EnvironmentError,ValueError):
+            continue
+        record["files"] = set(record["files"])
+        records[filename[:-len(".json")]] = record
+    return records
+
+
+def select_processes(names,changed_paths,infos,records):
+    """Select which of the named processes are affected by changed files.
+
+    A process is selected if its import record contains any of the changed
+    paths.  Processes without an up-to-date record, such as non-python
+    programs, are always selected since we can't tell what they depend on.
+    """
+    changed_paths = set(os.path.realpath(os.path.abspath(path))
+                        for path in changed_paths)
+    pids = {}
+    for info in infos:
+        pids["%s:%s" % (info["group"],info["name"])] = info["pid"]
+    selected = []
+    for name in names:
+        record = records.get(name)
+        if record is None or record["pid"] != pids.get(name):
+            selected.append(name)
+        elif not changed_paths.isdisjoint(record["files"]):
+            selected.append(name)
+    return selected
+
+
+def start_reporting(interval=2,environ=None,pid=None):
+    """Start recording the imports of this process in a background thread.
+
+    This does nothing if we're not running under supervisord, or if
+    reporting has already been started.  The record is written for the given
+    pid, which defaults to that of the current process; workers forked by
+    the zygote use the pid of the spawn script that supervisord started.
+    """
+    global _reporter
+    if environ is None:
+        environ = os.environ
+    records_dir = get_records_dir(environ)
+    name = environ.get("SUPERVISOR_PROCESS_NAME")
+    if records_dir is None or name is None:
+        return
+    name = "%s:%s" % (environ.get("SUPERVISOR_GROUP_NAME",name),name)
+    with _reporter_lock:
+        #  The thread doesn't survive a fork, so check it's still running.
+        if _reporter is None or not _reporter.is_alive():
+            _reporter = threading.Thread(target=_report_imports,
+                                         args=(records_dir,name,interval,
+                                               pid or os.getpid()))
+            _reporter.daemon = True
+            _reporter.start()
+
+
+def _report_imports(records_dir,name,interval,pid):
+    """Re-write the import record whenever the set of modules changes."""
+    num_modules = None
+    while True:
+        if len(sys.modules) != num_modules:
+            num_modules = len(sys.modules)
+            try:
+                write_record(records_dir,name,pid,get_imported_files())
+            except EnvironmentError:
+                pass
+        time.sleep(interval)
@@ -0,0 +1,204 @@
+"""
+
+djsupervisor.listener:  run supervisord event listeners inside Django
+---------------------------------------------------------------------
+
+This module implements the "supervisor listen" command, which runs as a
+supervisord eventlistener and passes the events it receives on to handlers
+connected to the djsupervisor.signals.supervisor_events signal.
+
+Django is set up just once when the listener starts, rather than once per
+event.  The supervisord protocol only lets a listener have one event in
+flight at a time, so events are read and acknowledged by a background thread
+and queued up for the handlers, which are sent everything that has piled up
+in a single batch.  If the handlers fall too far behind, we stop accepting
+new events and let supervisord buffer them until we catch up.
+
+Since events are acknowledged as soon as they are queued, supervisord will
+not re-send events for which a handler raised an error.
+
+"""
+
+import sys
+import time
+import threading
+import traceback
+from collections import namedtuple
+from Queue import Queue, Empty
+
+from supervisor import childutils
+
+from djsupervisor.signals import supervisor_events
+
+
+#  A single event from supervisord.  The name and serial number are taken
+#  from its headers, data is a dict of the fields on the first line of its
+#  payload, and body is the rest of the payload (e.g. the output of a process
+#  for PROCESS_LOG events).
+Event = namedtuple("Event","name serial headers data body")
+
+
+def main(name,handlers=(),batch_size=100,max_pending=1000,stats_interval=60):
+    """Run the named event listener, using the real stdin and stdout.
+
+    Any handlers given as dotted paths are connected to the signal first.
+    Anything printed to stdout by the handlers is redirected to stderr, as
+    stdout is reserved for talking to supervisord.
+    """
+    from django.utils.module_loading import import_string
+    for path in handlers:
+        supervisor_events.connect(import_string(path),weak=False,
+                                  dispatch_uid=path)
+    (stdin,stdout) = (sys.stdin,sys.stdout)
+    sys.stdout = sys.stderr
+    listener = EventListener(name,batch_size=batch_size,
+                             max_pending=max_pending,
+                             stats_interval=stats_interval)
+    listener.run(stdin,stdout)
+
+
+def parse_event(headers,payload):
+    """Parse the headers and payload of an event into an Event tuple."""
+    (line,_,body) = payload.partition("\n")
+    data = dict(token.split(":",1) for token in line.split() if ":" in token)
+    return Event(headers["eventname"],int(headers["serial"]),headers,data,body)
+
+
+class EventListener(object):
+    """Read events from supervisord, and dispatch them in batches.
+
+    At most batch_size events are sent to the handlers at once, and at most
+    max_pending events are queued up waiting for them.  Timings for each
+    handler are written to stderr every stats_interval seconds.
+    """
+
+    def __init__(self,name,signal=supervisor_events,batch_size=100,
+                      max_pending=1000,stats_interval=60,stderr=None):
+        self.name = name
+        self.signal = signal
+        self.batch_size = max(batch_size,1)
+        self.pending = Queue(max(max_pending,1))
+        self.stats_interval = stats_interval
+        self.stderr = stderr
+        self.timings = {}
+        self.next_stats = None
+
+    def run(self,stdin,stdout):
+        """Run until supervisord closes our stdin."""
+        reader = threading.Thread(target=self.read_events,args=(stdin,stdout))
+        reader.daemon = True
+        reader.start()
+        if self.stats_interval:
+            self.next_stats = time.time() + self.stats_interval
+        finished = False
+        while not finished:
+            events = [self.pending.get()]
+            while len(events) < self.batch_size:
+                try:
+                    events.append(self.pending.get_nowait())
+                except Empty:
+                    break
+            if events[-1] is None:
+                events.pop()
+                finished = True
+            if events:
+                self.dispatch(events)
+            if self.next_stats is not None and time.time() >= self.next_stats:
+                self.write_stats()
+                self.next_stats = time.time() + self.stats_interval
+        self.write_stats()
+
+    def read_events(self,stdin,stdout):
+        """Read events from supervisord and queue them for dispatch.
+
+        We don't tell supervisord we're ready for the next event until there
+        is room for it in the queue.  A None is queued when input runs out.
+        """
+        try:
+            while True:
+                childutils.listener.ready(stdout)
+                line = stdin.readline()
+                if not line:
+                    break
+                headers = childutils.get_headers(line)
+                payload = stdin.read(int(headers["len"]))
+                childutils.listener.ok(stdout)
+                self.pending.put(parse_event(headers,payload))
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.pending.put(None)
+
+    def dispatch(self,events):
+        """Send a batch of events to each handler, timing how long it takes.
+
+        If the handlers can't be listed separately, they're sent the events
+        with send_robust() and timed all together.
+        """
+        if not self.signal.has_listeners(self.name):
+            return
+        receivers = _get_receivers(self.signal,self.name)
+        if receivers is None:
+            start = time.time()
+            responses = self.signal.send_robust(sender=self.name,
+                                                listener=self.name,
+                                                events=events)
+            for (receiver,response) in responses:
+                if isinstance(response,Exception):
+                    print>>(self.stderr or sys.stderr), \
+                          "listen: %s raised %s: %s" \
+                          % (_get_receiver_name(receiver),
+                             response.__class__.__name__,response)
+            self.record_timing("all handlers",events,time.time() - start)
+            return
+        for receiver in receivers:
+            start = time.time()
+            try:
+                receiver(signal=self.signal,sender=self.name,
+                         listener=self.name,events=events)
+            except Exception:
+                traceback.print_exc()
+            self.record_timing(_get_receiver_name(receiver),events,
+                               time.time() - start)
+
+    def record_timing(self,name,events,elapsed):
+        timing = self.timings.setdefault(name,[0,0,0.0,0.0])
+        timing[0] += 1
+        timing[1] += len(events)
+        timing[2] += elapsed
+        timing[3] = max(timing[3],elapsed)
+
+    def write_stats(self):
+        """Write out and reset the timings for each handler."""
+        stderr = self.stderr or sys.stderr
+        for (name,timing) in sorted(self.timings.iteritems()):
+            print>>stderr, "listen: %s: %d batches, %d events, " \
+                           "%.3fs total, %.3fs max" % ((name,) + tuple(timing))
+        if self.timings:
+            print>>stderr, "listen: %d events pending" % (self.pending.qsize(),)
+            stderr.flush()
+        self.timings = {}
+
+
+def _get_receivers(signal,sender):
+    """Get the receivers of a signal for the given sender, or None.
+
+    Django has no public API for this, so we use Signal._live_receivers(),
+    which returns a list of receivers in Django 1.7 (the oldest version we
+    support) up to 4.2.  For anything else this returns None.
+    """
+    try:
+        receivers = signal._live_receivers(sender)
+    except (AttributeError,TypeError):
+        return None
+    if not isinstance(receivers,list) or not all(callable(receiver)
+                                                 for receiver in receivers):
+        return None
+    return receivers
+
+
+def _get_receiver_name(receiver):
+    try:
+        return "%s.%s" % (receiver.__module__,receiver.__name__)
+    except AttributeError:
+        return repr(receiver)
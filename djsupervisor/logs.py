@@ -0,0 +1,211 @@
+"""
+
+djsupervisor.logs:  follow the logs of many processes at once
+-------------------------------------------------------------
+
+This module implements the "supervisor logs" command, which follows the
+output of any number of supervised processes over a single connection to
+supervisord, prefixing each line with the time and the name of the process.
+
+The logs are polled using readProcessStdoutLog() and tailProcessStdoutLog(),
+keeping track of our offset into each log so that only new output is
+transferred.  All the processes that are due to be polled are checked in a
+single multicall, and each process backs off to polling less often while it
+is quiet, so following lots of mostly-idle processes costs very little.
+
+"""
+
+import sys
+import time
+import xmlrpclib
+
+from supervisor.xmlrpc import Faults
+
+
+class LogFollower(object):
+    """Follow the logs of the named processes, writing them to a stream.
+
+    The names may include shell-style wildcards, and are re-checked every
+    refresh_interval seconds so that new processes are picked up.  Each
+    process is polled every min_interval seconds while it's producing
+    output, backing off to every max_interval seconds while it's quiet.
+    Output is read in chunks of at most chunk_size bytes per poll; if a
+    process gets more than max_backlog bytes ahead of us, the excess is
+    skipped.
+    """
+
+    def __init__(self,client,names=(),channel="stdout",initial_bytes=1600,
+                      chunk_size=65536,max_backlog=1048576,
+                      min_interval=0.1,max_interval=5,refresh_interval=5,
+                      stream=None):
+        self.client = client
+        self.names = list(names) or ["*"]
+        self.channel = channel
+        self.initial_bytes = initial_bytes
+        self.chunk_size = chunk_size
+        self.max_backlog = max_backlog
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.refresh_interval = refresh_interval
+        self.stream = stream
+        #  Maps each process name to a dict with its offset into the log,
+        #  its current polling interval, the time it's next due to be polled,
+        #  and any incomplete line of output.
+        self.processes = {}
+        self.unknown = set()
+        self.next_refresh = 0
+        self.width = 0
+
+    def run(self,follow=True):
+        """Follow the logs until interrupted.
+
+        If follow is false, this just prints the end of each log and returns.
+        """
+        if not follow:
+            self.refresh()
+            self.poll()
+            for name in sorted(self.processes):
+                self.flush(name)
+            return
+        while True:
+            now = time.time()
+            if now >= self.next_refresh:
+                self.refresh()
+                self.next_refresh = now + self.refresh_interval
+            self.poll(now)
+            next_poll = min([p["due"] for p in self.processes.itervalues()] +
+                            [self.next_refresh])
+            time.sleep(max(next_poll - time.time(),0))
+
+    def refresh(self):
+        """Update the set of processes to follow."""
+        infos = self.client.get_all_process_info()
+        known = set("%s:%s" % (info["group"],info["name"]) for info in infos)
+        names = self.client.get_process_names(self.names,infos)
+        for name in names:
+            if name not in known:
+                if name not in self.unknown:
+                    self.unknown.add(name)
+                    print>>sys.stderr, "%s: ERROR (no such process)" % (name,)
+            elif name not in self.processes:
+                self.processes[name] = {"offset": None, "partial": "",
+                                        "skip_partial": False,
+                                        "interval": self.min_interval,
+                                        "due": 0}
+        for name in list(self.processes):
+            if name not in known:
+                self.flush(name)
+                del self.processes[name]
+        if self.processes:
+            self.width = max(len(name) for name in self.processes)
+
+    def poll(self,now=None):
+        """Poll the logs of all processes that are due, in a single batch.
+
+        For each process we ask for the current size of its log along with
+        the next chunk from our offset; the size tells us whether there's
+        more to come, or if the log has been rotated.  This returns the
+        number of bytes of output that were read.
+        """
+        if now is None:
+            now = time.time()
+        channel = self.channel.capitalize()
+        tail = "supervisor.tailProcess%sLog" % (channel,)
+        read = "supervisor.readProcess%sLog" % (channel,)
+        names = []
+        calls = []
+        for (name,process) in sorted(self.processes.iteritems()):
+            if process["due"] <= now:
+                names.append(name)
+                if process["offset"] is None:
+                    #  The first poll just gets the end of the existing log.
+                    #  We get an extra byte to see if it starts mid-line.
+                    calls.append([(tail,(name,0,self.initial_bytes + 1))])
+                else:
+                    calls.append([(tail,(name,process["offset"],0)),
+                                  (read,(name,process["offset"],
+                                         self.chunk_size))])
+        if not calls:
+            return 0
+        results = iter(self.client.multicall(c for cs in calls for c in cs))
+        total = 0
+        for (name,process_calls) in zip(names,calls):
+            process_results = [results.next() for _ in process_calls]
+            faults = [result for result in process_results
+                      if isinstance(result,xmlrpclib.Fault)]
+            if faults:
+                if faults[0].faultCode in (Faults.NO_FILE,Faults.BAD_NAME):
+                    print>>sys.stderr, "%s: ERROR (%s)" % (name,
+                                                          faults[0].faultString)
+                    del self.processes[name]
+                    continue
+                raise faults[0]
+            process = self.processes[name]
+            (data,size,overflow) = process_results[0]
+            if process["offset"] is None:
+                offset = size
+                if overflow or len(data) > self.initial_bytes:
+                    if data.startswith("\n"):
+                        data = data[1:]
+                    else:
+                        process["skip_partial"] = True
+            elif size < process["offset"]:
+                #  The log has been truncated or rotated, so start again.
+                (data,offset) = ("",0)
+            else:
+                data = process_results[1]
+                offset = process["offset"] + len(_to_bytes(data))
+                backlog = size - offset
+                if backlog > self.max_backlog:
+                    self.write_output(name,_to_bytes(data))
+                    self.flush(name)
+                    self.write(name,"[%d bytes skipped]" % (backlog,))
+                    (data,offset) = ("",size - self.max_backlog)
+                    process["skip_partial"] = True
+            if data:
+                data = _to_bytes(data)
+                total += len(data)
+                self.write_output(name,data)
+            if size > offset:
+                #  There's more waiting, so come back straight away.
+                process["interval"] = 0
+            elif data:
+                process["interval"] = self.min_interval
+            else:
+                process["interval"] = min(max(process["interval"] * 2,
+                                              self.min_interval),
+                                          self.max_interval)
+            process["offset"] = offset
+            process["due"] = now + process["interval"]
+        return total
+
+    def write_output(self,name,data):
+        """Write out any complete lines of output from the named process."""
+        process = self.processes[name]
+        lines = (process["partial"] + data).split("\n")
+        process["partial"] = lines.pop()
+        if process["skip_partial"] and lines:
+            #  We started reading part-way through a line.
+            lines.pop(0)
+            process["skip_partial"] = False
+        for line in lines:
+            self.write(name,line)
+
+    def flush(self,name):
+        """Write out any incomplete line of output from the named process."""
+        process = self.processes[name]
+        if process["partial"]:
+            self.write(name,process["partial"])
+            process["partial"] = ""
+
+    def write(self,name,line):
+        stream = self.stream or sys.stdout
+        timestamp = time.strftime("%H:%M:%S")
+        stream.write("%s %-*s | %s\n" % (timestamp,self.width,name,line))
+        stream.flush()
+
+
+def _to_bytes(data):
+    if isinstance(data,unicode):
+        return data.encode("utf8")
+    return data
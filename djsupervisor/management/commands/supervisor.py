@@ -25,8 +25,11 @@ The "supervisor" command suports several modes of operation:
 from __future__ import absolute_import, with_statement
 
 import sys
+import errno
 import os
 import time
+import argparse
+import functools
 from textwrap import dedent
 import traceback
 from ConfigParser import RawConfigParser, NoOptionError
@@ -35,18 +38,42 @@ try:
 except ImportError:
     from StringIO import StringIO
 
-from supervisor import supervisord, supervisorctl
-
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 
-from djsupervisor.config import get_merged_config
-from djsupervisor.events import CallbackModifiedHandler
+from djsupervisor.config import PROGRAM_SECTIONS, get_merged_config
 
+ROLLING_RESTART_SETTLE = getattr(settings, "SUPERVISOR_ROLLING_RESTART_SETTLE",
+                                 0)
 AUTORELOAD_PATTERNS = getattr(settings, "SUPERVISOR_AUTORELOAD_PATTERNS",
                               ['*.py'])
 AUTORELOAD_IGNORE = getattr(settings, "SUPERVISOR_AUTORELOAD_IGNORE_PATTERNS", 
                             [".*", "#*", "*~"])
+AUTORELOAD_QUIET_PERIOD = getattr(settings, "SUPERVISOR_AUTORELOAD_QUIET_PERIOD",
+                                  0.5)
+AUTORELOAD_MAX_WAIT = getattr(settings, "SUPERVISOR_AUTORELOAD_MAX_WAIT", 5)
+AUTORELOAD_SELECTIVE = getattr(settings, "SUPERVISOR_AUTORELOAD_SELECTIVE",
+                               False)
+AUTORELOAD_INCLUDE_DIRS = getattr(settings, "SUPERVISOR_AUTORELOAD_INCLUDE_DIRS",
+                                  [])
+AUTORELOAD_EXCLUDE_DIRS = getattr(settings, "SUPERVISOR_AUTORELOAD_EXCLUDE_DIRS",
+                                  ["*/.git", "*/.hg", "*/.svn", "*/.tox",
+                                   "*/node_modules", "*/__pycache__"])
+AUTORELOAD_MAX_WATCHES = getattr(settings, "SUPERVISOR_AUTORELOAD_MAX_WATCHES",
+                                 4096)
+AUTORELOAD_CHECK_CONTENTS = getattr(settings,
+                                    "SUPERVISOR_AUTORELOAD_CHECK_CONTENTS",
+                                    True)
+AUTORELOAD_BATCH_SIZE = getattr(settings, "SUPERVISOR_AUTORELOAD_BATCH_SIZE",
+                                None)
+LISTEN_BATCH_SIZE = getattr(settings, "SUPERVISOR_LISTEN_BATCH_SIZE", 100)
+LISTEN_MAX_PENDING = getattr(settings, "SUPERVISOR_LISTEN_MAX_PENDING", 1000)
+LISTEN_STATS_INTERVAL = getattr(settings, "SUPERVISOR_LISTEN_STATS_INTERVAL",
+                                60)
+HEALTHCHECK_THREADS = getattr(settings, "SUPERVISOR_HEALTHCHECK_THREADS", 32)
+ZYGOTE_PRELOAD = getattr(settings, "SUPERVISOR_ZYGOTE_PRELOAD", [])
+METRICS_HOST = getattr(settings, "SUPERVISOR_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = getattr(settings, "SUPERVISOR_METRICS_PORT", None)
 
 class Command(BaseCommand):
 
@@ -65,6 +92,12 @@ class Command(BaseCommand):
                supervisor start <progname>
                supervisor stop <progname>
                supervisor restart <progname>
+               supervisor rolling-restart <progname>
+               supervisor stats
+               supervisor logs [<progname> ...]
+               supervisor health
+               supervisor diffconfig
+               supervisor applyconfig
 
            """).strip()
 
@@ -153,6 +186,13 @@ class Command(BaseCommand):
             dest="noreload",
             help="don't restart processes when code files change"
         )
+        parser.add_argument(
+            "--refresh-config",
+            action="store_true",
+            dest="refresh_config",
+            default=False,
+            help="ignore any cached copy of the merged config"
+        )
 
     def run_from_argv(self,argv):
         #  Customize option handling so that it doesn't choke on any
@@ -188,18 +228,30 @@ class Command(BaseCommand):
         #  option.  Saves us having to write the config to a tempfile.
         cfg_file = OnDemandStringIO(get_merged_config, **options)
         #  With no arguments, we launch the processes under supervisord.
+        #  The supervisor modules are imported on demand, since they're
+        #  not needed by all of our own commands.
         if not args:
+            from supervisor import supervisord
+            self._write_config_snapshot(**options)
             return supervisord.main(("-c",cfg_file))
         #  With arguments, the first arg specifies the sub-command
         #  Some commands we implement ourself with _handle_<command>.
         #  The rest we just pass on to supervisorctl.
-        if not args[0].isalnum():
+        if not args[0].replace("-","").isalnum():
             raise ValueError("Unknown supervisor command: %s" % (args[0],))
-        methname = "_handle_%s" % (args[0],)
+        methname = "_handle_%s" % (args[0].replace("-","_"),)
         try:
             method = getattr(self,methname)
         except AttributeError:
-            return supervisorctl.main(("-c",cfg_file) + args)
+            from supervisor import supervisorctl
+            try:
+                status = supervisorctl.main(("-c",cfg_file) + args)
+            except SystemExit as e:
+                if not e.code:
+                    self._update_config_snapshot(*args,**options)
+                raise
+            self._update_config_snapshot(*args,**options)
+            return status
         else:
             return method(cfg_file,*args[1:],**options)
 
@@ -209,6 +261,7 @@ class Command(BaseCommand):
 
     def _handle_shell(self,cfg_file,*args,**options):
         """Command 'supervisord shell' runs the interactive command shell."""
+        from supervisor import supervisorctl
         args = ("--interactive",) + args
         return supervisorctl.main(("-c",cfg_file) + args)
 
@@ -219,6 +272,428 @@ class Command(BaseCommand):
         print cfg_file.read()
         return 0
 
+    def _handle_stats(self,cfg_file,*args,**options):
+        """Command 'supervisor stats' shows resource usage of processes.
+
+        This samples the CPU, memory, threads, file descriptors and context
+        switches of each supervised process tree from /proc, and prints them
+        as a table or as lines of JSON.
+        """
+        from djsupervisor import stats
+        from djsupervisor.client import SupervisorClient
+        parser = argparse.ArgumentParser(prog="supervisor stats")
+        parser.add_argument(
+            "--interval",
+            "-i",
+            type=float,
+            default=1,
+            help="seconds between samples"
+        )
+        parser.add_argument(
+            "--count",
+            "-c",
+            type=int,
+            default=1,
+            help="number of samples to print (0 means keep going forever)"
+        )
+        parser.add_argument(
+            "--json",
+            action="store_true",
+            help="print a line of JSON for each process in each sample"
+        )
+        parser.add_argument("process",nargs="*")
+        args = parser.parse_args(args)
+        if not os.path.isdir(stats.PROC_DIR):
+            raise CommandError("supervisor stats requires a /proc filesystem")
+        client = SupervisorClient.from_config(cfg_file.read())
+        prev_samples = None
+        prev_time = None
+        count = 0
+        try:
+            while True:
+                infos = client.get_all_process_info()
+                if args.process:
+                    names = set(client.get_process_names(args.process,infos))
+                    infos = [info for info in infos if "%s:%s" %
+                             (info["group"],info["name"]) in names]
+                now = time.time()
+                samples = stats.sample(infos)
+                if prev_samples is not None:
+                    stats.add_cpu_percent(samples,prev_samples,now-prev_time)
+                    if args.json:
+                        stats.write_json(samples)
+                    else:
+                        if count:
+                            print
+                        stats.write_table(samples)
+                        sys.stdout.flush()
+                    count += 1
+                    if args.count and count >= args.count:
+                        break
+                (prev_samples,prev_time) = (samples,now)
+                time.sleep(args.interval)
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    def _handle_metrics(self,cfg_file,*args,**options):
+        """Command 'supervisor metrics' is the metrics eventlistener.
+
+        This is run by supervisord itself when SUPERVISOR_METRICS_PORT is
+        set.  It speaks the eventlistener protocol on stdin/stdout, so must
+        not print anything else there.
+        """
+        from djsupervisor import metrics
+        from djsupervisor.client import SupervisorClient
+        if args:
+            raise CommandError("supervisor metrics takes no arguments")
+        if not METRICS_PORT:
+            raise CommandError("SUPERVISOR_METRICS_PORT is not set")
+        client = SupervisorClient.from_config(cfg_file.read())
+        metrics.main(client,METRICS_HOST,int(METRICS_PORT))
+        return 0
+
+    def _handle_listen(self,cfg_file,*args,**options):
+        """Command 'supervisor listen' runs a Django-based event listener.
+
+        This is run by supervisord for [eventlistener:<name>] sections that
+        don't give a command of their own.  It sends each batch of events to
+        the receivers of the supervisor_events signal, including any listed
+        in the "handlers" option of the section.
+        """
+        from djsupervisor import listener
+        if len(args) != 1:
+            raise CommandError("supervisor listen takes a listener name")
+        name = args[0]
+        cfg = RawConfigParser()
+        cfg.readfp(cfg_file)
+        section = "eventlistener:" + name
+        if not cfg.has_section(section):
+            raise CommandError("no event listener named '%s'" % (name,))
+        handlers = []
+        if cfg.has_option(section,"handlers"):
+            handlers = cfg.get(section,"handlers").split()
+        listener.main(name,handlers,batch_size=LISTEN_BATCH_SIZE,
+                      max_pending=LISTEN_MAX_PENDING,
+                      stats_interval=LISTEN_STATS_INTERVAL)
+        return 0
+
+    def _handle_logs(self,cfg_file,*args,**options):
+        """Command 'supervisor logs' follows the output of many processes.
+
+        This polls the logs of all the named processes over a single
+        connection, printing each line prefixed with the time and the name
+        of the process it came from.
+        """
+        from djsupervisor.logs import LogFollower
+        from djsupervisor.client import SupervisorClient
+        parser = argparse.ArgumentParser(prog="supervisor logs")
+        parser.add_argument(
+            "--stderr",
+            action="store_true",
+            help="show the stderr logs rather than the stdout logs"
+        )
+        parser.add_argument(
+            "--bytes",
+            "-n",
+            type=int,
+            default=1600,
+            help="number of bytes of existing output to show from each log"
+        )
+        parser.add_argument(
+            "--no-follow",
+            action="store_true",
+            help="show the existing output and exit, rather than following"
+        )
+        parser.add_argument("process",nargs="*")
+        args = parser.parse_args(args)
+        client = SupervisorClient.from_config(cfg_file.read())
+        follower = LogFollower(client,args.process,
+                               channel="stderr" if args.stderr else "stdout",
+                               initial_bytes=max(args.bytes,0))
+        try:
+            follower.run(follow=not args.no_follow)
+        except KeyboardInterrupt:
+            pass
+        except IOError as e:
+            #  Our output was piped into something that has finished.
+            if e.errno != errno.EPIPE:
+                raise
+        return 0
+
+    def _handle_memwatch(self,cfg_file,*args,**options):
+        """Command 'supervisor memwatch' is the memory watchdog listener.
+
+        This is run by supervisord itself when any program has a max_rss
+        option, and restarts processes whose memory usage exceeds it.
+        """
+        from djsupervisor import memwatch
+        from djsupervisor.client import SupervisorClient
+        if args:
+            raise CommandError("supervisor memwatch takes no arguments")
+        data = cfg_file.read()
+        cfg = RawConfigParser()
+        cfg.readfp(StringIO(data))
+        client = SupervisorClient.from_config(data)
+        memwatch.main(client,memwatch.get_limits(cfg))
+        return 0
+
+    def _handle_healthcheck(self,cfg_file,*args,**options):
+        """Command 'supervisor healthcheck' runs the health-check prober.
+
+        This is run by supervisord itself when any program has a healthcheck
+        option.  It probes each process concurrently, and restarts those
+        that repeatedly fail.
+        """
+        from djsupervisor import health
+        from djsupervisor.autoreload import get_own_process_name
+        from djsupervisor.client import SupervisorClient
+        if args:
+            raise CommandError("supervisor healthcheck takes no arguments")
+        data = cfg_file.read()
+        cfg = RawConfigParser()
+        cfg.readfp(StringIO(data))
+        checks = health.get_checks(cfg,get_own_process_name())
+        client = SupervisorClient.from_config(data)
+        state_file = self._get_health_file(**options)
+        checker = health.HealthChecker(client,checks,
+                                       threads=HEALTHCHECK_THREADS,
+                                       state_file=state_file)
+        checker.run()
+        return 0
+
+    def _handle_startup(self,cfg_file,*args,**options):
+        """Command 'supervisor startup' starts programs with dependencies.
+
+        This is run by supervisord itself when any program has a depends_on
+        option.  It starts each such program once everything it depends on
+        is ready, and exits when there is nothing left to start.
+        """
+        from djsupervisor import startup
+        from djsupervisor.client import SupervisorClient
+        if args:
+            raise CommandError("supervisor startup takes no arguments")
+        data = cfg_file.read()
+        cfg = RawConfigParser()
+        cfg.readfp(StringIO(data))
+        try:
+            programs = startup.get_programs(cfg)
+        except ValueError as e:
+            raise CommandError(str(e))
+        client = SupervisorClient.from_config(data)
+        if not startup.Startup(client,programs).run():
+            msg = "some programs were not started, as their dependencies failed"
+            raise CommandError(msg)
+        return 0
+
+    def _handle_zygote(self,cfg_file,*args,**options):
+        """Command 'supervisor zygote' forks preloaded Django processes.
+
+        This is run by supervisord itself when any program has the zygote
+        option.  It imports the management commands those programs run,
+        then forks a worker for each of them on request.
+        """
+        from djsupervisor import zygote
+        from djsupervisor.config import get_zygote_socket
+        if args:
+            raise CommandError("supervisor zygote takes no arguments")
+        cfg = RawConfigParser()
+        cfg.readfp(cfg_file)
+        start_time = time.time()
+        zygote.preload(zygote.get_subcommands(cfg),ZYGOTE_PRELOAD)
+        spawner = zygote.Zygote(get_zygote_socket(options.get("project_dir")))
+        spawner.log("preloaded in %.2fs" % (time.time() - start_time,))
+        spawner.run()
+        return 0
+
+    def _handle_health(self,cfg_file,*args,**options):
+        """Command 'supervisor health' shows the latest health-check results.
+
+        This shows the status and probe latency of each process that has
+        a health check, as last recorded by the health-check prober.
+        """
+        from djsupervisor import health
+        if args:
+            raise CommandError("supervisor health takes no arguments")
+        state = health.read_state(self._get_health_file(**options))
+        if state is None:
+            raise CommandError("no health checks have been run")
+        health.write_table(state)
+        return 0
+
+    def _get_health_file(self,**options):
+        """Get the path to the file recording health-check results."""
+        from djsupervisor.config import get_cache_file, guess_project_dir
+        project_dir = options.get("project_dir") or guess_project_dir()
+        return get_cache_file(project_dir,"health.json")
+
+    def _handle_diffconfig(self,cfg_file,*args,**options):
+        """Command 'supervisor diffconfig' shows changes to the config.
+
+        This has supervisord re-read its config, then reports which process
+        groups have been added, removed or changed, and for changed groups
+        which options are different and whether they need a restart.
+        """
+        if args:
+            raise CommandError("supervisor diffconfig takes no arguments")
+        self._diff_config(cfg_file,False,False,**options)
+        return 0
+
+    def _handle_applyconfig(self,cfg_file,*args,**options):
+        """Command 'supervisor applyconfig' applies changes to the config.
+
+        This is like "supervisorctl update", but it only touches the groups
+        that have actually changed.  Groups in which only options such as
+        autostart or priority have changed are not restarted; they are
+        skipped until applyconfig is run while the group is stopped, or
+        updated immediately if the --force argument is given.
+        """
+        force = False
+        if args == ("--force",):
+            force = True
+        elif args:
+            raise CommandError("usage: supervisor applyconfig [--force]")
+        failures = self._diff_config(cfg_file,True,force,**options)
+        for (name,error) in failures:
+            print>>sys.stderr, "%s: ERROR (%s)" % (name,error)
+        if failures:
+            raise CommandError("failed to apply config changes")
+        return 0
+
+    def _diff_config(self,cfg_file,do_apply,force,**options):
+        """Report, and optionally apply, changes to the running config."""
+        from djsupervisor import diff
+        from djsupervisor.client import SupervisorClient
+        cfg_data = cfg_file.read()
+        client = SupervisorClient.from_config(cfg_data)
+        [[added,changed,removed]] = client.call("supervisor.reloadConfig")
+        (snapshot_file,key) = self._get_config_snapshot_file(**options)
+        old = diff.read_snapshot(snapshot_file,key) or {}
+        new = diff.get_process_configs(cfg_data)
+        changes = diff.get_changes(added,changed,removed,old,new)
+        if not changes:
+            print "no changes"
+            return []
+        for (group,action,changed_options) in changes:
+            if action == "add":
+                print "%s: added" % (group,)
+            elif action == "remove":
+                print "%s: removed" % (group,)
+            elif action == "restart":
+                print "%s: changed, needs restart (%s)" \
+                      % (group,", ".join(changed_options) or "unknown")
+            else:
+                print "%s: changed, applied once stopped or with --force"\
+                      " (%s)" % (group,", ".join(changed_options))
+        if not do_apply:
+            return []
+        (applied,failures) = diff.apply_changes(client,changes,force)
+        for group in applied:
+            print "%s: updated" % (group,)
+            if group in new:
+                old[group] = new[group]
+            else:
+                old.pop(group,None)
+        diff.write_snapshot(snapshot_file,key,old)
+        return failures
+
+    def _write_config_snapshot(self,**options):
+        """Record the config that supervisord is about to be launched with.
+
+        This is used by the diffconfig and applyconfig commands.  If there's
+        already a supervisord running then we leave its snapshot alone.
+        """
+        import socket
+        from djsupervisor import diff
+        from djsupervisor.client import SupervisorClient
+        cfg_data = get_merged_config(**options)
+        try:
+            SupervisorClient.from_config(cfg_data).call("supervisor.getPID")
+        except socket.error:
+            (snapshot_file,key) = self._get_config_snapshot_file(**options)
+            snapshot = diff.get_process_configs(cfg_data)
+            diff.write_snapshot(snapshot_file,key,snapshot)
+        except Exception:
+            pass
+
+    def _update_config_snapshot(self,command,*args,**options):
+        """Bring the config snapshot up to date after a supervisorctl command.
+
+        Commands such as "update" change the running config behind our back,
+        so the snapshot entries for the groups they touch are replaced with
+        the current config.  Other commands leave the snapshot alone.
+        """
+        if command not in ("update","add","remove","reload"):
+            return
+        from djsupervisor import diff
+        (snapshot_file,key) = self._get_config_snapshot_file(**options)
+        old = diff.read_snapshot(snapshot_file,key) or {}
+        new = diff.get_process_configs(get_merged_config(**options))
+        groups = set(arg.split(":",1)[0] for arg in args)
+        if command == "reload" or (command == "update" and
+                                   (not groups or "all" in groups)):
+            groups = set(old) | set(new)
+        for group in groups:
+            if group in new and command != "remove":
+                old[group] = new[group]
+            else:
+                old.pop(group,None)
+        diff.write_snapshot(snapshot_file,key,old)
+
+    def _get_config_snapshot_file(self,**options):
+        """Get the path and cache key for the running config snapshot."""
+        from djsupervisor import cache
+        from djsupervisor.config import get_cache_file, guess_project_dir
+        project_dir = options.get("project_dir") or guess_project_dir()
+        snapshot_file = get_cache_file(project_dir,"running-config.json")
+        return (snapshot_file,cache.fingerprint(os.path.abspath(project_dir)))
+
+    def _handle_rolling_restart(self,cfg_file,*args,**options):
+        """Command 'supervisor rolling-restart' restarts a few at a time.
+
+        This restarts the named processes in batches, waiting for each batch
+        to come back up before moving on to the next, so that a group of
+        processes never entirely stops serving.  It gives up as soon as any
+        process fails to restart.
+        """
+        from djsupervisor.client import SupervisorClient
+        parser = argparse.ArgumentParser(prog="supervisor rolling-restart")
+        parser.add_argument(
+            "--batch-size",
+            "-b",
+            default="1",
+            help="number of processes to restart at a time,"
+                 " or a percentage such as 25%%"
+        )
+        parser.add_argument(
+            "--settle",
+            "-s",
+            type=float,
+            default=ROLLING_RESTART_SETTLE,
+            help="seconds that each batch must stay up before moving on"
+        )
+        parser.add_argument(
+            "--timeout",
+            "-t",
+            type=float,
+            default=None,
+            help="seconds to wait for each batch to stop and start"
+        )
+        parser.add_argument("process",nargs="+")
+        args = parser.parse_args(args)
+        client = SupervisorClient.from_config(cfg_file.read())
+
+        def progress(batch):
+            print "restarting %s" % (" ".join(batch),)
+
+        failures = client.rolling_restart(args.process,args.batch_size,
+                                          args.settle,args.timeout,progress)
+        for (name,error) in failures:
+            print>>sys.stderr, "%s: ERROR (%s)" % (name,error)
+        if failures:
+            raise CommandError("rolling restart aborted")
+        return 0
+
     def _handle_autoreload(self,cfg_file,*args,**options):
         """Command 'supervisor autoreload' watches for code changes.
 
@@ -230,39 +705,64 @@ class Command(BaseCommand):
         that have been loaded. Instead, it tries to watch all python files
         that are "nearby" the files loaded at startup by Django.
         """
+        from djsupervisor.events import CallbackModifiedHandler
+        from djsupervisor.client import SupervisorClient
+        from djsupervisor.autoreload import AutoReloader, ContentIndex
+        from djsupervisor.config import get_cache_file, guess_project_dir
         if args:
             raise CommandError("supervisor autoreload takes no arguments")
-        live_dirs = self._find_live_code_dirs()
-        reload_progs = self._get_autoreload_programs(cfg_file)
-
-        def autoreloader():
-            """
-            Forks a subprocess to make the restart call.
-            Otherwise supervisord might kill us and cancel the restart!
-            """
-            if os.fork() == 0:
-                sys.exit(self.handle("restart", *reload_progs, **options))
-
-        # Call the autoreloader callback whenever a .py file changes.
-        # To prevent thrashing, limit callbacks to one per second.
-        handler = CallbackModifiedHandler(callback=autoreloader,
-                                          repeat_delay=1,
+        project_dir = options.get("project_dir") or guess_project_dir()
+        watches = self._plan_watches()
+        cfg_data = cfg_file.read()
+        reload_progs = self._get_autoreload_programs(StringIO(cfg_data))
+
+        # Restarts are made over a persistent connection to supervisord,
+        # from a background thread so they don't block the observer.
+        # Saves that don't actually change a file's contents are ignored.
+        client = SupervisorClient.from_config(cfg_data)
+        content_index = None
+        if AUTORELOAD_CHECK_CONTENTS:
+            content_index = ContentIndex(get_cache_file(project_dir,
+                                                        "content-index.json"))
+        autoreloader = AutoReloader(client,reload_progs,
+                                    selective=AUTORELOAD_SELECTIVE,
+                                    content_index=content_index,
+                                    batch_size=AUTORELOAD_BATCH_SIZE)
+
+        # Call the autoreloader whenever a .py file changes.
+        # To prevent thrashing, wait for a burst of changes to settle
+        # (e.g. during a git checkout) before restarting.
+        handler = CallbackModifiedHandler(callback=autoreloader.trigger,
+                                          quiet_period=AUTORELOAD_QUIET_PERIOD,
+                                          max_wait=AUTORELOAD_MAX_WAIT,
                                           patterns=AUTORELOAD_PATTERNS,
                                           ignore_patterns=AUTORELOAD_IGNORE,
                                           ignore_directories=True)
 
+        # Hash the watched files in the background, so that the first save
+        # of a file without changing it can be ignored too.
+        if content_index is not None:
+            content_index.seed(watches,AUTORELOAD_PATTERNS,AUTORELOAD_IGNORE)
+
         # Try to add watches using the platform-specific observer.
-        # If this fails, print a warning and fall back to the PollingObserver.
+        # If this fails, print a warning and fall back to polling.
         # This will avoid errors with e.g. too many inotify watches.
+        # Our polling observer only looks at files matching the patterns,
+        # and saves its index in the cache dir to speed up the next start.
         from watchdog.observers import Observer
-        from watchdog.observers.polling import PollingObserver
-        
+        from djsupervisor.polling import IndexedPollingObserver
+        PollingObserver = functools.partial(IndexedPollingObserver,
+                                    patterns=AUTORELOAD_PATTERNS,
+                                    ignore_patterns=AUTORELOAD_IGNORE,
+                                    index_dir=get_cache_file(project_dir,
+                                                             "poll-index"))
+
         observer = None
         for ObserverCls in (Observer, PollingObserver):
             observer = ObserverCls()
             try:
-                for live_dir in set(live_dirs):
-                    observer.schedule(handler, live_dir, True)
+                for (watch_dir, recursive) in watches:
+                    observer.schedule(handler, watch_dir, recursive)
                 break
             except Exception:
                 print>>sys.stderr, "COULD NOT WATCH FILESYSTEM USING"
@@ -291,15 +791,16 @@ class Command(BaseCommand):
     def _get_autoreload_programs(self,cfg_file):
         """Get the set of programs to auto-reload when code changes.
 
-        Such programs will have autoreload=true in their config section.
-        This can be affected by config file sections or command-line
-        arguments, so we need to read it out of the merged config.
+        Such programs will have autoreload=true in their config section,
+        which also applies to event listeners.  This can be affected by config
+        file sections or command-line arguments, so we need to read it out of
+        the merged config.
         """
         cfg = RawConfigParser()
         cfg.readfp(cfg_file)
         reload_progs = []
         for section in cfg.sections():
-            if section.startswith("program:"):
+            if section.startswith(PROGRAM_SECTIONS + ("eventlistener:",)):
                 try:
                     if cfg.getboolean(section,"autoreload"):
                         reload_progs.append(section.split(":",1)[1])
@@ -307,39 +808,26 @@ class Command(BaseCommand):
                     pass
         return reload_progs
 
-    def _find_live_code_dirs(self):
-        """Find all directories in which we might have live python code.
+    def _plan_watches(self):
+        """Plan which directories to watch for code changes.
 
-        This walks all of the currently-imported modules and adds their
-        containing directory to the list of live dirs.  After normalization
-        and de-duplication, we get a pretty good approximation of the
-        directories on sys.path that are actively in use.
+        This starts from the directories containing all currently-imported
+        modules, but leaves out the stdlib, installed third-party packages
+        and any SUPERVISOR_AUTORELOAD_EXCLUDE_DIRS, and keeps the number of
+        watched directories within SUPERVISOR_AUTORELOAD_MAX_WATCHES so that
+        the native observer can be used.
         """
-        live_dirs = []
-        for mod in sys.modules.values():
-            #  Get the directory containing that module.
-            #  This is deliberately casting a wide net.
-            try:
-                dirnm = os.path.dirname(mod.__file__)
-            except AttributeError:
-                continue
-            #  Normalize it for comparison purposes.
-            dirnm = os.path.realpath(os.path.abspath(dirnm))
-            if not dirnm.endswith(os.sep):
-                dirnm += os.sep
-            #  Check that it's not an egg or some other wierdness
-            if not os.path.isdir(dirnm):
-                continue
-            #  If it's a subdir of one we've already found, ignore it.
-            for dirnm2 in live_dirs:
-                if dirnm.startswith(dirnm2):
-                    break
-            else:
-                #  Remove any ones we've found that are subdirs of it.
-                live_dirs = [dirnm2 for dirnm2 in live_dirs\
-                                    if not dirnm2.startswith(dirnm)]
-                live_dirs.append(dirnm)
-        return live_dirs
+        from djsupervisor.autoreload import find_live_code_dirs, plan_watches
+        (watches,num_watches,skipped) = plan_watches(find_live_code_dirs(),
+                                                     AUTORELOAD_INCLUDE_DIRS,
+                                                     AUTORELOAD_EXCLUDE_DIRS,
+                                                     AUTORELOAD_MAX_WATCHES)
+        for dirnm in skipped:
+            print>>sys.stderr, "autoreload: not watching %s;"\
+                               " it exceeds the watch budget" % (dirnm,)
+        print>>sys.stderr, "autoreload: planned %d watches from %d roots"\
+                           % (num_watches,len(watches))
+        return watches
 
 
 class OnDemandStringIO(object):
@@ -0,0 +1,116 @@
+"""
+
+djsupervisor.memwatch:  restart processes that use too much memory
+------------------------------------------------------------------
+
+This module implements the "supervisor memwatch" command, a supervisord
+eventlistener that is added to the config whenever a program has a max_rss
+option.  On each TICK event it samples the resident memory of every process
+tree from /proc, and restarts any process whose tree has stayed above its
+program's max_rss for at least max_rss_window seconds.
+
+Only one process is restarted per TICK, so that a group of workers which
+all grow at the same rate isn't taken down at once.
+
+"""
+
+import sys
+import time
+import traceback
+
+from supervisor import childutils
+
+from djsupervisor import stats
+from djsupervisor.config import PROGRAM_SECTIONS, get_process_names
+from djsupervisor.host import parse_bytes
+
+
+def get_limits(cfg):
+    """Get the memory limits for each process from the merged config.
+
+    This returns a dict mapping the "group:name" of each process of each
+    program with a max_rss option to a (max_rss,window) tuple, with max_rss
+    in bytes and window in seconds.
+    """
+    limits = {}
+    for section in cfg.sections():
+        if not section.startswith(PROGRAM_SECTIONS):
+            continue
+        if not cfg.has_option(section,"max_rss"):
+            continue
+        max_rss = parse_bytes(cfg.get(section,"max_rss"))
+        window = 0
+        if cfg.has_option(section,"max_rss_window"):
+            window = float(cfg.get(section,"max_rss_window"))
+        for name in get_process_names(cfg,section):
+            limits[name] = (max_rss,window)
+    return limits
+
+
+def main(client,limits,stdin=None,stdout=None):
+    """Run the memory watchdog eventlistener."""
+    if stdin is None:
+        stdin = sys.stdin
+    if stdout is None:
+        stdout = sys.stdout
+    watchdog = MemoryWatchdog(client,limits)
+    while True:
+        (headers,payload) = childutils.listener.wait(stdin,stdout)
+        if headers["eventname"].startswith("TICK_"):
+            try:
+                watchdog.check()
+            except Exception:
+                traceback.print_exc()
+        childutils.listener.ok(stdout)
+
+
+class MemoryWatchdog(object):
+    """Restart processes whose process tree exceeds their RSS limit."""
+
+    def __init__(self,client,limits,proc_dir=stats.PROC_DIR,stream=None):
+        self.client = client
+        self.limits = limits
+        self.proc_dir = proc_dir
+        self.stream = stream
+        #  Maps (name,pid) of processes over their limit to the time at
+        #  which they were first seen over it.
+        self.over_since = {}
+
+    def check(self,now=None):
+        """Check the memory usage of all limited processes.
+
+        This restarts the worst offender that has been over its limit for
+        long enough, if any, and returns its name.
+        """
+        if now is None:
+            now = time.time()
+        infos = [info for info in self.client.get_all_process_info()
+                 if "%s:%s" % (info["group"],info["name"]) in self.limits
+                 and info["statename"] == "RUNNING"]
+        over_since = {}
+        candidates = []
+        for s in stats.sample(infos,self.proc_dir):
+            (max_rss,window) = self.limits[s["name"]]
+            if s["rss"] <= max_rss:
+                continue
+            key = (s["name"],s["pid"])
+            since = over_since[key] = self.over_since.get(key,now)
+            if now - since >= window:
+                candidates.append((s["rss"] - max_rss,s,max_rss,now - since))
+        self.over_since = over_since
+        if not candidates:
+            return None
+        (_,s,max_rss,elapsed) = max(candidates)
+        self.log("restarting %s (pid %d), RSS of %s is over its limit of %s "
+                 "(for %ds)" % (s["name"],s["pid"],stats.format_bytes(s["rss"]),
+                                stats.format_bytes(max_rss),elapsed))
+        failures = self.client.restart([s["name"]])
+        for (name,error) in failures:
+            self.log("%s failed to restart: %s" % (name,error))
+        del self.over_since[(s["name"],s["pid"])]
+        return s["name"]
+
+    def log(self,msg):
+        stream = self.stream or sys.stderr
+        print>>stream, "memwatch: %s" % (msg,)
+        stream.flush()
@@ -0,0 +1,240 @@
+"""
+
+djsupervisor.metrics:  export process metrics from a supervisord eventlistener
+------------------------------------------------------------------------------
+
+This module implements the "supervisor metrics" command, which runs as a
+supervisord eventlistener.  It subscribes to PROCESS_STATE and TICK events
+and keeps track of the state of every process, serving the results over
+HTTP in the Prometheus text format.
+
+Since supervisord pushes every state change to us, there's no need to poll
+it over XML-RPC.  We make a single getAllProcessInfo() call at startup to
+learn the existing state of things, and a getProcessInfo() call when a
+process exits to find out its exit status.
+
+"""
+
+import sys
+import time
+import threading
+import traceback
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from supervisor import childutils
+from supervisor.states import ProcessStates, getProcessStateDescription
+
+STATE_NAMES = sorted(getProcessStateDescription(code)
+                     for code in ProcessStates.__dict__.values()
+                     if isinstance(code,int))
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def main(client,host,port,stdin=None,stdout=None):
+    """Run the metrics eventlistener, serving metrics on the given port."""
+    if stdin is None:
+        stdin = sys.stdin
+    if stdout is None:
+        stdout = sys.stdout
+    store = MetricsStore()
+    store.load(client.get_all_process_info())
+    server = serve(store,host,port)
+    print>>sys.stderr, "serving metrics on http://%s:%d/metrics" \
+                       % server.server_address[:2]
+    while True:
+        (headers,payload) = childutils.listener.wait(stdin,stdout)
+        try:
+            handle_event(store,client,headers,payload)
+        except Exception:
+            traceback.print_exc()
+        childutils.listener.ok(stdout)
+
+
+def handle_event(store,client,headers,payload):
+    """Update the metrics store in response to a single event."""
+    eventname = headers["eventname"]
+    if eventname.startswith("TICK_"):
+        store.tick(int(childutils.get_headers(payload)["when"]))
+    elif eventname.startswith("PROCESS_STATE_"):
+        state = eventname[len("PROCESS_STATE_"):]
+        info = childutils.get_headers(payload.split("\n",1)[0])
+        name = "%s:%s" % (info["groupname"],info["processname"])
+        exitstatus = None
+        if state == "EXITED":
+            try:
+                exitstatus = client.call("supervisor.getProcessInfo",
+                                         name)["exitstatus"]
+            except Exception:
+                pass
+        store.set_state(info["groupname"],info["processname"],
+                        state,info["from_state"],exitstatus=exitstatus)
+
+
+class MetricsStore(object):
+    """Thread-safe store of the metrics for each process."""
+
+    def __init__(self):
+        self.processes = {}
+        self.last_tick = None
+        self._lock = threading.Lock()
+
+    def load(self,infos):
+        """Initialize the store from a list of process info dicts."""
+        with self._lock:
+            for info in infos:
+                process = self._get_process(info["group"],info["name"])
+                process["state"] = info["statename"]
+                if info["statename"] == "RUNNING":
+                    process["since"] = info["start"]
+                elif info["stop"]:
+                    process["since"] = info["stop"]
+                if info["statename"] == "EXITED":
+                    process["exitstatus"] = info["exitstatus"]
+
+    def set_state(self,group,name,state,from_state,exitstatus=None,now=None):
+        """Record that a process has changed state."""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            process = self._get_process(group,name)
+            if process["state"] is not None:
+                elapsed = max(now - process["since"],0)
+                process["state_seconds"][process["state"]] += elapsed
+            process["state"] = state
+            process["since"] = now
+            if state == "STARTING":
+                process["starts"] += 1
+                if from_state in ("EXITED","BACKOFF"):
+                    process["restarts"] += 1
+            elif state == "EXITED":
+                process["exits"] += 1
+                if exitstatus is not None:
+                    process["exitstatus"] = exitstatus
+
+    def tick(self,when):
+        """Record a TICK event from supervisord."""
+        with self._lock:
+            self.last_tick = when
+
+    def render(self,now=None):
+        """Render all the metrics in the Prometheus text format."""
+        if now is None:
+            now = time.time()
+        lines = []
+        def metric(name,kind,help,samples):
+            lines.append("# HELP %s %s" % (name,help))
+            lines.append("# TYPE %s %s" % (name,kind))
+            for (labels,value) in samples:
+                if labels:
+                    labels = "{%s}" % (",".join('%s="%s"' % (k,_escape(v))
+                                                for (k,v) in labels),)
+                else:
+                    labels = ""
+                lines.append("%s%s %s" % (name,labels,_format(value)))
+        with self._lock:
+            processes = sorted(self.processes.iteritems())
+            state = []
+            uptime = []
+            state_seconds = []
+            starts = []
+            restarts = []
+            exits = []
+            exitstatus = []
+            for ((group,name),process) in processes:
+                labels = (("group",group),("name",name))
+                current = process["state"]
+                elapsed = 0
+                if current is not None:
+                    elapsed = max(now - process["since"],0)
+                for state_name in STATE_NAMES:
+                    state_labels = labels + (("state",state_name),)
+                    state.append((state_labels,int(state_name == current)))
+                    seconds = process["state_seconds"][state_name]
+                    if state_name == current:
+                        seconds += elapsed
+                    state_seconds.append((state_labels,seconds))
+                uptime.append((labels,elapsed if current == "RUNNING" else 0))
+                starts.append((labels,process["starts"]))
+                restarts.append((labels,process["restarts"]))
+                exits.append((labels,process["exits"]))
+                if process["exitstatus"] is not None:
+                    exitstatus.append((labels,process["exitstatus"]))
+            last_tick = self.last_tick
+        metric("supervisor_process_state","gauge",
+               "Whether the process is in the given state.",state)
+        metric("supervisor_process_uptime_seconds","gauge",
+               "Seconds since the process entered the RUNNING state.",uptime)
+        metric("supervisor_process_state_seconds_total","counter",
+               "Seconds the process has spent in each state.",state_seconds)
+        metric("supervisor_process_starts_total","counter",
+               "Number of times the process has been started.",starts)
+        metric("supervisor_process_restarts_total","counter",
+               "Number of times the process was restarted after exiting.",
+               restarts)
+        metric("supervisor_process_exits_total","counter",
+               "Number of times the process has exited.",exits)
+        metric("supervisor_process_exit_status","gauge",
+               "Exit status of the last time the process exited.",exitstatus)
+        if last_tick is not None:
+            metric("supervisor_last_tick_timestamp_seconds","gauge",
+                   "Time of the last TICK event from supervisord.",
+                   [((),last_tick)])
+        return "\n".join(lines) + "\n"
+
+    def _get_process(self,group,name):
+        try:
+            return self.processes[(group,name)]
+        except KeyError:
+            process = {
+                "state": None,
+                "since": time.time(),
+                "state_seconds": dict((state,0) for state in STATE_NAMES),
+                "starts": 0,
+                "restarts": 0,
+                "exits": 0,
+                "exitstatus": None,
+            }
+            self.processes[(group,name)] = process
+            return process
+
+
+class MetricsServer(ThreadingMixIn,HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        data = self.server.store.render().encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type",CONTENT_TYPE)
+        self.send_header("Content-Length",str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self,format,*args):
+        pass
+
+
+def serve(store,host,port):
+    """Serve the metrics from the given store, in a background thread."""
+    server = MetricsServer((host,port),MetricsHandler)
+    server.store = store
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _escape(value):
+    value = unicode(value)
+    return value.replace("\\","\\\\").replace("\"","\\\"").replace("\n","\\n")
+
+
+def _format(value):
+    if isinstance(value,float):
+        return repr(value)
+    return str(value)
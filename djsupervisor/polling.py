@@ -0,0 +1,189 @@
+"""
+
+djsupervisor.polling:  lightweight polling observer for autoreload
+------------------------------------------------------------------
+
+This module provides IndexedPollingObserver, a replacement for watchdog's
+PollingObserver that is used when native filesystem events are unavailable.
+
+Rather than re-reading and comparing a full snapshot of every directory tree
+on each poll, it keeps an index of the files it has seen.  Only files that
+match the autoreload patterns are stat'ed, directories are only re-listed
+when their own mtime changes, and the polling interval backs off while
+nothing is changing.  The index can be saved to disk so that a restarted
+autoreload process doesn't have to begin with a full cold scan.
+
+"""
+
+import os
+import json
+import time
+import functools
+
+from watchdog.events import FileCreatedEvent, FileDeletedEvent
+from watchdog.events import FileModifiedEvent
+from watchdog.observers.api import BaseObserver, EventEmitter
+from watchdog.observers.api import DEFAULT_OBSERVER_TIMEOUT
+try:
+    from watchdog.utils.patterns import match_any_paths
+except ImportError:
+    from pathtools.patterns import match_any_paths
+
+from djsupervisor import cache
+
+#  Directory listings are only trusted if the directory's mtime is at least
+#  this many seconds old, in case the filesystem has coarse timestamps.
+MTIME_GRANULARITY = 2
+
+
+class IndexedPollingObserver(BaseObserver):
+    """Observer that polls for changes using an incremental index.
+
+    Only files matching the given patterns are reported.  The polling
+    interval starts at min_interval seconds, and doubles up to max_interval
+    for as long as nothing changes.  If index_dir is given then the index
+    for each watched directory is saved there.
+    """
+
+    def __init__(self,patterns=None,ignore_patterns=None,index_dir=None,
+                      min_interval=1,max_interval=10,
+                      timeout=DEFAULT_OBSERVER_TIMEOUT):
+        emitter_class = functools.partial(IndexedPollingEmitter,
+                                          patterns=patterns,
+                                          ignore_patterns=ignore_patterns,
+                                          index_dir=index_dir,
+                                          min_interval=min_interval,
+                                          max_interval=max_interval)
+        BaseObserver.__init__(self,emitter_class=emitter_class,timeout=timeout)
+
+
+class IndexedPollingEmitter(EventEmitter):
+    """Emitter that polls a single watched directory using an index."""
+
+    def __init__(self,event_queue,watch,timeout=DEFAULT_OBSERVER_TIMEOUT,
+                      patterns=None,ignore_patterns=None,index_dir=None,
+                      min_interval=1,max_interval=10):
+        EventEmitter.__init__(self,event_queue,watch,timeout)
+        self.patterns = patterns
+        self.ignore_patterns = ignore_patterns
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.index_file = None
+        if index_dir is not None:
+            key = cache.fingerprint(watch.path,watch.is_recursive,
+                                    patterns,ignore_patterns)
+            self.index_file = os.path.join(index_dir,key + ".json")
+        self.dirs = None
+        self.files = None
+
+    def on_thread_start(self):
+        (self.dirs,self.files) = self.load_index()
+        #  Establish a baseline without reporting any events; the processes
+        #  being watched will have just started with the current code anyway.
+        (self.dirs,self.files) = self.scan()
+        self.save_index()
+
+    def on_thread_stop(self):
+        self.save_index()
+
+    def queue_events(self,timeout):
+        if self.stopped_event.wait(self.interval):
+            return
+        (dirs,files) = self.scan()
+        changed = False
+        for (path,stat) in files.iteritems():
+            old_stat = self.files.get(path)
+            if old_stat is None:
+                self.queue_event(FileCreatedEvent(path))
+                changed = True
+            elif old_stat != stat:
+                self.queue_event(FileModifiedEvent(path))
+                changed = True
+        for path in self.files:
+            if path not in files:
+                self.queue_event(FileDeletedEvent(path))
+                changed = True
+        (self.dirs,self.files) = (dirs,files)
+        if changed:
+            self.interval = self.min_interval
+            self.save_index()
+        else:
+            self.interval = min(self.interval * 2,self.max_interval)
+
+    def scan(self):
+        """Scan the watched directory, returning a new (dirs,files) index.
+
+        The dirs index maps each directory to a list [mtime,files,subdirs]
+        giving its matching files and subdirectories, and the files index
+        maps each matching file to a list [mtime,size].
+        """
+        dirs = {}
+        files = {}
+        stack = [self.watch.path]
+        while stack:
+            dirnm = stack.pop()
+            try:
+                mtime = os.stat(dirnm).st_mtime
+            except EnvironmentError:
+                continue
+            listing = (self.dirs or {}).get(dirnm)
+            if listing is None or listing[0] != mtime:
+                listing = self.list_dir(dirnm)
+                if listing is None:
+                    continue
+                #  Don't trust the mtime if it might not have ticked over yet.
+                if mtime > time.time() - MTIME_GRANULARITY:
+                    listing[0] = None
+                else:
+                    listing[0] = mtime
+            dirs[dirnm] = listing
+            for filenm in listing[1]:
+                try:
+                    st = os.stat(filenm)
+                except EnvironmentError:
+                    continue
+                files[filenm] = [st.st_mtime,st.st_size]
+            stack.extend(listing[2])
+        return (dirs,files)
+
+    def list_dir(self,dirnm):
+        """List a directory, returning [None,files,subdirs] or None."""
+        try:
+            names = os.listdir(dirnm)
+        except EnvironmentError:
+            return None
+        filenms = []
+        subdirs = []
+        for name in names:
+            path = os.path.join(dirnm,name)
+            if os.path.isdir(path):
+                if self.watch.is_recursive and not os.path.islink(path):
+                    subdirs.append(path)
+            elif match_any_paths([path],
+                                 included_patterns=self.patterns,
+                                 excluded_patterns=self.ignore_patterns):
+                filenms.append(path)
+        return [None,filenms,subdirs]
+
+    def load_index(self):
+        """Load the saved (dirs,files) index, if there is one."""
+        if self.index_file is None:
+            return (None,None)
+        try:
+            with open(self.index_file,"r") as f:
+                index = json.load(f)
+            return (index["dirs"],index["files"])
+        except (EnvironmentError,ValueError,KeyError):
+            return (None,None)
+
+    def save_index(self):
+        """Save the current index, if we have somewhere to put it."""
+        if self.index_file is None or self.files is None:
+            return
+        data = json.dumps({"dirs": self.dirs, "files": self.files})
+        try:
+            cache.atomic_write(self.index_file,data)
+        except EnvironmentError:
+            pass
+
@@ -0,0 +1,13 @@
+"""
+
+djsupervisor.signals:  django signals sent by djsupervisor
+----------------------------------------------------------
+
+"""
+
+from django.dispatch import Signal
+
+#  Sent by "supervisor listen" for each batch of events from supervisord.
+#  The sender is the name of the event listener, which is also passed as
+#  the "listener" argument, and "events" is a list of listener.Event tuples.
+supervisor_events = Signal(providing_args=["listener","events"])
@@ -0,0 +1,135 @@
+"""
+
+djsupervisor.spawn:  run a manage.py command by forking it from the zygote
+--------------------------------------------------------------------------
+
+This script is the command that supervisord runs for programs with the
+zygote option.  It is deliberately tiny and doesn't import Django, or even
+the rest of djsupervisor.  It hands its stdin, stdout and stderr to the
+zygote over a unix socket, asks it to fork a worker that runs the given
+manage.py command, and then stands in for that worker: signals sent to it
+by supervisord are passed on to the worker, and it exits with the same
+status as the worker did.
+
+If the zygote can't be reached within CONNECT_TIMEOUT seconds, it runs the
+manage.py command itself instead.
+
+Usage:  python spawn.py <socket> <manage.py> [<args>...]
+
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import signal
+import socket
+import _multiprocessing
+
+CONNECT_TIMEOUT = 10
+
+#  Signals that are passed on to the worker.
+FORWARD_SIGNALS = ("SIGHUP","SIGINT","SIGQUIT","SIGTERM","SIGUSR1","SIGUSR2")
+
+
+class Channel(object):
+    """Newline-delimited JSON messages over a unix socket.
+
+    Each end first sends its file descriptors (if any) with send_fds(), and
+    then exchanges messages.
+    """
+
+    def __init__(self,sock):
+        self.sock = sock
+        self.buffer = ""
+
+    def send_fds(self,fds):
+        for fd in fds:
+            _multiprocessing.sendfd(self.sock.fileno(),fd)
+
+    def recv_fds(self,count):
+        return [_multiprocessing.recvfd(self.sock.fileno())
+                for _ in xrange(count)]
+
+    def send(self,msg):
+        self.sock.sendall(json.dumps(msg) + "\n")
+
+    def recv(self):
+        """Receive the next message, or None if the other end has gone."""
+        while "\n" not in self.buffer:
+            try:
+                data = self.sock.recv(4096)
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not data:
+                return None
+            self.buffer += data
+        (line,self.buffer) = self.buffer.split("\n",1)
+        return json.loads(line)
+
+
+def connect(socket_path,timeout=CONNECT_TIMEOUT):
+    """Connect to the zygote, waiting for it to start if necessary.
+
+    This returns None if it doesn't start listening within the timeout.
+    """
+    deadline = time.time() + timeout
+    while True:
+        sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        try:
+            sock.connect(socket_path)
+        except socket.error as e:
+            sock.close()
+            if e.args[0] not in (errno.ENOENT,errno.ECONNREFUSED):
+                raise
+            if time.time() >= deadline:
+                return None
+            time.sleep(0.1)
+        else:
+            return sock
+
+
+def main(argv):
+    if len(argv) < 2:
+        print>>sys.stderr, __doc__.strip()
+        return 2
+    (socket_path,command) = (argv[0],argv[1:])
+    sock = connect(socket_path)
+    if sock is None:
+        print>>sys.stderr, "spawn: zygote not listening on %s, running "\
+                           "command directly" % (socket_path,)
+        sys.stderr.flush()
+        os.execv(sys.executable,[sys.executable] + command)
+    channel = Channel(sock)
+    channel.send_fds((0,1,2))
+    channel.send({"argv": command, "cwd": os.getcwd(),
+                  "env": dict(os.environ), "pid": os.getpid()})
+    def forward(signum,frame):
+        channel.send({"signal": signum})
+    for name in FORWARD_SIGNALS:
+        signal.signal(getattr(signal,name),forward)
+    while True:
+        msg = channel.recv()
+        if msg is None:
+            print>>sys.stderr, "spawn: lost connection to the zygote"
+            return 1
+        if "exit" in msg:
+            break
+    status = msg["exit"]
+    if status < 0:
+        #  The worker was killed by a signal, so do the same to ourselves.
+        #  Some signals such as SIGKILL can't have their handler changed.
+        try:
+            signal.signal(-status,signal.SIG_DFL)
+        except (RuntimeError,ValueError):
+            pass
+        os.kill(os.getpid(),-status)
+        return 128 - status
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,242 @@
+"""
+
+djsupervisor.startup:  start programs once their dependencies are ready
+-----------------------------------------------------------------------
+
+This module implements the "supervisor startup" command, which is run by
+supervisord whenever some program has a depends_on option.  supervisord
+itself starts all the programs without dependencies, in parallel.  We then
+watch for programs to become ready, and start each dependent program as
+soon as everything it depends on is ready, so that the total startup time
+is only as long as the longest chain of dependencies.
+
+A program is ready when all its processes are in the RUNNING state, or
+when the condition given by its ready_when option holds:
+
+    * port:[<host>:]<port>   the port accepts connections
+    * file:<path>            the file exists
+    * log:<text>             every process has written the text to its log
+
+"""
+
+import os
+import sys
+import time
+import socket
+import xmlrpclib
+
+from supervisor.states import ProcessStates
+
+from djsupervisor.config import PROGRAM_SECTIONS, get_boolean
+from djsupervisor.config import get_process_names
+
+READY_KINDS = ("running","port","file","log")
+
+#  States of a program that isn't going to become ready unless someone
+#  starts it.
+STOPPED_STATES = (ProcessStates.STOPPED,ProcessStates.EXITED)
+
+
+def get_programs(cfg):
+    """Get the dependencies and readiness conditions of each program.
+
+    This returns a dict mapping program names to dicts with the following
+    keys:
+
+        * depends_on:  list of names of programs it depends on
+        * ready_when:  (kind,arg) tuple giving the readiness condition
+        * deferred:    whether it should be started once its dependencies
+                       are ready
+        * processes:   list of the "group:name" of each of its processes
+    """
+    programs = {}
+    for section in cfg.sections():
+        if not section.startswith(PROGRAM_SECTIONS):
+            continue
+        options = dict(cfg.items(section))
+        ready_when = options.get("ready_when","running")
+        (kind,_,arg) = ready_when.partition(":")
+        kind = kind.strip().lower()
+        if kind not in READY_KINDS:
+            msg = "Program '%s' has unknown ready_when condition '%s'"
+            raise ValueError(msg % (section.split(":",1)[1],ready_when))
+        programs[section.split(":",1)[1]] = {
+            "depends_on": options.get("depends_on","").split(),
+            "ready_when": (kind,arg.strip()),
+            "deferred": get_boolean(options.get("deferred_autostart","false")),
+            "processes": get_process_names(cfg,section),
+        }
+    return programs
+
+
+class Startup(object):
+    """Start deferred programs as soon as their dependencies are ready."""
+
+    def __init__(self,client,programs,poll_interval=0.2,stopped_grace=5,
+                      stream=None):
+        self.client = client
+        self.programs = programs
+        self.poll_interval = poll_interval
+        self.stopped_grace = stopped_grace
+        self.stream = stream
+        #  Maps dependencies that are stopped, or have no processes, to when
+        #  they were first seen that way.  They get stopped_grace seconds for
+        #  supervisord to (re)start them before we give up on them.
+        self.stopped_since = {}
+        #  Offsets into the log of each process, and the tail end of what
+        #  has been read, for "log:" readiness conditions.
+        self.log_offsets = {}
+        self.log_tails = {}
+        self.log_found = set()
+
+    def run(self):
+        """Start all the deferred programs, returning once they're started.
+
+        Programs whose dependencies fail to start, stay stopped, or have no
+        processes at all, are never started.
+        """
+        start_time = time.time()
+        pending = set(name for (name,program) in self.programs.iteritems()
+                      if program["deferred"])
+        ready = set()
+        failed = set()
+        while pending:
+            infos = {}
+            for info in self.client.get_all_process_info():
+                infos["%s:%s" % (info["group"],info["name"])] = info
+            waiting_for = set()
+            for name in pending:
+                waiting_for.update(self.programs[name]["depends_on"])
+            for name in sorted(waiting_for - ready - failed):
+                if name in pending:
+                    continue
+                process_infos = [infos[process]
+                               for process in self.programs[name]["processes"]
+                               if process in infos]
+                if self.is_ready(name,process_infos):
+                    ready.add(name)
+                    self.log("%s is ready after %.1fs"
+                             % (name,time.time() - start_time))
+                elif any(info["state"] == ProcessStates.FATAL
+                         for info in process_infos):
+                    failed.add(name)
+                    self.log("%s failed to start" % (name,))
+                elif all(info["state"] in STOPPED_STATES
+                         for info in process_infos):
+                    now = time.time()
+                    since = self.stopped_since.setdefault(name,now)
+                    if now - since >= self.stopped_grace:
+                        failed.add(name)
+                        if process_infos:
+                            self.log("%s is not running, and nothing is going "
+                                     "to start it" % (name,))
+                        else:
+                            self.log("%s has no processes" % (name,))
+                else:
+                    self.stopped_since.pop(name,None)
+            for name in sorted(pending):
+                deps = self.programs[name]["depends_on"]
+                if any(dep in failed for dep in deps):
+                    pending.discard(name)
+                    failed.add(name)
+                    self.log("not starting %s, since its dependencies failed"
+                             % (name,))
+            to_start = sorted(name for name in pending
+                              if all(dep in ready
+                                     for dep in self.programs[name]["depends_on"]))
+            if to_start:
+                self.log("starting %s after %.1fs" %
+                         (", ".join(to_start),time.time() - start_time))
+                processes = []
+                for name in to_start:
+                    processes.extend(self.programs[name]["processes"])
+                    if self.programs[name]["ready_when"][0] == "log":
+                        for process in self.programs[name]["processes"]:
+                            self.mark_log_end(process)
+                failures = self.client.start(processes,wait=False)
+                for (name,error) in failures:
+                    self.log("%s failed to start: %s" % (name,error))
+                pending.difference_update(to_start)
+            elif pending:
+                time.sleep(self.poll_interval)
+        self.log("startup finished after %.1fs" % (time.time() - start_time,))
+        return not failed
+
+    def is_ready(self,name,infos):
+        """Check whether the named program is ready."""
+        (kind,arg) = self.programs[name]["ready_when"]
+        if kind == "running":
+            return bool(infos) and all(info["state"] == ProcessStates.RUNNING
+                                       for info in infos)
+        if kind == "port":
+            (host,_,port) = arg.rpartition(":")
+            try:
+                sock = socket.create_connection((host or "127.0.0.1",
+                                                 int(port)),1)
+            except socket.error:
+                return False
+            sock.close()
+            return True
+        if kind == "file":
+            return os.path.exists(arg)
+        if kind == "log":
+            if not infos:
+                return False
+            names = ["%s:%s" % (info["group"],info["name"]) for info in infos]
+            return all(self.log_contains(name,arg) for name in names)
+        return False
+
+    def mark_log_end(self,name):
+        """Note where the log of the named process currently ends.
+
+        Only output after this point counts towards a "log:" condition, so
+        that output left in the log by a previous run is ignored.
+        """
+        try:
+            (_,offset,_) = self.client.call("supervisor.tailProcessStdoutLog",
+                                            name,0,0)
+        except xmlrpclib.Fault:
+            #  The log doesn't exist yet, so everything in it will be new.
+            offset = 0
+        self.log_offsets[name] = offset
+        self.log_tails[name] = ""
+
+    def log_contains(self,name,text):
+        """Check whether the named process has written the text to its log.
+
+        The log is read incrementally from where we last left off, keeping
+        just enough of the end to spot text that spans two reads.  For a
+        process that we didn't start ourselves, we start from wherever the
+        log ended when we first saw it.
+        """
+        if name in self.log_found:
+            return True
+        if name not in self.log_offsets:
+            self.mark_log_end(name)
+        offset = self.log_offsets[name]
+        tail = self.log_tails.get(name,"")
+        while True:
+            try:
+                data = self.client.call("supervisor.readProcessStdoutLog",
+                                        name,offset,65536)
+            except xmlrpclib.Fault:
+                #  e.g. the log hasn't been created yet, so it's not ready.
+                break
+            if isinstance(data,unicode):
+                data = data.encode("utf8")
+            if not data:
+                break
+            offset += len(data)
+            tail += data
+            if text in tail:
+                self.log_found.add(name)
+                return True
+            tail = tail[-len(text):]
+        self.log_offsets[name] = offset
+        self.log_tails[name] = tail
+        return False
+
+    def log(self,msg):
+        stream = self.stream or sys.stderr
+        print>>stream, "startup: %s" % (msg,)
+        stream.flush()
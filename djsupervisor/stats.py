@@ -0,0 +1,181 @@
+"""
+
+djsupervisor.stats:  sample resource usage of supervised processes
+------------------------------------------------------------------
+
+This module implements the "supervisor stats" command.  It gets the pids of
+all supervised processes from a single getAllProcessInfo() call, then reads
+their resource usage straight out of /proc.  The usage of each process is
+totalled over its whole process tree, so e.g. the workers forked by gunicorn
+or celery are counted against the program that started them.
+
+This only works on systems that have a Linux-style /proc filesystem.
+
+"""
+
+import os
+import sys
+import json
+import time
+
+PROC_DIR = "/proc"
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def sample(infos,proc_dir=PROC_DIR):
+    """Sample the resource usage of the given supervised processes.
+
+    This takes a list of process info dicts as returned by getAllProcessInfo,
+    and returns a list of dicts giving the following totals for the process
+    tree rooted at each one:
+
+        * processes:     number of processes in the tree
+        * cpu_time:      user plus system CPU time, in seconds
+        * rss:           resident set size, in bytes
+        * threads:       number of threads
+        * fds:           number of open file descriptors
+        * ctx_switches:  number of voluntary and involuntary context switches
+
+    Processes that aren't running have all these values as zero.
+    """
+    table = read_proc_table(proc_dir)
+    children = {}
+    for (pid,info) in table.iteritems():
+        children.setdefault(info["ppid"],[]).append(pid)
+    samples = []
+    for info in infos:
+        totals = {
+            "name": "%s:%s" % (info["group"],info["name"]),
+            "pid": info["pid"],
+            "state": info["statename"],
+            "processes": 0,
+            "cpu_time": 0.0,
+            "rss": 0,
+            "threads": 0,
+            "fds": 0,
+            "ctx_switches": 0,
+        }
+        todo = []
+        if info["pid"] and info["pid"] in table:
+            todo.append(info["pid"])
+        while todo:
+            pid = todo.pop()
+            todo.extend(children.get(pid,()))
+            stat = table[pid]
+            totals["processes"] += 1
+            totals["cpu_time"] += stat["cpu_time"]
+            totals["rss"] += stat["rss"]
+            totals["threads"] += stat["threads"]
+            totals["fds"] += count_fds(proc_dir,pid)
+            totals["ctx_switches"] += count_ctx_switches(proc_dir,pid)
+        samples.append(totals)
+    return samples
+
+
+def read_proc_table(proc_dir=PROC_DIR):
+    """Read the basic stats for every process on the system.
+
+    This returns a dict mapping pids to dicts with keys ppid, cpu_time,
+    rss and threads, all read from /proc/<pid>/stat.
+    """
+    table = {}
+    for name in os.listdir(proc_dir):
+        if not name.isdigit():
+            continue
+        try:
+            with open(os.path.join(proc_dir,name,"stat"),"r") as f:
+                data = f.read()
+        except EnvironmentError:
+            continue
+        #  The command name is in parens and might contain spaces, so
+        #  we split the fields from after the last closing paren.
+        fields = data[data.rindex(")") + 2:].split()
+        table[int(name)] = {
+            "ppid": int(fields[1]),
+            "cpu_time": (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS),
+            "threads": int(fields[17]),
+            "rss": int(fields[21]) * PAGE_SIZE,
+        }
+    return table
+
+
+def count_fds(proc_dir,pid):
+    """Count the open file descriptors of a process, if we're allowed to."""
+    try:
+        return len(os.listdir(os.path.join(proc_dir,str(pid),"fd")))
+    except EnvironmentError:
+        return 0
+
+
+def count_ctx_switches(proc_dir,pid):
+    """Count the context switches of a process."""
+    count = 0
+    try:
+        with open(os.path.join(proc_dir,str(pid),"status"),"r") as f:
+            for line in f:
+                #  Both voluntary_ and nonvoluntary_ctxt_switches.
+                if "ctxt_switches:" in line:
+                    count += int(line.split()[1])
+    except (EnvironmentError,ValueError,IndexError):
+        pass
+    return count
+
+
+def add_cpu_percent(samples,prev_samples,elapsed):
+    """Add a cpu_percent field to each sample, based on the previous ones.
+
+    The percentage is of a single CPU, so can be more than 100 for processes
+    using several CPUs at once.  It is None if there's no previous sample
+    for the same pid.
+    """
+    prev = dict((s["name"],s) for s in prev_samples or ())
+    for s in samples:
+        p = prev.get(s["name"])
+        if p is None or p["pid"] != s["pid"] or not elapsed:
+            s["cpu_percent"] = None
+        else:
+            cpu = max(s["cpu_time"] - p["cpu_time"],0)
+            s["cpu_percent"] = 100 * cpu / elapsed
+
+
+def write_table(samples,stream=None):
+    """Write the samples as a human-readable table."""
+    if stream is None:
+        stream = sys.stdout
+    columns = "%-32s %7s %5s %6s %10s %9s %7s %6s %10s"
+    print>>stream, columns % ("NAME","PID","PROCS","CPU%","CPU TIME",
+                              "RSS","THREADS","FDS","CTX SWTCH")
+    for s in samples:
+        if s["cpu_percent"] is None:
+            cpu_percent = "-"
+        else:
+            cpu_percent = "%.1f" % (s["cpu_percent"],)
+        print>>stream, columns % (s["name"],s["pid"] or "-",s["processes"],
+                                  cpu_percent,"%.2f" % (s["cpu_time"],),
+                                  format_bytes(s["rss"]),s["threads"],
+                                  s["fds"],s["ctx_switches"])
+
+
+def write_json(samples,stream=None):
+    """Write the samples as JSON, one object per line."""
+    if stream is None:
+        stream = sys.stdout
+    timestamp = time.time()
+    for s in samples:
+        s = dict(s,timestamp=timestamp)
+        print>>stream, json.dumps(s,sort_keys=True)
+    stream.flush()
+
+
+def format_bytes(num):
+    """Format a number of bytes in a compact human-readable form."""
+    if num < 1024:
+        return "%dB" % (num,)
+    for unit in ("K","M","G"):
+        num /= 1024.0
+        if num < 1024:
+            return "%.1f%s" % (num,unit)
+    num /= 1024.0
+    return "%.1fT" % (num,)
@@ -5,22 +5,33 @@ djsupervisor.templatetags.djsupervisor_tags:  custom template tags
 
 This module defines a custom template filter "templated" which can be used
 to apply the djsupervisor templating logic to other config files in your
-project.
+project, and a tag "workers" for sizing process pools to fit the host.
 """
 
 import os
+import stat
 import shutil
+import threading
 
 from django import template
+
+from djsupervisor.cache import atomic_write
+from djsupervisor.host import HostFacts, get_worker_count
+
 register = template.Library()
 
-current_context = None
+#  State for the render in progress.  This has the template context as
+#  "context" and optionally a list as "files" that collects the paths of
+#  all files read or written, for use by the config cache.  It's thread-local
+#  since config files may be rendered concurrently.
+current = threading.local()
 
 @register.filter
 def templated(template_path):
     import djsupervisor.config
     # Interpret paths relative to the project directory.
-    project_dir = current_context["PROJECT_DIR"]
+    context = current.context
+    project_dir = context["PROJECT_DIR"]
     full_path = os.path.join(project_dir, template_path)
     templated_path = full_path + ".templated"
     # If the target file doesn't exist, we will copy over source file metadata.
@@ -29,16 +40,49 @@ def templated(template_path):
     created = not os.path.exists(templated_path)
     # Read and process the source file.
     with open(full_path, "r") as f:
-        templated = djsupervisor.config.render_config(f.read(), current_context)
-    # Write it out to the corresponding .templated file.
-    with open(templated_path, "w") as f:
-        f.write(templated)
-    # Copy metadata if necessary.
-    if created:
+        templated = djsupervisor.config.render_config(f.read(), context)
+    # Write it out to the corresponding .templated file, but only if the
+    # contents have actually changed.  That way programs watching the file
+    # don't see spurious updates, and they'll never see a partial write.
+    if created or not _has_contents(templated_path, templated):
+        # Keep the metadata of the file we're replacing, or copy it
+        # over from the source file if there wasn't one.
+        info = os.stat(full_path if created else templated_path)
+        atomic_write(templated_path, templated, stat.S_IMODE(info.st_mode))
         try:
-            info = os.stat(full_path)
-            shutil.copystat(full_path, templated_path)
+            if created:
+                shutil.copystat(full_path, templated_path)
             os.chown(templated_path, info.st_uid, info.st_gid)
         except EnvironmentError:
             pass
+    files = getattr(current, "files", None)
+    if files is not None:
+        files.extend((full_path, templated_path))
     return templated_path
+
+
+@register.simple_tag(takes_context=True)
+def workers(context, per_cpu=1, plus=0, memory_per_worker=None,
+            at_least=1, at_most=None):
+    """Get the number of workers to run, scaled to the host's resources.
+
+    For example {% workers per_cpu=2 plus=1 memory_per_worker="256M" %}
+    gives two workers per usable CPU plus one, but no more than will fit
+    in memory at 256M each.
+    """
+    host = context.get("HOST")
+    if host is None:
+        host = HostFacts()
+    return get_worker_count(host, float(per_cpu), float(plus),
+                            memory_per_worker, at_least, at_most)
+
+
+def _has_contents(path, data):
+    """Check whether the given file contains exactly the given data."""
+    try:
+        if os.path.getsize(path) != len(data):
+            return False
+        with open(path, "rb") as f:
+            return f.read() == data
+    except EnvironmentError:
+        return False
@@ -9,10 +9,30 @@ These are just some simple tests for the moment, more to come...
 
 import os
 import sys
+import time
 import difflib
+import shutil
+import tempfile
+import threading
 import unittest
+import xmlrpclib
+
+from django.conf import settings
+if not settings.configured:
+    settings.configure(SECRET_KEY="djsupervisor-tests",
+                       INSTALLED_APPS=["djsupervisor"],
+                       TEMPLATES=[{"BACKEND": "django.template.backends"
+                                              ".django.DjangoTemplates"}])
+    import django
+    django.setup()
 
 import djsupervisor
+from djsupervisor import autoreload
+from djsupervisor import cache
+from djsupervisor import client
+from djsupervisor import imports
+from djsupervisor import config
+from djsupervisor import diff
 
 
 class TestDJSupervisorDocs(unittest.TestCase):
@@ -38,3 +58,967 @@ class TestDJSupervisorDocs(unittest.TestCase):
                 f.close()
 
 
+class TestConfigCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_cache_is_invalidated_by_key_or_file_changes(self):
+        source = os.path.join(self.tempdir,"supervisord.conf")
+        cache_file = os.path.join(self.tempdir,"cache","merged.json")
+        with open(source,"w") as f:
+            f.write("[program:one]\n")
+        key = cache.fingerprint("one",["two"])
+        self.assertEquals(cache.read_cache(cache_file,key),None)
+        cache.write_cache(cache_file,key,[source],"DATA")
+        self.assertEquals(cache.read_cache(cache_file,key),"DATA")
+        self.assertEquals(cache.read_cache(cache_file,key + "x"),None)
+        with open(source,"w") as f:
+            f.write("[program:two]\n")
+        self.assertEquals(cache.read_cache(cache_file,key),None)
+
+    def test_control_info_is_invalidated_by_environment_changes(self):
+        from djsupervisor import ctl
+        data = "[supervisorctl]\nserverurl = http://127.0.0.1:9001\n"
+        config.write_control_cache(self.tempdir,[],data)
+        info = ctl.get_control_info(self.tempdir)
+        self.assertEquals(info["serverurl"],"http://127.0.0.1:9001")
+        os.environ["DJSUPERVISOR_TEST_PASSWORD"] = "secret"
+        try:
+            self.assertEquals(ctl.get_control_info(self.tempdir),None)
+        finally:
+            del os.environ["DJSUPERVISOR_TEST_PASSWORD"]
+        self.assertNotEquals(ctl.get_control_info(self.tempdir),None)
+
+
+class TestTemplates(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache_size = config.TEMPLATE_CACHE_SIZE
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        config.TEMPLATE_CACHE_SIZE = self.cache_size
+
+    def test_unchanged_templated_files_are_not_rewritten(self):
+        source = os.path.join(self.tempdir,"nginx.conf")
+        target = source + ".templated"
+        with open(source,"w") as f:
+            f.write("root {{ PROJECT_DIR }};\n")
+        ctx = {"PROJECT_DIR": self.tempdir}
+        data = "{{ 'nginx.conf'|templated }}"
+        self.assertEquals(config.render_config(data,ctx),target)
+        with open(target,"r") as f:
+            self.assertEquals(f.read(),"root %s;\n" % (self.tempdir,))
+        os.utime(target,(1000000000,1000000000))
+        inode = os.stat(target).st_ino
+        config.render_config(data,ctx)
+        self.assertEquals(os.stat(target).st_mtime,1000000000)
+        self.assertEquals(os.stat(target).st_ino,inode)
+        with open(source,"w") as f:
+            f.write("root {{ PROJECT_DIR }}/static;\n")
+        config.render_config(data,ctx)
+        self.assertNotEquals(os.stat(target).st_mtime,1000000000)
+        with open(target,"r") as f:
+            self.assertEquals(f.read(),"root %s/static;\n" % (self.tempdir,))
+
+    def test_templates_are_evicted_least_recently_used_first(self):
+        config.TEMPLATE_CACHE_SIZE = 2
+        with config._template_cache_lock:
+            config._template_cache.clear()
+        a = config.get_template("a")
+        config.get_template("b")
+        self.assertTrue(config.get_template("a") is a)
+        config.get_template("c")
+        self.assertEquals(len(config._template_cache),2)
+        self.assertTrue(config.get_template("a") is a)
+        self.assertFalse(config.get_template("b") is None)
+        self.assertFalse(config.get_template("c") is a)
+
+    def test_template_cache_is_thread_safe(self):
+        config.TEMPLATE_CACHE_SIZE = 3
+        sources = ["{{ N }} %d" % (i,) for i in xrange(5)]
+        errors = []
+        def render(n):
+            try:
+                for i in xrange(200):
+                    source = sources[(n + i) % len(sources)]
+                    output = config.render_config(source,{"N": n})
+                    if output != source.replace("{{ N }}",str(n)):
+                        errors.append(output)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=render,args=(n,))
+                   for n in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(errors,[])
+        self.assertTrue(len(config._template_cache) <= 3)
+
+
+class TestMergeConfig(unittest.TestCase):
+
+    def test_pattern_scoped_defaults_and_overrides(self):
+        merged = config.parse_config(config.merge_config(["""
+[program:__defaults__]
+user=nobody
+startsecs=1
+
+[program:celery_*:__defaults__]
+startsecs=10
+stopwaitsecs=60
+
+[program:celery_beat:__overrides__]
+numprocs=1
+
+[program:web]
+command=web
+
+[program:celery_worker]
+command=worker
+stopwaitsecs=600
+
+[program:celery_beat]
+command=beat
+numprocs=4
+
+[program:excluded]
+exclude=true
+"""],{}))
+        self.assertEquals(dict(merged["program:web"]),
+                          {"command": "web", "user": "nobody",
+                           "startsecs": "1"})
+        self.assertEquals(dict(merged["program:celery_worker"]),
+                          {"command": "worker", "user": "nobody",
+                           "startsecs": "10", "stopwaitsecs": "600"})
+        self.assertEquals(merged["program:celery_beat"]["numprocs"],"1")
+        self.assertEquals(merged["program:celery_beat"]["stopwaitsecs"],"60")
+        self.assertFalse("program:excluded" in merged)
+        for name in merged:
+            self.assertFalse("__" in name)
+
+    def test_builtins_dont_clash_with_project_programs(self):
+        builtin = "[program:djsupervisor_healthcheck]\ncommand=builtin\n"
+        merged = config.parse_config(config.merge_config([builtin,"""
+[program:healthcheck]
+command=mine
+"""],{}))
+        self.assertEquals(merged["program:healthcheck"]["command"],"mine")
+        self.assertFalse("program:djsupervisor_healthcheck" in merged)
+        merged = config.parse_config(config.merge_config([builtin,"""
+[program:healthcheck]
+command=mine
+healthcheck_tcp=127.0.0.1:80
+"""],{}))
+        self.assertEquals(merged["program:healthcheck"]["command"],"mine")
+        self.assertEquals(merged["program:djsupervisor_healthcheck"]["command"],
+                          "builtin")
+
+
+class TestClient(unittest.TestCase):
+
+    def test_expand_process_names(self):
+        infos = [{"group": "web", "name": "web"},
+                 {"group": "celery", "name": "celery_0"},
+                 {"group": "celery", "name": "celery_1"}]
+        self.assertEquals(client.expand_process_names(["web"],infos),
+                          ["web:web"])
+        self.assertEquals(client.expand_process_names(["celery"],infos),
+                          ["celery:celery_0","celery:celery_1"])
+        self.assertEquals(client.expand_process_names(["celery:celery_1",
+                                                        "c*","missing"],infos),
+                          ["celery:celery_1","celery:celery_0","missing"])
+
+    def test_get_batch_size(self):
+        self.assertEquals(client.get_batch_size(2,16),2)
+        self.assertEquals(client.get_batch_size("3",16),3)
+        self.assertEquals(client.get_batch_size("25%",16),4)
+        self.assertEquals(client.get_batch_size("25%",3),1)
+        self.assertEquals(client.get_batch_size("1%",3),1)
+        self.assertEquals(client.get_batch_size(0,3),1)
+
+
+class TestCallbackModifiedHandler(unittest.TestCase):
+
+    def test_events_are_debounced_and_coalesced(self):
+        from watchdog.events import FileModifiedEvent, FileCreatedEvent
+        from watchdog.events import FileMovedEvent, FileDeletedEvent
+        from djsupervisor.events import CallbackModifiedHandler
+        calls = []
+        fired = threading.Event()
+        def callback(changed_paths):
+            calls.append(changed_paths)
+            fired.set()
+        handler = CallbackModifiedHandler(callback=callback,
+                                          quiet_period=0.1,
+                                          max_wait=5,
+                                          patterns=["*.py"])
+        handler.dispatch(FileModifiedEvent("/app/models.py"))
+        handler.dispatch(FileCreatedEvent("/app/views.py"))
+        handler.dispatch(FileMovedEvent("/app/.urls.py.swp","/app/urls.py"))
+        handler.dispatch(FileDeletedEvent("/app/old.py"))
+        handler.dispatch(FileModifiedEvent("/app/README.txt"))
+        self.assertFalse(calls)
+        fired.wait(5)
+        self.assertEquals(calls,[set(["/app/models.py","/app/views.py",
+                                      "/app/urls.py","/app/old.py"])])
+
+
+class TestImports(unittest.TestCase):
+
+    def test_select_processes(self):
+        infos = [{"group": "web", "name": "web", "pid": 10},
+                 {"group": "celery", "name": "celery", "pid": 11},
+                 {"group": "nginx", "name": "nginx", "pid": 12}]
+        records = {"web:web": {"pid": 10, "files": set(["/app/views.py"])},
+                   "celery:celery": {"pid": 11,
+                                     "files": set(["/app/tasks.py"])}}
+        names = ["web:web","celery:celery","nginx:nginx"]
+        self.assertEquals(imports.select_processes(names,["/app/views.py"],
+                                                   infos,records),
+                          ["web:web","nginx:nginx"])
+        #  Records left over from a previous process are ignored.
+        records["celery:celery"]["pid"] = 9
+        self.assertEquals(imports.select_processes(names,["/app/views.py"],
+                                                   infos,records),
+                          names)
+
+
+class TestPlanWatches(unittest.TestCase):
+
+    def setUp(self):
+        self.root = os.path.realpath(tempfile.mkdtemp()) + os.sep
+        for dirnm in ("a","b/c","node_modules/x/y"):
+            os.makedirs(os.path.join(self.root,dirnm))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_excluded_dirs_are_split_out(self):
+        (watches,num_watches,skipped) = autoreload.plan_watches(
+            [self.root],exclude=["*/node_modules"])
+        self.assertEquals(watches,[(self.root,False),
+                                   (self.root + "a" + os.sep,True),
+                                   (self.root + "b" + os.sep,True)])
+        self.assertEquals(num_watches,4)
+        self.assertEquals(skipped,[])
+
+    def test_watch_budget_is_enforced(self):
+        (watches,num_watches,skipped) = autoreload.plan_watches(
+            [self.root + "a",self.root + "b"],max_watches=2)
+        self.assertEquals(watches,[(self.root + "a" + os.sep,True)])
+        self.assertEquals(num_watches,1)
+        self.assertEquals(skipped,[self.root + "b" + os.sep])
+        (watches,num_watches,skipped) = autoreload.plan_watches(
+            [self.root],max_watches=2)
+        self.assertEquals(watches,[])
+        self.assertEquals(skipped,[self.root])
+
+
+    def test_projects_under_the_interpreter_prefix_are_watched(self):
+        site_packages = self.root + "lib/python%d.%d/site-packages/pkg" \
+                        % sys.version_info[:2]
+        os.makedirs(site_packages)
+        (prefix,exec_prefix) = (sys.prefix,sys.exec_prefix)
+        sys.prefix = sys.exec_prefix = self.root
+        try:
+            (watches,_,_) = autoreload.plan_watches([self.root + "a",
+                                                     site_packages])
+        finally:
+            (sys.prefix,sys.exec_prefix) = (prefix,exec_prefix)
+        self.assertEquals(watches,[(self.root + "a" + os.sep,True)])
+
+
+class TestContentIndex(unittest.TestCase):
+
+    def test_unchanged_contents_are_ignored(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempdir,"models.py")
+            index_file = os.path.join(tempdir,"index.json")
+            with open(filename,"w") as f:
+                f.write("one")
+            os.utime(filename,(time.time() - 60,time.time() - 60))
+            index = autoreload.ContentIndex(index_file)
+            #  Seeding the index means that even the first save of a file
+            #  is ignored if it doesn't change anything.
+            index.seed([(tempdir,True)]).join()
+            self.assertEquals(index.filter_changed([filename]),set())
+            #  Files not seen by the seeding are always reported.
+            newfile = os.path.join(tempdir,"views.py")
+            with open(newfile,"w") as f:
+                f.write("one")
+            self.assertEquals(index.filter_changed([newfile]),set([newfile]))
+            self.assertEquals(index.filter_changed([newfile]),set())
+            #  The index is persisted between instances.
+            index = autoreload.ContentIndex(index_file)
+            self.assertEquals(index.filter_changed([filename]),set())
+            with open(filename,"w") as f:
+                f.write("two")
+            self.assertEquals(index.filter_changed([filename]),set([filename]))
+            os.unlink(filename)
+            self.assertEquals(index.filter_changed([filename]),set([filename]))
+        finally:
+            shutil.rmtree(tempdir)
+
+
+class TestIndexedPollingObserver(unittest.TestCase):
+
+    def setUp(self):
+        self.root = os.path.realpath(tempfile.mkdtemp())
+        os.makedirs(os.path.join(self.root,"app"))
+        self.write("app/models.py","one")
+        self.write("app/notes.txt","one")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self,filename,data):
+        with open(os.path.join(self.root,filename),"w") as f:
+            f.write(data)
+
+    def test_changes_are_detected_from_the_index(self):
+        from watchdog.observers.api import EventQueue, ObservedWatch
+        from djsupervisor.polling import IndexedPollingEmitter
+        index_dir = os.path.join(self.root,"index")
+        def make_emitter():
+            emitter = IndexedPollingEmitter(EventQueue(),
+                                            ObservedWatch(self.root,True),
+                                            patterns=["*.py"],
+                                            index_dir=index_dir,
+                                            min_interval=0)
+            emitter.on_thread_start()
+            return emitter
+        emitter = make_emitter()
+        self.assertEquals(sorted(emitter.files),
+                          [os.path.join(self.root,"app","models.py")])
+        self.assertTrue(os.listdir(index_dir))
+        self.write("app/models.py","second")
+        self.write("app/views.py","one")
+        self.write("app/notes.txt","two")
+        emitter.queue_events(0)
+        events = []
+        while not emitter._event_queue.empty():
+            (event,_) = emitter._event_queue.get()
+            events.append((event.event_type,os.path.basename(event.src_path)))
+        self.assertEquals(sorted(events),[("created","views.py"),
+                                          ("modified","models.py")])
+        #  A new emitter picks up the saved index.
+        self.assertEquals(make_emitter().files,emitter.files)
+
+
+class TestConfigDiff(unittest.TestCase):
+
+    def test_changes_are_classified_by_option(self):
+        old = diff.get_process_configs("""
+[supervisord]
+[program:web]
+command=web
+[program:worker]
+command=worker
+[program:beat]
+command=beat
+""")
+        new = diff.get_process_configs("""
+[supervisord]
+[program:web]
+command=web --fast
+[program:worker]
+command=worker
+autostart=false
+priority=10
+[program:beat]
+command=beat
+numprocs=2
+process_name=%(program_name)s_%(process_num)s
+""")
+        changes = diff.get_changes(["cron"],["web","worker","beat"],["old"],
+                                   old,new)
+        self.assertEquals(changes,[("cron","add",[]),
+                                   ("old","remove",[]),
+                                   ("beat","restart",[]),
+                                   ("web","restart",["command"]),
+                                   ("worker","defer",["autostart",
+                                                      "priority"])])
+
+    def test_socket_configs_are_compared_by_value(self):
+        data = """
+[supervisord]
+[fcgi-program:web]
+command=web
+socket=unix:///tmp/web.sock
+socket_mode=0600
+"""
+        old = diff.get_process_configs(data)
+        new = diff.get_process_configs(data.replace("0600","0660"))
+        self.assertEquals(diff.get_process_configs(data),old)
+        autostart = diff.get_process_configs(data + "autostart=false\n")
+        self.assertEquals(diff.get_changes([],["web"],[],old,autostart),
+                          [("web","defer",["autostart"])])
+        self.assertEquals(diff.get_changes([],["web"],[],old,new),
+                          [("web","restart",["socket_config"])])
+
+
+class TestStats(unittest.TestCase):
+
+    def test_usage_is_totalled_over_process_trees(self):
+        from djsupervisor import stats
+        proc_dir = tempfile.mkdtemp()
+        try:
+            def make_proc(pid,ppid,ticks,threads,pages,fds):
+                os.makedirs(os.path.join(proc_dir,str(pid),"fd"))
+                fields = ["S",ppid] + [0] * 9 + [ticks,ticks] + [0] * 4
+                fields += [threads,0,0,0,pages]
+                with open(os.path.join(proc_dir,str(pid),"stat"),"w") as f:
+                    f.write("%d (a (weird) name) %s\n" %
+                            (pid," ".join(str(x) for x in fields)))
+                with open(os.path.join(proc_dir,str(pid),"status"),"w") as f:
+                    f.write("voluntary_ctxt_switches:\t3\n")
+                    f.write("nonvoluntary_ctxt_switches:\t2\n")
+                for fd in xrange(fds):
+                    open(os.path.join(proc_dir,str(pid),"fd",str(fd)),"w")
+            make_proc(10,1,stats.CLOCK_TICKS,2,1,3)
+            make_proc(11,10,stats.CLOCK_TICKS,1,2,1)
+            make_proc(12,1,0,1,4,1)
+            infos = [{"group": "web", "name": "web", "pid": 10,
+                      "statename": "RUNNING"},
+                     {"group": "cron", "name": "cron", "pid": 0,
+                      "statename": "STOPPED"}]
+            [web,cron] = stats.sample(infos,proc_dir)
+            self.assertEquals(web["processes"],2)
+            self.assertEquals(web["cpu_time"],4.0)
+            self.assertEquals(web["threads"],3)
+            self.assertEquals(web["rss"],3 * stats.PAGE_SIZE)
+            self.assertEquals(web["fds"],4)
+            self.assertEquals(web["ctx_switches"],10)
+            self.assertEquals(cron["processes"],0)
+        finally:
+            shutil.rmtree(proc_dir)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_state_changes_are_tracked_from_events(self):
+        from djsupervisor import metrics
+        store = metrics.MetricsStore()
+        store.load([{"group": "web", "name": "web", "statename": "STOPPED",
+                     "start": 0, "stop": 100, "exitstatus": 0}])
+        store.set_state("web","web","STARTING","STOPPED",now=110)
+        store.set_state("web","web","RUNNING","STARTING",now=111)
+        store.set_state("web","web","EXITED","RUNNING",exitstatus=3,now=120)
+        store.set_state("web","web","STARTING","EXITED",now=121)
+        store.set_state("web","web","RUNNING","STARTING",now=122)
+        lines = store.render(now=130).splitlines()
+        labels = '{group="web",name="web"}'
+        self.assertTrue("supervisor_process_starts_total%s 2" % labels in lines)
+        self.assertTrue("supervisor_process_restarts_total%s 1" % labels in lines)
+        self.assertTrue("supervisor_process_exit_status%s 3" % labels in lines)
+        self.assertTrue("supervisor_process_uptime_seconds%s 8" % labels in lines)
+        labels = '{group="web",name="web",state="%s"}'
+        self.assertTrue("supervisor_process_state%s 1" % (labels % "RUNNING",)
+                        in lines)
+        self.assertTrue("supervisor_process_state%s 0" % (labels % "EXITED",)
+                        in lines)
+        self.assertTrue("supervisor_process_state_seconds_total%s 17"
+                        % (labels % "RUNNING",) in lines)
+
+
+class TestEventListener(unittest.TestCase):
+
+    def test_events_are_dispatched_in_batches(self):
+        from StringIO import StringIO
+        from django.dispatch import Signal
+        from djsupervisor import listener
+        data = []
+        for serial in xrange(3):
+            payload = "processname:web groupname:web from_state:STARTING pid:1"
+            data.append("ver:3.0 server:supervisor serial:%d pool:web "
+                        "poolserial:%d eventname:PROCESS_STATE_RUNNING "
+                        "len:%d\n%s" % (serial,serial,len(payload),payload))
+        stdin = StringIO("".join(data))
+        stdout = StringIO()
+        batches = []
+        def receiver(sender,listener,events,**kwds):
+            batches.append((listener,events))
+        signal = Signal(providing_args=["listener","events"])
+        signal.connect(receiver)
+        el = listener.EventListener("web",signal=signal,stats_interval=0,
+                                    stderr=StringIO())
+        el.run(stdin,stdout)
+        events = [e for (_,batch) in batches for e in batch]
+        self.assertEquals([e.serial for e in events],[0,1,2])
+        self.assertEquals(events[0].data["from_state"],"STARTING")
+        self.assertEquals(set(name for (name,_) in batches),set(["web"]))
+        self.assertEquals(stdout.getvalue().count("RESULT 2\nOK"),3)
+        self.assertTrue("listen: djsupervisor.tests.receiver: "
+                        in el.stderr.getvalue())
+        #  Without a list of receivers, they're all sent the events at once.
+        get_receivers = listener._get_receivers
+        listener._get_receivers = lambda signal,sender: None
+        try:
+            del batches[:]
+            el.dispatch(events)
+        finally:
+            listener._get_receivers = get_receivers
+        self.assertEquals(batches,[("web",events)])
+        self.assertTrue("all handlers" in el.timings)
+
+    def test_listen_options_only_apply_to_listen_listeners(self):
+        fragments = ["""
+[eventlistener:__defaults__]
+command=python /proj/manage.py supervisor listen %(program_name)s
+
+[eventlistener:alerts]
+events=PROCESS_STATE
+
+[eventlistener:foo]
+command=/bin/cat
+events=TICK_5
+"""]
+        merged = config.parse_config(config.merge_config(fragments,{}))
+        self.assertEquals(merged["eventlistener:alerts"]["buffer_size"],"1024")
+        self.assertEquals(merged["eventlistener:alerts"]["autoreload"],"true")
+        self.assertFalse("buffer_size" in merged["eventlistener:foo"])
+        self.assertFalse("autoreload" in merged["eventlistener:foo"])
+        fragments.append("[program:autoreload]\ncommand=autoreload\n"
+                         "[program:web]\ncommand=web\n")
+        merged = config.parse_config(config.merge_config(fragments,
+                                                         {"autoreload": ["web"]}))
+        self.assertEquals(merged["eventlistener:alerts"]["autoreload"],"false")
+        self.assertEquals(merged["eventlistener:foo"]["autoreload"],"false")
+
+
+class TestLogFollower(unittest.TestCase):
+
+    def test_output_is_followed_from_offsets(self):
+        from StringIO import StringIO
+        from supervisor.options import readFile, tailFile
+        from djsupervisor.logs import LogFollower
+        tempdir = tempfile.mkdtemp()
+        try:
+            logfile = os.path.join(tempdir,"web.log")
+            with open(logfile,"w") as f:
+                f.write("old\nlast\n")
+            class FakeClient(object):
+                def multicall(self,calls):
+                    results = []
+                    for (method,(name,offset,length)) in calls:
+                        if method.startswith("supervisor.tail"):
+                            results.append(tailFile(logfile,offset,length))
+                        else:
+                            results.append(readFile(logfile,offset,length))
+                    return results
+            stream = StringIO()
+            follower = LogFollower(FakeClient(),initial_bytes=5,chunk_size=4,
+                                   stream=stream)
+            follower.processes["web:web"] = {"offset": None, "partial": "",
+                                             "skip_partial": False,
+                                             "interval": 0, "due": 0}
+            follower.poll(now=0)
+            with open(logfile,"a") as f:
+                f.write("first\nsecond")
+            for i in xrange(1,10):
+                follower.poll(now=i * 100)
+            follower.flush("web:web")
+            lines = [line.split(" | ",1)[1]
+                     for line in stream.getvalue().splitlines()]
+            self.assertEquals(lines,["last","first","second"])
+        finally:
+            shutil.rmtree(tempdir)
+
+
+class TestHostFacts(unittest.TestCase):
+
+    def test_cgroup_limits_are_applied(self):
+        from djsupervisor import host
+        tempdir = tempfile.mkdtemp()
+        try:
+            def write(path,data):
+                path = os.path.join(tempdir,path)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path,"w") as f:
+                    f.write(data)
+            write("proc/self/status","Name:\tpython\nCpus_allowed_list:\t0-5,8\n")
+            write("proc/meminfo","MemTotal:\t16777216 kB\n"
+                                 "MemAvailable:\t8388608 kB\n")
+            write("cgroup/cpu.max","250000 100000\n")
+            write("cgroup/memory.max","%d\n" % (4 * 1024 ** 3,))
+            write("cgroup/memory.current","%d\n" % (3 * 1024 ** 3,))
+            facts = host.HostFacts(os.path.join(tempdir,"proc"),
+                                   os.path.join(tempdir,"cgroup"))
+            facts._facts["cpu_count"] = 16
+            self.assertEquals(facts.usable_cpus,3)
+            self.assertEquals(facts.memory_total,4 * 1024 ** 3)
+            self.assertEquals(facts.memory_available,1024 ** 3)
+            self.assertEquals(host.get_worker_count(facts,2,1),7)
+            self.assertEquals(host.get_worker_count(facts,2,1,"1G"),4)
+            self.assertEquals(host.get_worker_count(facts,2,1,"8G"),1)
+            self.assertEquals(host.get_worker_count(facts,2,1,at_most=5),5)
+        finally:
+            shutil.rmtree(tempdir)
+
+
+class TestMemoryWatchdog(unittest.TestCase):
+
+    def test_processes_over_limit_are_restarted_after_window(self):
+        from StringIO import StringIO
+        from djsupervisor import memwatch, stats
+        proc_dir = tempfile.mkdtemp()
+        try:
+            for (pid,ppid,pages) in ((10,1,100),(11,10,100),(20,1,150)):
+                os.makedirs(os.path.join(proc_dir,str(pid)))
+                fields = ["S",ppid] + [0] * 15 + [1,0,0,0,pages]
+                with open(os.path.join(proc_dir,str(pid),"stat"),"w") as f:
+                    f.write("%d (python) %s\n" %
+                            (pid," ".join(str(x) for x in fields)))
+            restarted = []
+            class FakeClient(object):
+                def get_all_process_info(self):
+                    return [{"group": "web", "name": "web_0", "pid": 10,
+                             "statename": "RUNNING"},
+                            {"group": "web", "name": "web_1", "pid": 20,
+                             "statename": "RUNNING"}]
+                def restart(self,names):
+                    restarted.extend(names)
+                    return []
+            limits = {"web:web_0": (160 * stats.PAGE_SIZE,10),
+                      "web:web_1": (160 * stats.PAGE_SIZE,10)}
+            watchdog = memwatch.MemoryWatchdog(FakeClient(),limits,proc_dir,
+                                               stream=StringIO())
+            self.assertEquals(watchdog.check(now=100),None)
+            self.assertEquals(watchdog.check(now=105),None)
+            self.assertEquals(watchdog.check(now=110),"web:web_0")
+            self.assertEquals(restarted,["web:web_0"])
+            self.assertTrue("pid 10" in watchdog.stream.getvalue())
+        finally:
+            shutil.rmtree(proc_dir)
+
+
+    def test_limits_are_keyed_by_process_name(self):
+        from ConfigParser import RawConfigParser
+        from StringIO import StringIO
+        from djsupervisor import memwatch
+        cfg = RawConfigParser()
+        cfg.readfp(StringIO("[program:web]\n"
+                            "numprocs=2\n"
+                            "process_name=web_%(process_num)s\n"
+                            "max_rss=1MB\n"
+                            "[program:celeryd]\n"
+                            "max_rss=2MB\n"
+                            "max_rss_window=60\n"
+                            "[group:workers]\n"
+                            "programs=celeryd,beat\n"))
+        limits = memwatch.get_limits(cfg)
+        self.assertEquals(sorted(limits),["web:web_0","web:web_1",
+                                          "workers:celeryd"])
+        self.assertEquals(limits["workers:celeryd"],(2 * 1024 * 1024,60))
+
+
+class TestHealthChecks(unittest.TestCase):
+
+    def test_checks_are_expanded_for_each_process(self):
+        from ConfigParser import RawConfigParser
+        from StringIO import StringIO
+        from djsupervisor import health
+        cfg = RawConfigParser()
+        cfg.readfp(StringIO("[program:web]\n"
+                            "numprocs=2\n"
+                            "process_name=web_%(process_num)s\n"
+                            "healthcheck_http=http://localhost:80%(process_num)02d/\n"
+                            "healthcheck_failures=2\n"
+                            "[program:cron]\n"))
+        checks = sorted(health.get_checks(cfg),key=lambda c: c["name"])
+        self.assertEquals([c["name"] for c in checks],["web:web_0","web:web_1"])
+        self.assertEquals(checks[1]["target"],"http://localhost:8001/")
+        self.assertEquals(checks[1]["failures"],2)
+        cfg.readfp(StringIO("[group:site]\n"
+                            "programs=web\n"))
+        checks = sorted(health.get_checks(cfg),key=lambda c: c["name"])
+        self.assertEquals([c["name"] for c in checks],
+                          ["site:web_0","site:web_1"])
+        self.assertEquals(checks[0]["group"],"site")
+
+    def test_failing_processes_are_restarted_one_per_group(self):
+        from StringIO import StringIO
+        from djsupervisor import health
+        checks = [{"name": "web:web_%d" % (i,), "group": "web",
+                   "kind": "tcp", "target": "127.0.0.1:1", "failures": 2,
+                   "interval": 1, "timeout": 1, "max_latency": None,
+                   "grace": 0} for i in xrange(2)]
+        checker = health.HealthChecker(None,checks,stream=StringIO())
+        restarts = []
+        checker.pool.apply_async = None
+        checker.restart_pool.apply_async = lambda func,args,callback: \
+                                               restarts.append(args)
+        for name in ("web:web_0","web:web_1"):
+            checker.state[name] = {"status": "unknown", "failures": 0}
+        for i in xrange(2):
+            checker.handle_result("probe","web:web_0",10,False,0.1,"refused")
+            checker.handle_result("probe","web:web_1",11,False,0.1,"refused")
+        self.assertEquals(restarts,[("web:web_0",)])
+        checker.handle_result("restart","web:web_0",[])
+        checker.handle_result("probe","web:web_1",11,False,0.1,"refused")
+        self.assertEquals(restarts,[("web:web_0",),("web:web_1",)])
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_dependencies_are_deferred_and_checked(self):
+        merged = config.parse_config(config.merge_config(["""
+[program:db]
+command=db
+
+[program:web]
+command=web
+depends_on=db, cache
+
+[program:cache]
+command=cache
+exclude=true
+"""],{}))
+        self.assertEquals(merged["program:web"]["depends_on"],"db")
+        self.assertEquals(merged["program:web"]["autostart"],"false")
+        self.assertEquals(merged["program:web"]["deferred_autostart"],"true")
+        self.assertFalse("autostart" in merged["program:db"])
+        merged = config.parse_config(config.merge_config(["""
+[program:db]
+command=db
+ready_when=log:ready to accept connections
+
+[program:web]
+command=web
+depends_on=db
+"""],{}))
+        self.assertEquals(merged["program:db"]["depends_on"],"")
+        self.assertEquals(merged["program:db"]["autostart"],"false")
+        self.assertEquals(merged["program:db"]["deferred_autostart"],"true")
+        self.assertRaises(ValueError,config.merge_config,["""
+[program:a]
+command=a
+depends_on=b
+
+[program:b]
+command=b
+depends_on=a
+"""],{})
+
+    def test_programs_are_started_once_dependencies_are_ready(self):
+        from StringIO import StringIO
+        from djsupervisor import startup
+        from supervisor.states import ProcessStates
+        states = {"db": [ProcessStates.STARTING,ProcessStates.RUNNING],
+                  "web": [ProcessStates.STOPPED],
+                  "worker": [ProcessStates.STOPPED]}
+        started = []
+        class FakeClient(object):
+            def get_all_process_info(self):
+                infos = []
+                for (name,history) in states.iteritems():
+                    state = history.pop(0) if len(history) > 1 else history[0]
+                    infos.append({"group": name, "name": name, "state": state})
+                return infos
+            def start(self,names,wait=True):
+                started.append(names)
+                for name in names:
+                    states[name.split(":")[1]] = [ProcessStates.RUNNING]
+                return []
+        programs = {
+            "db": {"depends_on": [], "ready_when": ("running",""),
+                   "deferred": False, "processes": ["db:db"]},
+            "web": {"depends_on": ["db"], "ready_when": ("running",""),
+                    "deferred": True, "processes": ["web:web"]},
+            "worker": {"depends_on": ["db","web"],
+                       "ready_when": ("running",""), "deferred": True,
+                       "processes": ["worker:worker"]},
+        }
+        runner = startup.Startup(FakeClient(),programs,poll_interval=0,
+                                 stream=StringIO())
+        self.assertTrue(runner.run())
+        self.assertEquals(started,[["web:web"],["worker:worker"]])
+
+    def test_dependencies_that_stay_stopped_have_failed(self):
+        from StringIO import StringIO
+        from djsupervisor import startup
+        from supervisor.states import ProcessStates
+        started = []
+        class FakeClient(object):
+            def get_all_process_info(self):
+                return [{"group": name, "name": name,
+                         "state": ProcessStates.STOPPED}
+                        for name in ("db","web")]
+            def start(self,names,wait=True):
+                started.append(names)
+                return []
+        programs = {
+            "db": {"depends_on": [], "ready_when": ("running",""),
+                   "deferred": False, "processes": ["db:db"]},
+            "web": {"depends_on": ["db"], "ready_when": ("running",""),
+                    "deferred": True, "processes": ["web:web"]},
+        }
+        runner = startup.Startup(FakeClient(),programs,poll_interval=0,
+                                 stopped_grace=0,stream=StringIO())
+        self.assertFalse(runner.run())
+        self.assertEquals(started,[])
+        self.assertTrue("not starting web" in runner.stream.getvalue())
+        #  A dependency that supervisord knows nothing about fails too.
+        programs["db"]["processes"] = ["data:db"]
+        runner = startup.Startup(FakeClient(),programs,poll_interval=0,
+                                 stopped_grace=0,stream=StringIO())
+        self.assertFalse(runner.run())
+        self.assertTrue("db has no processes" in runner.stream.getvalue())
+
+    def test_grouped_programs_are_found_by_process_name(self):
+        from ConfigParser import RawConfigParser
+        from StringIO import StringIO
+        from djsupervisor import startup
+        from supervisor.states import ProcessStates
+        cfg = RawConfigParser()
+        cfg.readfp(StringIO("[program:db]\n"
+                            "[program:web]\n"
+                            "depends_on=db\n"
+                            "deferred_autostart=true\n"
+                            "[group:site]\n"
+                            "programs=db,web\n"))
+        programs = startup.get_programs(cfg)
+        self.assertEquals(programs["web"]["processes"],["site:web"])
+        started = []
+        class FakeClient(object):
+            def get_all_process_info(self):
+                return [{"group": "site", "name": "db",
+                         "state": ProcessStates.RUNNING}]
+            def start(self,names,wait=True):
+                started.append(names)
+                return []
+        runner = startup.Startup(FakeClient(),programs,poll_interval=0,
+                                 stream=StringIO())
+        self.assertTrue(runner.run())
+        self.assertEquals(started,[["site:web"]])
+
+    def test_log_output_from_previous_runs_is_ignored(self):
+        from StringIO import StringIO
+        from djsupervisor import startup
+        from supervisor.states import ProcessStates
+        #  The log already says "ready" from a previous run, and this run
+        #  takes two polls to say it again.  The cache's log doesn't exist
+        #  until it has been started.
+        logs = {"db:db": "ready\n"}
+        output = ["starting\n","ready\n"]
+        states = {"db": ProcessStates.STOPPED, "cache": ProcessStates.STOPPED,
+                  "web": ProcessStates.STOPPED}
+        started = []
+        class FakeClient(object):
+            def get_all_process_info(self):
+                if states["db"] == ProcessStates.RUNNING and output:
+                    logs["db:db"] += output.pop(0)
+                return [{"group": name, "name": name, "state": state}
+                        for (name,state) in states.iteritems()]
+            def call(self,method,name,offset,length):
+                if name not in logs:
+                    raise xmlrpclib.Fault(10,"NO_FILE: %s" % (name,))
+                if method == "supervisor.tailProcessStdoutLog":
+                    return ["",len(logs[name]),False]
+                return logs[name][offset:offset + length]
+            def start(self,names,wait=True):
+                started.append((names,list(output)))
+                for name in names:
+                    states[name.split(":")[1]] = ProcessStates.RUNNING
+                    if name == "cache:cache":
+                        logs["cache:cache"] = "ready\n"
+                return []
+        programs = {
+            "db": {"depends_on": [], "ready_when": ("log","ready"),
+                   "deferred": True, "processes": ["db:db"]},
+            "cache": {"depends_on": [], "ready_when": ("log","ready"),
+                      "deferred": True, "processes": ["cache:cache"]},
+            "web": {"depends_on": ["db","cache"],
+                    "ready_when": ("running",""), "deferred": True,
+                    "processes": ["web:web"]},
+        }
+        runner = startup.Startup(FakeClient(),programs,poll_interval=0,
+                                 stream=StringIO())
+        self.assertTrue(runner.run())
+        self.assertEquals(started,[(["cache:cache","db:db"],
+                                    ["starting\n","ready\n"]),
+                                   (["web:web"],[])])
+
+
+class TestListenSockets(unittest.TestCase):
+
+    def test_programs_with_listen_become_fcgi_programs(self):
+        merged = config.parse_config(config.merge_config(["""
+[program:web]
+command=web --fd {{ SOCKET_FD }}
+numprocs=4
+listen=8000
+
+[program:api]
+command=api
+listen=/tmp/api.sock
+
+[program:cron]
+command=cron
+"""],{}))
+        self.assertFalse("program:web" in merged)
+        self.assertEquals(merged["fcgi-program:web"]["socket"],
+                          "tcp://127.0.0.1:8000")
+        self.assertFalse("listen" in merged["fcgi-program:web"])
+        self.assertEquals(merged["fcgi-program:api"]["socket"],
+                          "unix:///tmp/api.sock")
+        self.assertTrue("program:cron" in merged)
+        self.assertEquals(config.parse_listen_address("*:80"),
+                          "tcp://0.0.0.0:80")
+        self.assertRaises(ValueError,config.parse_listen_address,"nope")
+
+
+class TestZygote(unittest.TestCase):
+
+    def test_zygote_programs_are_run_by_the_spawn_script(self):
+        from djsupervisor import zygote
+        merged = config.parse_config(config.merge_config(["""
+[program:djsupervisor_zygote]
+command=python /proj/manage.py supervisor zygote
+
+[program:worker]
+command=python /proj/manage.py celery worker -n w%(process_num)s
+zygote=true
+
+[program:cron]
+command=python /proj/manage.py cron
+"""],{"project_dir": "/proj"}))
+        self.assertEquals(merged["program:worker"]["command"],
+                          "python %s /proj/.supervisor-cache/zygote.sock "
+                          "/proj/manage.py celery worker -n w%%(process_num)s"
+                          % (zygote.SPAWN_SCRIPT,))
+        self.assertFalse("zygote" in merged["program:worker"])
+        self.assertEquals(merged["program:cron"]["command"],
+                          "python /proj/manage.py cron")
+        self.assertRaises(ValueError,zygote.get_spawn_command,
+                          "/bin/sleep 10","/tmp/zygote.sock")
+
+    def test_file_descriptors_and_messages_are_passed(self):
+        import socket
+        from djsupervisor.spawn import Channel
+        (a,b) = socket.socketpair(socket.AF_UNIX,socket.SOCK_STREAM)
+        (r,w) = os.pipe()
+        try:
+            Channel(a).send_fds([w])
+            Channel(a).send({"argv": ["manage.py","check"]})
+            channel = Channel(b)
+            (fd,) = channel.recv_fds(1)
+            self.assertEquals(channel.recv(),{"argv": ["manage.py","check"]})
+            os.write(fd,"hello")
+            os.close(fd)
+            self.assertEquals(os.read(r,5),"hello")
+            a.close()
+            self.assertEquals(channel.recv(),None)
+        finally:
+            b.close()
+            os.close(r)
+            os.close(w)
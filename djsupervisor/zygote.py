@@ -0,0 +1,282 @@
+"""
+
+djsupervisor.zygote:  fork Django processes from a preloaded parent
+-------------------------------------------------------------------
+
+This module implements the "supervisor zygote" command, which is added to
+the config whenever a program has the zygote option.  The zygote sets up
+Django and imports the management commands of all such programs once, then
+listens on a unix socket.  Each of those programs is run by supervisord as
+the tiny djsupervisor/spawn.py script, which connects to the zygote and
+asks it to fork a worker for its manage.py command.  The workers start
+without importing anything, and share the zygote's memory copy-on-write.
+
+For each connection the zygote forks a session process, which receives the
+stdin, stdout and stderr of the spawn script, forks the worker with them,
+passes on any signals from the spawn script, and reports back the worker's
+exit status.  Sessions are in their own process group and outlive the
+zygote, so restarting the zygote doesn't affect running workers.
+
+"""
+
+import os
+import sys
+import time
+import errno
+import fcntl
+import shlex
+import random
+import select
+import signal
+import socket
+import traceback
+
+from djsupervisor.spawn import Channel
+
+SPAWN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "spawn.py")
+
+#  Signals whose handlers are reset to the default in each worker.
+RESET_SIGNALS = ("SIGCHLD","SIGHUP","SIGQUIT","SIGTERM","SIGUSR1","SIGUSR2")
+
+
+def get_spawn_command(command,socket_path):
+    """Rewrite a manage.py command to be forked from the zygote.
+
+    The command must be of the form "<python> <path>/manage.py <args>", and
+    it becomes "<python> <path>/spawn.py <socket> <path>/manage.py <args>".
+    """
+    parts = command.split(None,1)
+    if len(parts) < 2 or not parts[1].split()[0].endswith("manage.py"):
+        raise ValueError("not a manage.py command: %s" % (command,))
+    return "%s %s %s %s" % (parts[0],SPAWN_SCRIPT,socket_path,parts[1])
+
+
+def get_subcommands(cfg):
+    """Get the names of the manage.py commands run through the zygote."""
+    subcommands = set()
+    for section in cfg.sections():
+        if not cfg.has_option(section,"command"):
+            continue
+        args = shlex.split(cfg.get(section,"command"))
+        if len(args) > 4 and args[1] == SPAWN_SCRIPT:
+            subcommands.add(args[4])
+    return subcommands
+
+
+def preload(subcommands,modules=(),stream=None):
+    """Import everything that the workers are likely to need.
+
+    This loads the classes for the given management commands along with
+    any other named modules, and closes any database connections that were
+    opened along the way so that they aren't shared with the workers.
+    """
+    from importlib import import_module
+    from django.core.management import get_commands, load_command_class
+    from django.db import connections
+    stream = stream or sys.stderr
+    commands = get_commands()
+    for name in sorted(subcommands):
+        if name in commands:
+            try:
+                load_command_class(commands[name],name)
+            except Exception:
+                traceback.print_exc(file=stream)
+    for name in modules:
+        try:
+            import_module(name)
+        except Exception:
+            traceback.print_exc(file=stream)
+    connections.close_all()
+
+
+class Zygote(object):
+    """Fork workers on request from spawn scripts."""
+
+    def __init__(self,socket_path,stream=None):
+        self.socket_path = socket_path
+        self.stream = stream
+
+    def run(self):
+        """Listen for spawn requests until killed."""
+        dirname = os.path.dirname(self.socket_path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        try:
+            os.unlink(self.socket_path)
+        except EnvironmentError:
+            pass
+        listener = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        os.chmod(self.socket_path,0600)
+        listener.listen(128)
+        #  Remove the socket on the way out, so spawn scripts don't try to
+        #  connect while we're being restarted.
+        def terminate(signum,frame):
+            raise SystemExit(0)
+        signal.signal(signal.SIGTERM,terminate)
+        self.log("listening on %s" % (self.socket_path,))
+        try:
+            while True:
+                try:
+                    readable = select.select([listener],[],[],1)[0]
+                except select.error as e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    readable = []
+                if readable:
+                    (conn,_) = listener.accept()
+                    self.fork_session(listener,conn)
+                self.reap()
+        finally:
+            listener.close()
+            try:
+                os.unlink(self.socket_path)
+            except EnvironmentError:
+                pass
+
+    def fork_session(self,listener,conn):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                listener.close()
+                signal.signal(signal.SIGTERM,signal.SIG_DFL)
+                os.setpgrp()
+                self.run_session(conn)
+                status = 0
+            except Exception:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+        conn.close()
+
+    def reap(self):
+        """Clean up any session processes that have exited."""
+        while True:
+            try:
+                (pid,_) = os.waitpid(-1,os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+
+    def run_session(self,conn):
+        """Fork a worker for a spawn script, and report back its exit status.
+
+        This runs in its own process, forked from the zygote.
+        """
+        channel = Channel(conn)
+        fds = channel.recv_fds(3)
+        request = channel.recv()
+        if request is None:
+            return
+        start_time = time.time()
+        #  Wake up from select() when the worker exits.
+        (wakeup_r,wakeup_w) = os.pipe()
+        _set_nonblocking(wakeup_r)
+        _set_nonblocking(wakeup_w)
+        signal.set_wakeup_fd(wakeup_w)
+        signal.signal(signal.SIGCHLD,lambda signum,frame: None)
+        pid = os.fork()
+        if pid == 0:
+            signal.set_wakeup_fd(-1)
+            conn.close()
+            os.close(wakeup_r)
+            os.close(wakeup_w)
+            self.run_worker(request,fds)
+        for fd in fds:
+            os.close(fd)
+        self.log("forked %s for pid %d as pid %d in %.1fms" %
+                 (" ".join(request["argv"][1:]),request["pid"],pid,
+                  (time.time() - start_time) * 1000))
+        while True:
+            (waited,status) = os.waitpid(pid,os.WNOHANG)
+            if waited:
+                break
+            try:
+                readable = select.select([conn,wakeup_r],[],[])[0]
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+            if wakeup_r in readable:
+                try:
+                    os.read(wakeup_r,4096)
+                except OSError:
+                    pass
+            if conn in readable:
+                msg = channel.recv()
+                if msg is None:
+                    #  The spawn script has gone, so the worker must too.
+                    os.kill(pid,signal.SIGKILL)
+                    (_,status) = os.waitpid(pid,0)
+                    return
+                os.kill(pid,msg["signal"])
+        if os.WIFSIGNALED(status):
+            status = -os.WTERMSIG(status)
+        else:
+            status = os.WEXITSTATUS(status)
+        try:
+            channel.send({"exit": status})
+        except socket.error:
+            pass
+
+    def run_worker(self,request,fds):
+        """Run a management command in a newly-forked worker.
+
+        This never returns.
+        """
+        status = 1
+        try:
+            for (target,fd) in enumerate(fds):
+                os.dup2(fd,target)
+            for fd in fds:
+                if fd > 2:
+                    os.close(fd)
+            for name in RESET_SIGNALS:
+                signal.signal(getattr(signal,name),signal.SIG_DFL)
+            signal.signal(signal.SIGINT,signal.default_int_handler)
+            os.chdir(request["cwd"])
+            os.environ.clear()
+            os.environ.update(request["env"])
+            sys.argv = list(request["argv"])
+            random.seed()
+            from django.conf import settings
+            if getattr(settings,"SUPERVISOR_AUTORELOAD_SELECTIVE",False):
+                from djsupervisor.imports import start_reporting
+                start_reporting(pid=request["pid"])
+            from django.core.management import execute_from_command_line
+            execute_from_command_line(sys.argv)
+            status = 0
+        except SystemExit as e:
+            if e.code is None:
+                status = 0
+            elif isinstance(e.code,(int,long)):
+                status = e.code
+            else:
+                print>>sys.stderr, e.code
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(status)
+
+    def log(self,msg):
+        stream = self.stream or sys.stderr
+        print>>stream, "zygote: %s" % (msg,)
+        stream.flush()
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd,fcntl.F_GETFL)
+    fcntl.fcntl(fd,fcntl.F_SETFL,flags | os.O_NONBLOCK)